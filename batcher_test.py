@@ -0,0 +1,137 @@
+import os
+import threading
+import tempfile
+from time import time, sleep
+from icedb.batcher import Batcher, BatcherFullException, estimate_row_bytes
+
+
+class FakeIceDB:
+    """
+    Records inserted rows, failing the next `fail` inserts
+    """
+    def __init__(self, fail=0):
+        self.inserted = []
+        self.fail = fail
+
+    def insert(self, rows):
+        if self.fail > 0:
+            self.fail -= 1
+            raise Exception("insert failed")
+        self.inserted.extend(rows)
+        return []
+
+
+row = {"user_id": "a", "event": "click", "ts": 1}
+row_bytes = estimate_row_bytes(row)
+
+# threads are assigned to shards round-robin
+ice = FakeIceDB()
+batcher = Batcher(ice, shards=4)
+threads = list(map(lambda x: threading.Thread(target=lambda: batcher.insert([row])), range(8)))
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+assert list(map(lambda x: len(x.rows), batcher._Batcher__shards)) == [2, 2, 2, 2]
+assert batcher.metrics()["buffered_rows"] == 8
+assert batcher.flush() == 8
+assert len(ice.inserted) == 8
+
+# once the in-flight bytes are over the limit, inserts are rejected or block until a flush frees space
+batcher = Batcher(ice, max_inflight_bytes=2 * row_bytes, block=False)
+batcher.insert([row, row])
+try:
+    batcher.insert([row])
+    raise AssertionError("expected BatcherFullException")
+except BatcherFullException:
+    pass
+assert batcher.metrics()["rejected_rows"] == 1
+
+batcher = Batcher(ice, max_inflight_bytes=2 * row_bytes, block_timeout_sec=0.2)
+batcher.insert([row, row])
+s = time()
+try:
+    batcher.insert([row])
+    raise AssertionError("expected BatcherFullException")
+except BatcherFullException:
+    pass
+assert time() - s >= 0.2
+assert batcher.metrics()["waiting_inserts"] == 0
+
+batcher = Batcher(ice, max_inflight_bytes=2 * row_bytes, block_timeout_sec=None)
+batcher.insert([row, row])
+blocked = threading.Thread(target=lambda: batcher.insert([row]))
+blocked.start()
+deadline = time() + 5
+while batcher.metrics()["waiting_inserts"] == 0 and time() < deadline:
+    sleep(0.01)
+assert batcher.metrics()["waiting_inserts"] == 1
+assert blocked.is_alive() and batcher.metrics()["buffered_rows"] == 2
+batcher.flush()
+blocked.join(5)
+assert not blocked.is_alive()
+metrics = batcher.metrics()
+assert metrics["waiting_inserts"] == 0 and metrics["buffered_rows"] == 1 and metrics["rejected_rows"] == 0
+
+# a failed flush keeps its rows for the next flush
+ice = FakeIceDB(fail=1)
+batcher = Batcher(ice)
+batcher.insert([row, row, row])
+try:
+    batcher.flush()
+    raise AssertionError("expected the flush to fail")
+except Exception as e:
+    assert str(e) == "insert failed"
+metrics = batcher.metrics()
+assert metrics["flush_errors"] == 1 and metrics["buffered_rows"] == 3 and metrics["inflight_bytes"] == 3 * row_bytes
+batcher.insert([row])
+assert batcher.flush() == 4
+assert len(ice.inserted) == 4
+assert batcher.metrics()["inflight_bytes"] == 0
+
+# rows are durable in the write-ahead log before insert returns, and are buffered again by a new batcher after a crash
+wal_dir = tempfile.mkdtemp()
+batcher = Batcher(FakeIceDB(), wal_dir=wal_dir, shards=2)
+batcher.insert([row, row])
+batcher.insert([row])
+ice = FakeIceDB()
+batcher = Batcher(ice, wal_dir=wal_dir, shards=2)
+assert batcher.metrics()["buffered_rows"] == 3
+assert batcher.flush() == 3
+assert len(ice.inserted) == 3
+
+# rows that cannot be written to the write-ahead log are not buffered
+try:
+    batcher.insert([{"ts": object()}])
+    raise AssertionError("expected a TypeError")
+except TypeError:
+    pass
+assert batcher.metrics()["buffered_rows"] == 0
+
+# the segments of a failed flush are kept until their rows are inserted, and are replayed once after a crash
+wal_dir = tempfile.mkdtemp()
+ice = FakeIceDB(fail=1)
+batcher = Batcher(ice, wal_dir=wal_dir)
+batcher.insert([row, row])
+try:
+    batcher.flush()
+    raise AssertionError("expected the flush to fail")
+except Exception as e:
+    assert str(e) == "insert failed"
+assert len(batcher._Batcher__retry_segments) == 1
+retry_segment = batcher._Batcher__retry_segments[0]
+assert os.path.exists(retry_segment)
+ice = FakeIceDB()
+replayed = Batcher(ice, wal_dir=wal_dir)
+assert replayed.metrics()["buffered_rows"] == 2
+assert replayed.flush() == 2
+assert len(ice.inserted) == 2
+assert not os.path.exists(retry_segment)
+
+# a torn last line (from a crash while writing) is ignored
+wal_dir = tempfile.mkdtemp()
+with open(os.path.join(wal_dir, "1_torn.wal"), "w") as f:
+    f.write('[{"ts": 1}]\n[{"ts": 2}, {"ts"')
+assert Batcher(FakeIceDB(), wal_dir=wal_dir).metrics()["buffered_rows"] == 1
+
+print("passed!")
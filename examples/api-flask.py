@@ -39,6 +39,7 @@ curl http://localhost:8090/query
 
 from icedb.icedb import IceDBv3, CompressionCodec
 from icedb.log import IceLogIO
+from icedb.batcher import Batcher
 from datetime import datetime
 import json
 from time import time
@@ -50,7 +51,7 @@ import os
 
 class IceDBBatcher(object):
     """
-    Buffers inserted rows into memory and batch inserts them into icedb.
+    Buffers inserted rows into memory and batch inserts them into icedb (with `icedb.batcher.Batcher`).
 
     Runs merge on 10x the insert interval, and tombstone clean on 50x the insert interval.
 
@@ -58,46 +59,30 @@ class IceDBBatcher(object):
     """
 
     def __init__(self, icedb: IceDBv3, insert_interval_sec=3):
-        self._timer = None
         self._timer_merge = None
         self._timer_tombstone = None
         self.insert_interval_sec = insert_interval_sec
         self.icedb = icedb
-        self.is_running = False
+        self.batcher = Batcher(icedb, flush_interval_sec=insert_interval_sec)
         self.is_running_merge = False
         self.is_running_tombstone = False
         self.start()
-        self.rows = []
 
     def insert(self, rows: list[dict]):
-        # just append rows
-        self.rows = self.rows + rows
-
-    def _insert(self):
-        self.is_running = False
-        if len(self.rows) > 0:
-            try:
-                s = time()
-                self.icedb.insert(self.rows)
-                print("inserted in", time()-s)
-                self.rows = []
-            except Exception as e:
-                print("caught exception in _insert")
-                print(e)
-        self.start()
+        # buffer rows, blocking if too many are waiting to be inserted
+        self.batcher.insert(rows)
 
     def _merge(self):
         self.is_running_merge = False
         try:
-            merged_log: str | None = ""
-            while merged_log is not None:
-                print("running merge")
-                s = time()
-                merged_log, _, _, _, _ = self.icedb.merge()
-                if merged_log is not None:
-                    print("merged in", time() - s)
-                else:
-                    print("no files merged")
+            print("running merge")
+            s = time()
+            # merges every partition that needs it at once, in a single log file
+            merged_log, new_files, _, _ = self.icedb.merge_all()
+            if merged_log is not None:
+                print(f"merged {len(new_files)} partitions in", time() - s)
+            else:
+                print("no files merged")
         except Exception as e:
             print("caught exception in _merge")
             print(e)
@@ -119,10 +104,7 @@ class IceDBBatcher(object):
         self.start()
 
     def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.insert_interval_sec, self._insert)
-            self._timer.start()
-            self.is_running = True
+        self.batcher.start()
         if not self.is_running_merge:
             self._timer_merge = Timer(self.insert_interval_sec * 10, self._merge)
             self._timer_merge.start()
@@ -133,10 +115,9 @@ class IceDBBatcher(object):
             self.is_running_tombstone = True
 
     def stop(self):
-        self._timer.cancel()
+        self.batcher.stop()
         self._timer_merge.cancel()
         self._timer_tombstone.cancel()
-        self.is_running = False
         self.is_running_merge = False
         self.is_running_tombstone = False
 
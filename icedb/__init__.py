@@ -1,5 +1,19 @@
 from .log import (
     IceLogIO, Schema, LogMetadata, LogTombstone, NoLogFilesException, FileMarker, S3Client,
-    LogMetadataFromJSON, FileMarkerFromJSON, LogTombstoneFromJSON, SchemaConflictException, get_log_file_info
+    LogMetadataFromJSON, FileMarkerFromJSON, LogTombstoneFromJSON, SchemaConflictException, get_log_file_info,
+    LogState, is_checkpoint_log_file, get_file_partition, LogReadEngine, decode_log_header, decode_log_file,
+    decode_file_markers_arrow, fold_file_markers_arrow, file_markers_from_arrow, FileMarkerTable,
+    FileMarkerTableFromList,
+    zone_map_value, zone_map_stats, combine_zone_maps, zone_map_may_match, hive_partition_values
 )
-from .icedb import IceDBv3, PartitionFunctionType, CompressionCodec
+from .partition import (
+    PartitionSpec, PartitionField, PartitionTransform, PartitionSpecFromString, partition_matches,
+    partition_value_matches, check_partitions, PARTITION_NULL_VALUE
+)
+from .pool import DuckDBPool
+from .arrow_types import arrow_to_duckdb_type, arrow_schema_to_duckdb
+from .icedb import (
+    IceDBv3, PartitionFunctionType, CompressionCodec, ParquetWriter, InsertExecutor, LoadFormat,
+    PartitionFilterFunctionType, PredicateType
+)
+from .batcher import Batcher, BatcherFullException, estimate_row_bytes
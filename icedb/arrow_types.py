@@ -0,0 +1,103 @@
+import re
+import threading
+import duckdb
+import pyarrow as pa
+
+# Arrow types with a fixed DuckDB type name
+ARROW_DUCKDB_TYPES = {
+    pa.null(): "INTEGER",
+    pa.bool_(): "BOOLEAN",
+    pa.int8(): "TINYINT",
+    pa.int16(): "SMALLINT",
+    pa.int32(): "INTEGER",
+    pa.int64(): "BIGINT",
+    pa.uint8(): "UTINYINT",
+    pa.uint16(): "USMALLINT",
+    pa.uint32(): "UINTEGER",
+    pa.uint64(): "UBIGINT",
+    pa.float32(): "FLOAT",
+    pa.float64(): "DOUBLE",
+    pa.string(): "VARCHAR",
+    pa.large_string(): "VARCHAR",
+    pa.binary(): "BLOB",
+    pa.large_binary(): "BLOB",
+    pa.date32(): "DATE",
+    pa.date64(): "DATE",
+    pa.time32("s"): "TIME",
+    pa.time32("ms"): "TIME",
+    pa.time64("us"): "TIME",
+    pa.month_day_nano_interval(): "INTERVAL",
+}
+
+# DuckDB type names of timestamps without a time zone, by unit
+TIMESTAMP_UNIT_TYPES = {
+    "s": "TIMESTAMP_S",
+    "ms": "TIMESTAMP_MS",
+    "us": "TIMESTAMP",
+    "ns": "TIMESTAMP_NS",
+}
+
+_keywords: set[str] | None = None
+_keywords_lock = threading.Lock()
+
+
+def duckdb_keywords() -> set[str]:
+    """
+    The keywords of the installed DuckDB, read once per process
+    """
+    global _keywords
+    with _keywords_lock:
+        if _keywords is None:
+            with duckdb.connect(":memory:") as ddb:
+                _keywords = set(map(lambda x: x[0], ddb.execute(
+                    "select keyword_name from duckdb_keywords()").fetchall()))
+        return _keywords
+
+
+def duckdb_struct_field_name(name: str) -> str:
+    """
+    Struct field names are quoted when they are not plain identifiers, or are keywords
+    """
+    if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) and name.lower() not in duckdb_keywords():
+        return name
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def arrow_to_duckdb_type(arrow_type: pa.DataType) -> str | None:
+    """
+    Returns the name DuckDB's DESCRIBE gives a column of the Arrow type, including nested types (e.g.
+    `STRUCT(a BIGINT, b VARCHAR[])`), or None if it is not known.
+    """
+    if arrow_type in ARROW_DUCKDB_TYPES:
+        return ARROW_DUCKDB_TYPES[arrow_type]
+    if pa.types.is_timestamp(arrow_type):
+        return "TIMESTAMP WITH TIME ZONE" if arrow_type.tz is not None else TIMESTAMP_UNIT_TYPES[arrow_type.unit]
+    if pa.types.is_duration(arrow_type):
+        return "INTERVAL"
+    if pa.types.is_decimal128(arrow_type):
+        return f"DECIMAL({arrow_type.precision},{arrow_type.scale})"
+    if pa.types.is_dictionary(arrow_type):
+        return arrow_to_duckdb_type(arrow_type.value_type)
+    if pa.types.is_map(arrow_type):
+        key, item = arrow_to_duckdb_type(arrow_type.key_type), arrow_to_duckdb_type(arrow_type.item_type)
+        return f"MAP({key}, {item})" if key is not None and item is not None else None
+    if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+        value = arrow_to_duckdb_type(arrow_type.value_type)
+        return f"{value}[]" if value is not None else None
+    if pa.types.is_struct(arrow_type) and arrow_type.num_fields > 0:
+        fields = list(map(lambda x: (x.name, arrow_to_duckdb_type(x.type)), arrow_type))
+        if any(map(lambda x: x[1] is None, fields)):
+            return None
+        return "STRUCT({})".format(", ".join(map(lambda x: f"{duckdb_struct_field_name(x[0])} {x[1]}", fields)))
+    return None
+
+
+def arrow_schema_to_duckdb(schema: pa.Schema) -> tuple[list[str], list[str]] | None:
+    """
+    Returns the column names and DuckDB type names of an Arrow schema, the same as `describe select * from table`
+    would, or None if any type is not known.
+    """
+    types = list(map(lambda x: arrow_to_duckdb_type(x.type), schema))
+    if any(map(lambda x: x is None, types)):
+        return None
+    return schema.names, types
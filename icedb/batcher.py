@@ -0,0 +1,349 @@
+import os
+import json
+import logging
+import threading
+import itertools
+from time import time
+from typing import Dict
+from uuid import uuid4
+from .icedb import IceDBv3
+
+logger = logging.getLogger(__name__)
+
+class BatcherFullException(Exception):
+    """
+    Raised when rows can not be buffered because the in-flight bytes are over the limit
+    """
+    pass
+
+
+def estimate_row_bytes(row: dict) -> int:
+    """
+    A cheap estimate of the size of a row once in Arrow: the length of strings and bytes, and 8 bytes for anything else
+    """
+    return sum(map(lambda x: len(x) if isinstance(x, (str, bytes)) else 8, row.values()))
+
+
+def read_wal_segment(path: str) -> list[dict]:
+    """
+    Reads the rows of a write-ahead log segment. A torn last line (from a crash while writing) is ignored.
+    """
+    rows: list[dict] = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                rows.extend(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return rows
+
+
+class BatcherShard:
+    """
+    A buffer of rows with its own lock, so threads inserting into different shards do not contend.
+
+    With a `wal_dir`, rows are also appended to a local write-ahead log segment (a JSON array of rows per line), which
+    is rotated when the rows are taken for a flush.
+    """
+    lock: threading.Lock
+    rows: list[dict]
+    bytes: int
+    wal_dir: str | None
+
+    def __init__(self, wal_dir: str = None):
+        self.lock = threading.Lock()
+        self.rows = []
+        self.bytes = 0
+        self.wal_dir = wal_dir
+        # Serializes fsyncs, so concurrent writers share one fsync (group commit)
+        self.__sync_lock = threading.Lock()
+        self.__segment: str | None = None
+        self.__wal = None
+        self.__generation = 0
+        self.__synced = 0
+        if wal_dir is not None:
+            self.__open_segment()
+
+    def __open_segment(self):
+        self.__segment = os.path.join(self.wal_dir, f"{round(time() * 1000)}_{uuid4().hex}.wal")
+        self.__wal = open(self.__segment, "a")
+        self.__generation += 1
+        self.__synced = 0
+
+    def append(self, rows: list[dict], nbytes: int):
+        """
+        Buffers rows, and with a write-ahead log, returns once they are durable on local disk. Rows are only buffered
+        once they are written to the log, so rows that cannot be serialized or written are not buffered either.
+        """
+        line = json.dumps(rows) + "\n" if self.wal_dir is not None else None
+        with self.lock:
+            wal = self.__wal
+            if wal is not None:
+                wal.write(line)
+                generation, position = self.__generation, wal.tell()
+            self.rows.extend(rows)
+            self.bytes += nbytes
+        if wal is not None:
+            self.__sync(generation, position)
+
+    def __sync(self, generation: int, position: int):
+        with self.__sync_lock:
+            if generation != self.__generation or self.__synced >= position:
+                # Rotated (which syncs the old segment), or another writer's fsync already covered these rows
+                return
+            with self.lock:
+                self.__wal.flush()
+                end = self.__wal.tell()
+                fd = self.__wal.fileno()
+            os.fsync(fd)
+            self.__synced = end
+
+    def take(self) -> tuple[list[dict], int, str | None]:
+        """
+        Takes the buffered rows, returning them with the write-ahead log segment that holds them, if any
+        """
+        with self.__sync_lock, self.lock:
+            rows, nbytes, segment = self.rows, self.bytes, None
+            self.rows, self.bytes = [], 0
+            if self.__wal is not None and len(rows) > 0:
+                self.__wal.flush()
+                os.fsync(self.__wal.fileno())
+                self.__wal.close()
+                segment = self.__segment
+                self.__open_segment()
+            return rows, nbytes, segment
+
+    def close(self):
+        """
+        Closes the write-ahead log segment, removing it if it has no rows
+        """
+        with self.__sync_lock, self.lock:
+            if self.__wal is None:
+                return
+            self.__wal.flush()
+            os.fsync(self.__wal.fileno())
+            self.__wal.close()
+            self.__wal = None
+            if len(self.rows) == 0:
+                os.remove(self.__segment)
+
+
+class Batcher:
+    """
+    Buffers rows inserted from many threads, and inserts them into IceDB in batches from a background thread.
+
+    Rows are appended to one of `shards` buffers (assigned to threads round-robin), which keep their own counts, so
+    inserts from different threads only contend when they share a shard. A flush inserts every buffered row with
+    `IceDBv3.insert`, and runs every `flush_interval_sec` seconds, or sooner once `flush_rows` rows or `flush_bytes`
+    bytes are buffered. If a flush fails, its rows are buffered again and retried on the next flush.
+
+    Buffered and flushing rows count towards the in-flight bytes (see `estimate_row_bytes`). Once that would exceed
+    `max_inflight_bytes`, `insert` blocks until a flush frees space (or raises `BatcherFullException` after
+    `block_timeout_sec`), or raises `BatcherFullException` immediately if `block` is False. The limit is checked
+    without a global lock, so concurrent inserts may each exceed it by their own batch.
+
+    With a `wal_dir`, inserted rows are appended to local write-ahead log segments (one per shard) and fsynced before
+    `insert` returns, concurrent inserts sharing an fsync. Segments are deleted once their rows are inserted, and
+    segments left by a previous process (e.g. after a crash) are buffered again on startup. Rows must be JSON
+    serializable. Each process needs its own `wal_dir`.
+    """
+    icedb: IceDBv3
+    flush_rows: int
+    flush_bytes: int
+    flush_interval_sec: float
+    max_inflight_bytes: int
+    block: bool
+    block_timeout_sec: float | None
+
+    def __init__(self, icedb: IceDBv3, flush_rows: int = 100_000, flush_bytes: int = 64 * 1024 * 1024,
+                 flush_interval_sec: float = 3, max_inflight_bytes: int = 256 * 1024 * 1024, block: bool = True,
+                 block_timeout_sec: float = None, shards: int = os.cpu_count(), wal_dir: str = None):
+        self.icedb = icedb
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_interval_sec = flush_interval_sec
+        self.max_inflight_bytes = max_inflight_bytes
+        self.block = block
+        self.block_timeout_sec = block_timeout_sec
+        self.wal_dir = wal_dir
+        # Guards the flushing bytes and metrics, and is notified when in-flight bytes are freed. Buffered rows and bytes
+        # are counted by each shard.
+        self.__space = threading.Condition()
+        self.__flushing_bytes = 0
+        self.__local = threading.local()
+        self.__next_shard = itertools.count()
+        # Write-ahead log segments of rows that were buffered again after a failed flush, or replayed
+        self.__retry_segments: list[str] = []
+
+        replayed: list[dict] = []
+        if wal_dir is not None:
+            os.makedirs(wal_dir, exist_ok=True)
+            self.__retry_segments = sorted(map(lambda x: os.path.join(wal_dir, x),
+                                               filter(lambda x: x.endswith(".wal"), os.listdir(wal_dir))))
+            for segment in self.__retry_segments:
+                replayed.extend(read_wal_segment(segment))
+
+        self.__shards = list(map(lambda x: BatcherShard(wal_dir), range(max(shards or 1, 1))))
+        if len(replayed) > 0:
+            # Already durable in the replayed segments, so they are not written again
+            nbytes = sum(map(estimate_row_bytes, replayed))
+            self.__shards[0].rows.extend(replayed)
+            self.__shards[0].bytes += nbytes
+        self.__flush_now = threading.Event()
+        self.__stopping = False
+        self.__thread: threading.Thread | None = None
+        self.__metrics = {
+            "flushes": 0,
+            "flush_errors": 0,
+            "flushed_rows": 0,
+            "rejected_rows": 0,
+            "waiting_inserts": 0,
+            "last_flush_latency_sec": 0.0,
+            "max_flush_latency_sec": 0.0,
+        }
+
+    def start(self):
+        """
+        Starts the background flush thread
+        """
+        if self.__thread is not None:
+            return
+        self.__stopping = False
+        self.__thread = threading.Thread(target=self.__run, name="icedb-batcher", daemon=True)
+        self.__thread.start()
+
+    def stop(self, flush=True):
+        """
+        Stops the background flush thread, flushing the remaining rows first unless `flush` is False
+        """
+        if self.__thread is None:
+            return
+        self.__stopping = True
+        self.__flush_now.set()
+        self.__thread.join()
+        self.__thread = None
+        if flush:
+            self.flush()
+        for shard in self.__shards:
+            shard.close()
+
+    def insert(self, rows: list[dict]):
+        """
+        Buffers rows to be inserted. Blocks or raises `BatcherFullException` if the in-flight bytes are over the limit.
+        """
+        if len(rows) == 0:
+            return
+        nbytes = sum(map(estimate_row_bytes, rows))
+
+        # A batch larger than the limit is still accepted once nothing else is in flight
+        def has_space() -> bool:
+            inflight = self.__inflight_bytes()
+            return inflight + nbytes <= self.max_inflight_bytes or inflight == 0
+
+        if not has_space():
+            with self.__space:
+                has_room = False
+                if self.block:
+                    self.__metrics["waiting_inserts"] += 1
+                    try:
+                        has_room = self.__space.wait_for(has_space, self.block_timeout_sec)
+                    finally:
+                        self.__metrics["waiting_inserts"] -= 1
+                if not has_room:
+                    self.__metrics["rejected_rows"] += len(rows)
+                    raise BatcherFullException(f"{self.__inflight_bytes()} bytes in flight, limit is "
+                                               f"{self.max_inflight_bytes}")
+
+        self.__shard().append(rows, nbytes)
+
+        buffered_rows, buffered_bytes = self.__buffered()
+        if buffered_rows >= self.flush_rows or buffered_bytes >= self.flush_bytes:
+            self.__flush_now.set()
+
+    def __shard(self) -> BatcherShard:
+        """
+        The shard of the calling thread, assigned round-robin on its first insert
+        """
+        index = getattr(self.__local, "shard", None)
+        if index is None:
+            index = self.__local.shard = next(self.__next_shard) % len(self.__shards)
+        return self.__shards[index]
+
+    def __buffered(self) -> tuple[int, int]:
+        return sum(map(lambda x: len(x.rows), self.__shards)), sum(map(lambda x: x.bytes, self.__shards))
+
+    def __inflight_bytes(self) -> int:
+        return self.__buffered()[1] + self.__flushing_bytes
+
+    def flush(self) -> int:
+        """
+        Inserts every buffered row now. Returns the number of rows inserted.
+        """
+        rows: list[dict] = []
+        nbytes = 0
+        with self.__space:
+            segments, self.__retry_segments = self.__retry_segments, []
+            for shard in self.__shards:
+                shard_rows, shard_bytes, segment = shard.take()
+                rows.extend(shard_rows)
+                nbytes += shard_bytes
+                if segment is not None:
+                    segments.append(segment)
+            # Still in flight until inserted
+            self.__flushing_bytes += nbytes
+        if len(rows) == 0:
+            return 0
+
+        s = time()
+        try:
+            self.icedb.insert(rows)
+        except Exception as e:
+            # Keep the rows (and their in-flight bytes) for the next flush, they are still in their WAL segments
+            shard = self.__shards[0]
+            with shard.lock:
+                shard.rows.extend(rows)
+                shard.bytes += nbytes
+            with self.__space:
+                self.__flushing_bytes -= nbytes
+                self.__retry_segments.extend(segments)
+                self.__metrics["flush_errors"] += 1
+            raise e
+
+        for segment in segments:
+            os.remove(segment)
+
+        latency = time() - s
+        with self.__space:
+            self.__flushing_bytes -= nbytes
+            self.__metrics["flushes"] += 1
+            self.__metrics["flushed_rows"] += len(rows)
+            self.__metrics["last_flush_latency_sec"] = latency
+            self.__metrics["max_flush_latency_sec"] = max(self.__metrics["max_flush_latency_sec"], latency)
+            self.__space.notify_all()
+        return len(rows)
+
+    def metrics(self) -> Dict[str, int | float]:
+        """
+        Returns the queue depth (`buffered_rows`, `buffered_bytes`), `inflight_bytes` (buffered or flushing), the inserts
+        blocked waiting for space (`waiting_inserts`), and flush counts and latencies
+        """
+        buffered_rows, buffered_bytes = self.__buffered()
+        with self.__space:
+            return {
+                "buffered_rows": buffered_rows,
+                "buffered_bytes": buffered_bytes,
+                "inflight_bytes": buffered_bytes + self.__flushing_bytes,
+                **self.__metrics
+            }
+
+    def __run(self):
+        while not self.__stopping:
+            self.__flush_now.wait(self.flush_interval_sec)
+            self.__flush_now.clear()
+            if self.__stopping:
+                return
+            try:
+                self.flush()
+            except Exception:
+                # Counted in flush_errors, the rows are retried on the next flush
+                logger.exception("error flushing batcher")
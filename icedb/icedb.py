@@ -1,15 +1,30 @@
+import io
 import os
-from typing import List, Callable, Dict
+import inspect
+import tempfile
+from contextlib import contextmanager
+from typing import List, Callable, Dict, Iterable
 import duckdb
 from uuid import uuid4
-from .log import (IceLogIO, Schema, LogMetadata, S3Client, FileMarker, LogTombstone, get_log_file_info,
-                 LogMetadataFromJSON, LogTombstoneFromJSON, FileMarkerFromJSON)
-from time import time, sleep
-import json
+from urllib.parse import unquote
+from .log import (IceLogIO, Schema, SchemaConflictException, LogMetadata, S3Client, FileMarker, LogTombstone,
+                 get_log_file_info, LogState, is_checkpoint_log_file, get_file_partition, LogReadEngine,
+                 decode_file_markers_arrow, fold_file_markers_arrow, file_markers_from_arrow, FileMarkerTable,
+                 FileMarkerTableFromList, zone_map_stats, combine_zone_maps, arrow_zone_map, parquet_zone_map,
+                 zone_map_may_match, hive_partition_values)
+from .partition import PartitionSpec, partition_matches, check_partitions
+from .pool import DuckDBPool
+from .arrow_types import arrow_schema_to_duckdb
+from time import time
 from enum import Enum
 import pyarrow as pa
-from copy import deepcopy
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 import concurrent.futures
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
 
 
 class CompressionCodec(Enum):
@@ -19,11 +34,74 @@ class CompressionCodec(Enum):
     GZIP = "GZIP"
 
 
+class ParquetWriter(Enum):
+    """
+    How data files are encoded. Both write to local memory or a temporary file that is then uploaded.
+    """
+    DUCKDB = "duckdb"  # DuckDB COPY to a temporary file
+    PYARROW = "pyarrow"  # pyarrow, in memory for inserts, or streamed from a DuckDB query into a temporary file
+
+
+class InsertExecutor(Enum):
+    """
+    Where partitions are encoded and uploaded on insert
+    """
+    THREAD = "thread"  # a thread per partition, in this process
+    PROCESS = "process"  # a pool of worker processes, which read each partition from shared memory
+
+
+class LoadFormat(Enum):
+    """
+    Formats of the source files of `load_files`, and the DuckDB function that reads them
+    """
+    CSV = "read_csv_auto"
+    JSON = "read_json_auto"  # newline-delimited JSON, or JSON arrays
+    PARQUET = "read_parquet"
+
+
+class LogAppendGroup:
+    """
+    The file markers and schemas of concurrent inserts that are appended to the log in a single log file
+    """
+    entries: list[tuple[Schema, list[FileMarker]]]
+    errors: list[Exception | None]
+    done: threading.Event
+
+    def __init__(self):
+        self.entries = []
+        self.errors = []
+        self.done = threading.Event()
+
+
+# Row dicts are converted to Arrow in chunks of at most this many rows when streaming inserts
+STREAM_CHUNK_ROWS = 10_000
+
 PartitionFunctionType = Callable[[dict], str]
 PartitionRemovalFunctionType = Callable[[list[str]], list[str]]
+PartitionFilterFunctionType = Callable[[str], bool]
+# (column, operator, value), e.g. ("ts", "between", (a, b)) or ("user_id", "=", "x"), see `zone_map_may_match`
+PredicateType = tuple[str, str, object]
+
+def concat_tables(tables: list[pa.Table]) -> pa.Table:
+    """
+    Concatenates tables, adding null columns for columns missing from some of them, and casting columns whose type
+    differs between tables to a common type (e.g. int64 and double to double). Raises a `pyarrow.ArrowTypeError` if
+    there is none (e.g. int64 and string), like the schema of the log would.
+    """
+    if len(tables) == 1:
+        return tables[0]
+    schema = pa.unify_schemas(list(map(lambda x: x.schema, tables)), promote_options="permissive")
+
+    def cast(table: pa.Table) -> pa.Table:
+        fields = list(filter(lambda x: x.name in table.column_names, schema))
+        return table.select(list(map(lambda x: x.name, fields))).cast(pa.schema(fields))
+
+    return pa.concat_tables(list(map(cast, tables)), promote_options="default")
+
 
 class IceDBv3:
     partition_function: PartitionFunctionType
+    partition_spec: PartitionSpec | None
     sort_order: List[str]
     s3c: S3Client
     unique_row_key: str | None
@@ -35,10 +113,22 @@ class IceDBv3:
     preserve_partition: bool
     max_threads: int
     duckdb_ext_dir: str
+    log_state: LogState | None
+    log_version: int
+    log_read_engine: LogReadEngine
+    duckdb_pool: DuckDBPool
+    parquet_writer: ParquetWriter
+    insert_executor: InsertExecutor
+    insert_processes: int
+    target_file_bytes: int | None
+    max_rows_per_file: int | None
+    bloom_filter_columns: list[str]
+    write_page_index: bool
+    group_commit_ms: float | None
 
     def __init__(
             self,
-            partition_function: PartitionFunctionType,
+            partition_function: PartitionFunctionType | PartitionSpec,
             sort_order: List[str],
             s3_region: str,
             s3_access_key: str,
@@ -54,9 +144,24 @@ class IceDBv3:
             row_group_size: int = 122_880,
             compression_codec: CompressionCodec = CompressionCodec.SNAPPY,
             preserve_partition: bool = False,
-            max_threads: int = os.cpu_count()
+            max_threads: int = os.cpu_count(),
+            cache_log_state: bool = True,
+            log_version: int = 1,
+            log_read_engine: LogReadEngine = LogReadEngine.PYTHON,
+            parquet_writer: ParquetWriter = ParquetWriter.DUCKDB,
+            multipart_chunksize: int = 8 * 1024 * 1024,
+            multipart_max_concurrency: int = 10,
+            insert_executor: InsertExecutor = InsertExecutor.THREAD,
+            insert_processes: int = None,
+            target_file_bytes: int = None,
+            max_rows_per_file: int = None,
+            bloom_filter_columns: list[str] = None,
+            write_page_index: bool = False,
+            group_commit_ms: float = None
     ):
         self.partition_function = partition_function
+        # A declarative spec is evaluated in bulk on insert, and used to map predicates to partitions
+        self.partition_spec = partition_function if isinstance(partition_function, PartitionSpec) else None
         self.sort_order = sort_order
         self.row_group_size = row_group_size
         self.path_safe_hostname = path_safe_hostname
@@ -72,15 +177,60 @@ class IceDBv3:
         self.s3_secret_key = s3_secret_key
         self.s3_endpoint = s3_endpoint
         self.s3_use_path = s3_use_path
+        # Long-lived view of the log, so repeated merges only fetch new log files
+        self.log_state = LogState() if cache_log_state else None
+        self.log_version = log_version
+        self.log_read_engine = log_read_engine
+        self.parquet_writer = parquet_writer
+        self.multipart_chunksize = multipart_chunksize
+        self.multipart_max_concurrency = multipart_max_concurrency
+        self.insert_executor = insert_executor
+        self.insert_processes = insert_processes if insert_processes is not None else max_threads
+        self.target_file_bytes = target_file_bytes
+        self.max_rows_per_file = max_rows_per_file
+        self.bloom_filter_columns = bloom_filter_columns if bloom_filter_columns is not None else []
+        self.write_page_index = write_page_index
+        self.group_commit_ms = group_commit_ms
+        # The group of concurrent inserts waiting to be appended to the log together, see `group_commit_ms`
+        self.__group_commit: LogAppendGroup | None = None
+        self.__group_commit_lock = threading.Lock()
+        # Notified when an insert joins a group or finishes, so a group is appended once no other insert can join it
+        self.__group_commit_changed = threading.Condition(self.__group_commit_lock)
+        self.__inserts_in_progress = 0
+        self.__group_append_lock = threading.Lock()
+        self.__last_group_append = 0
+        # Started on the first insert with `InsertExecutor.PROCESS`, and kept until `close`
+        self.__process_pool: concurrent.futures.ProcessPoolExecutor | None = None
+        self.__process_pool_lock = threading.Lock()
 
         if not isinstance(compression_codec, CompressionCodec):
             raise AttributeError(f"invalid compression codec '{compression_codec}', must be one of type CompressionCodec")
 
         self.compression_codec = compression_codec
 
+        if (len(self.bloom_filter_columns) > 0 or write_page_index) and parquet_writer != ParquetWriter.PYARROW:
+            raise ValueError("bloom_filter_columns and write_page_index need parquet_writer=ParquetWriter.PYARROW")
+        # Not in pyarrow versions older than the pinned one, which would raise a TypeError on every write
+        writer_options = inspect.signature(pq.ParquetWriter.__init__).parameters
+        if len(self.bloom_filter_columns) > 0 and "bloom_filter_options" not in writer_options:
+            raise ValueError(f"bloom_filter_columns needs a pyarrow version that writes bloom filters, "
+                             f"pyarrow {pa.__version__} is installed")
+        if write_page_index and "write_page_index" not in writer_options:
+            raise ValueError(f"write_page_index needs a pyarrow version that writes page indexes, "
+                             f"pyarrow {pa.__version__} is installed")
+
+        # DuckDB is configured once, and connections are handed out to each operation (and insert thread)
+        self.duckdb_pool = DuckDBPool(lambda: self.get_duckdb(), max_threads)
+        # Shared by all uploads, so large files are uploaded in parallel parts, and total concurrency is bounded
+        self.transfer_manager = create_transfer_manager(self.s3c.s3, TransferConfig(
+            multipart_threshold=multipart_chunksize,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=multipart_max_concurrency
+        ))
+
     def get_duckdb(self) -> duckdb:
         """
-        threadsafe creation of a duckdb session
+        threadsafe creation of a duckdb session. Operations use connections from `duckdb_pool`, which calls this once.
         """
         ddb = duckdb.connect(":memory:")
         ddb.execute("install httpfs")
@@ -97,34 +247,83 @@ class IceDBv3:
         return ddb
 
     def __get_file_partition(self, full_path: str) -> str:
-        base_path = full_path.split("_data/")[1]
-        path_parts = base_path.split("/")
-        # remove the file name
-        partition = '/'.join(path_parts[:-1])
-        return partition
+        return get_file_partition(full_path)
+
+    def __get_zone_map(self, ddb: duckdb.DuckDBPyConnection, source: str, columns: list[str],
+                       params: list = None) -> tuple[int, Dict[str, list]]:
+        """
+        Returns the row count of a query, and the min, max, and null count of the given columns
+        """
+        selects = ["count(*)"]
+        for column in columns:
+            quoted = '"{}"'.format(column.replace('"', '""'))
+            selects += [f"min({quoted})", f"max({quoted})", f"count(*) - count({quoted})"]
+        row = ddb.execute("select {} from ({})".format(", ".join(selects), source), params).fetchone()
+        zone_map: Dict[str, list] = {}
+        for i in range(len(columns)):
+            stats = zone_map_stats(row[1 + i * 3], row[2 + i * 3], row[3 + i * 3])
+            if stats is not None:
+                zone_map[columns[i]] = stats
+        return row[0], zone_map
+
+    def __file_zone_map(self, ddb: duckdb.DuckDBPyConnection, local: str,
+                        columns: list[str]) -> tuple[int, Dict[str, list]]:
+        """
+        Returns the row count of a local parquet file, and the zone map of the given columns from the statistics in
+        its footer. The file is only scanned if a column is missing statistics.
+        """
+        row_count, zone_map = parquet_zone_map(pq.read_metadata(local), columns)
+        if zone_map is None:
+            return self.__get_zone_map(ddb, "select * from read_parquet(?)", columns, [local])
+        return row_count, zone_map
 
     def get_schema(self, rows: list[dict]):
         """
         Creates one or more files in the destination folder based on the partition strategy :param rows: Rows of JSON
         data to be inserted. Must have the expected keys of the partitioning strategy and the sorting order
         """
-        running_schema = Schema()
-
         # py arrow table
         _rows = pa.Table.from_pylist(rows)
 
-        # get schema
-        ddb = self.get_duckdb()
-        ddb.execute("describe {}".format("select * from _rows" if self.custom_insert_query is None
-                                                         else self.custom_insert_query))
-        schema_arrow = ddb.arrow()
-        running_schema.accumulate(list(map(lambda x: str(x), schema_arrow.column('column_name'))), list(map(lambda x:
-         str(x), schema_arrow.column('column_type'))))
+        running_schema = self.__arrow_schema(_rows.schema)
+        if running_schema is None:
+            with self.duckdb_pool.connection() as ddb:
+                ddb.register("_rows", _rows)
+                running_schema = self.__describe_schema(ddb)
+                ddb.unregister("_rows")
         return running_schema
 
-    def __insert_part(self, part: str, part_ref: list[dict]) -> tuple[FileMarker, Schema]:
+    def __arrow_schema(self, schema: pa.Schema) -> Schema | None:
+        """
+        Maps the Arrow schema of inserted rows to DuckDB types without DuckDB. Returns None if the rows must be
+        described with DuckDB, because a custom insert query may change their shape, or a type is not known.
+        """
+        if self.custom_insert_query is not None:
+            return None
+        columns = arrow_schema_to_duckdb(schema)
+        if columns is None:
+            return None
         running_schema = Schema()
+        running_schema.accumulate(columns[0], columns[1])
+        return running_schema
 
+    def __describe_schema(self, ddb: duckdb.DuckDBPyConnection) -> Schema:
+        """
+        Describes the schema of the rows registered as `_rows`, after the custom insert query if there is one
+        """
+        running_schema = Schema()
+        ddb.execute("describe {}".format("select * from _rows" if self.custom_insert_query is None
+                                         else self.custom_insert_query))
+        schema_arrow = ddb.fetch_arrow_table()
+        running_schema.accumulate(list(map(lambda x: str(x), schema_arrow.column('column_name'))),
+                                  list(map(lambda x: str(x), schema_arrow.column('column_type'))))
+        return running_schema
+
+    def _insert_part(self, part: str, _rows: pa.Table, schema: Schema | None) -> tuple[FileMarker, Schema]:
+        """
+        Writes and uploads the file of a partition, returning its file marker and schema. Also called by the insert
+        worker processes, see `_insert_part_in_process`.
+        """
         # upload parquet file
         filename = str(uuid4()) + '.parquet'
         path_parts = ['_data', part, filename]
@@ -132,81 +331,368 @@ class IceDBv3:
             path_parts = [self.s3c.s3prefix] + path_parts
         fullpath = '/'.join(path_parts)
 
-        # py arrow table for inserting into duckdb
-        _rows = pa.Table.from_pylist(part_ref)
-
-        # get schema
-        ddb = self.get_duckdb()
-        ddb.execute("describe select * from _rows")
-        schema_arrow = ddb.arrow()
-        running_schema.accumulate(list(map(lambda x: str(x), schema_arrow.column('column_name'))),
-                                  list(map(lambda x: str(x), schema_arrow.column('column_type'))))
+        with self.duckdb_pool.connection() as ddb:
+            ddb.register("_rows", _rows)
+            try:
+                running_schema = schema if schema is not None else self.__describe_schema(ddb)
+                file_size, row_count, zone_map = self.__write_part(
+                    ddb, fullpath, _rows, list(filter(lambda x: x in running_schema, self.sort_order)))
+                insert_time = round(time() * 1000)
+            finally:
+                # the pooled connection must not keep the rows alive
+                ddb.unregister("_rows")
+
+        return FileMarker(fullpath, insert_time, file_size, None, row_count, zone_map), running_schema
+
+    def __write_part(self, ddb: duckdb.DuckDBPyConnection, fullpath: str, _rows: pa.Table,
+                     zone_map_columns: list[str]) -> tuple[int, int, Dict[str, list]]:
+        """
+        Writes the rows (registered as `_rows`) to a parquet file at the path. Returns the file size, and the row count
+        and zone map of the given columns.
+        """
+        if self.custom_insert_query is None:
+            # the file has the rows still in memory, so their statistics are computed in Arrow
+            row_count, zone_map = arrow_zone_map(_rows, zone_map_columns)
+            if zone_map is None:
+                row_count, zone_map = self.__get_zone_map(ddb, "select * from _rows", zone_map_columns)
+
+        if self.parquet_writer == ParquetWriter.PYARROW and self.custom_insert_query is None:
+            # encode the rows still in memory, without a round trip through DuckDB
+            buffer = io.BytesIO()
+            pq.write_table(_rows.sort_by(list(map(lambda x: (x, "ascending"), self.sort_order))), buffer,
+                           row_group_size=self.row_group_size, **self.__pyarrow_options(_rows.schema))
+            return self.__upload_file(buffer, fullpath), row_count, zone_map
 
         # copy to parquet file
-        s = time()
-        retries = 0
-        while retries < 3:
-            try:
-                # if retries > 0:
-                    # print(f"retrying duckdb s3 upload try {retries}")
-                ddb.execute("""
-                            copy ({}) to 's3://{}/{}' (format parquet, codec '{}', row_group_size {})
-                            """.format(
-                    'select * from _rows order by {}'.format(
-                        ','.join(self.sort_order)) if self.custom_insert_query is None else self.custom_insert_query,
-                    self.s3c.s3bucket,
-                    fullpath,
+        with self.__copy_to_local_parquet(ddb, 'select * from _rows order by {}'.format(
+                ','.join(self.sort_order)) if self.custom_insert_query is None else self.custom_insert_query) as local:
+            if self.custom_insert_query is not None:
+                # the query may change the rows, so their statistics are read from the footer of the written file
+                row_count, zone_map = self.__file_zone_map(ddb, local, zone_map_columns)
+            return self.__upload_file(local, fullpath), row_count, zone_map
+
+    @contextmanager
+    def __copy_to_local_parquet(self, ddb: duckdb.DuckDBPyConnection, query: str, params: list = None):
+        """
+        Writes the result of a query to a temporary local parquet file, yielding its path. The file is removed on exit.
+        """
+        fd, local = tempfile.mkstemp(suffix='.parquet')
+        os.close(fd)
+        try:
+            if self.parquet_writer == ParquetWriter.PYARROW:
+                # stream the result, so only a row group is in memory at once
+                reader = ddb.execute(query, params).fetch_record_batch(self.row_group_size)
+                with pq.ParquetWriter(local, reader.schema, **self.__pyarrow_options(reader.schema)) as writer:
+                    for batch in reader:
+                        writer.write_batch(batch, row_group_size=self.row_group_size)
+            else:
+                ddb.execute("copy ({}) to '{}' (format parquet, codec '{}', row_group_size {})".format(
+                    query,
+                    local,
                     self.compression_codec.value,
                     self.row_group_size
-                ))
-                break
-            except duckdb.HTTPException as e:
-                if e.status_code < 500:
-                    raise e
-                if retries >= 3:
-                    raise e
-                retries += 1
-                print(f"HTTP exception (code {e.status_code}) uploading part on try {retries}, sleeping "
-                      f"{300*retries}ms before retrying")
-                sleep(0.3*retries)
-            except Exception as e:
-                raise e
-
-        insert_time = round(time() * 1000)
-
-        # get file metadata
-        obj = self.s3c.s3.head_object(
-            Bucket=self.s3c.s3bucket,
-            Key=fullpath
-        )
-        return FileMarker(fullpath, insert_time, obj['ContentLength']), running_schema
+                ), params)
+            yield local
+        finally:
+            os.remove(local)
+
+    def __pyarrow_options(self, schema: pa.Schema) -> dict:
+        """
+        Options of the pyarrow parquet writer. Page indexes and bloom filters are only passed when enabled, as older
+        pyarrow versions do not have them.
+        """
+        options = {
+            "compression": "none" if self.compression_codec == CompressionCodec.UNCOMPRESSED
+            else self.compression_codec.value.lower()
+        }
+        if self.write_page_index:
+            options["write_page_index"] = True
+        # Sized for a row group of distinct values, a larger filter is wasted space for every column chunk
+        bloom_filters = dict(map(lambda x: (x, {"ndv": self.row_group_size}),
+                                 filter(lambda x: x in schema.names, self.bloom_filter_columns)))
+        if len(bloom_filters) > 0:
+            options["bloom_filter_options"] = bloom_filters
+        return options
+
+    def __upload_file(self, local: str | io.BytesIO, fullpath: str) -> int:
+        """
+        Uploads a local file (or buffer) to the path in the bucket with the shared transfer manager, returning its
+        size. Knowing the size up front avoids a `head_object` after the upload, and boto3 retries failed requests.
+        """
+        size = local.getbuffer().nbytes if isinstance(local, io.BytesIO) else os.path.getsize(local)
+        if isinstance(local, io.BytesIO):
+            local.seek(0)
+        self.transfer_manager.upload(local, self.s3c.s3bucket, fullpath).result()
+        return size
 
     def insert(self, rows: list[dict]) -> list[FileMarker]:
         """
         Creates one or more files in the destination folder based on the partition strategy :param rows: Rows of JSON
         data to be inserted. Must have the expected keys of the partitioning strategy and the sorting order
         """
-        part_map: Dict[str, list[dict]] = {}
-        for row in rows:
-            part: str
-            if "_partition" in row:
-                part = row["_partition"]
-                if not self.preserve_partition:
-                    del row["_partition"]
-            else:
-                part = self.partition_function(row)
+        with self.__inserting():
+            return self.__insert_table(*self.__partition_rows(rows))
+
+    def insert_arrow(self, data: pa.Table | pa.RecordBatchReader, partition_expr: str = None) -> list[FileMarker]:
+        """
+        Creates one or more files in the destination folder based on the partition strategy, writing each partition
+        straight from Arrow memory.
+
+        The partition of each row is, in order of preference:
+        1. The result of `partition_expr`, a DuckDB SQL expression over the columns of the table, e.g.
+           `'u=' || user_id || '/d=' || strftime(ts, '%Y-%m-%d')`
+        2. The `_partition` column, which is dropped unless `preserve_partition` is set
+        3. The partition spec, if `partition_function` is a `PartitionSpec`
+        4. The result of `partition_function` for each row (slow, as each row is converted to a dict)
+        """
+        with self.__inserting():
+            return self.__insert_table(*self.__partition_table(
+                data.read_all() if isinstance(data, pa.RecordBatchReader) else data, partition_expr))
+
+    def insert_stream(self, rows_or_batches: Iterable[dict | pa.RecordBatch | pa.Table], max_rows: int = 1_000_000,
+                      max_bytes: int = 256 * 1024 * 1024, max_latency: float = None,
+                      partition_expr: str = None) -> list[FileMarker]:
+        """
+        Inserts from an iterable (e.g. a generator, or a `pyarrow.RecordBatchReader`) of row dicts, Arrow record
+        batches, or tables, without holding the whole input in memory. Partitions are determined like `insert_arrow`.
+
+        Rows are buffered in Arrow, per partition. A partition is written to a file once it has `max_rows` rows, and
+        every buffered partition is written once the buffers reach `max_bytes` (the memory ceiling). The files written
+        during a flush window are appended to the log at once, when the window ends: after `max_latency` seconds
+        (checked as input arrives), and at the end of the input.
+
+        Returns the file markers of every file written.
+        """
+        buffers: Dict[str, list[pa.Table]] = {}
+        buffered_rows: Dict[str, int] = {}
+        buffered_bytes: Dict[str, int] = {}
+        window_schema = Schema()
+        window_file_markers: list[FileMarker] = []
+        file_markers: list[FileMarker] = []
+        window_start = time()
+        pending_rows: list[dict] = []
+
+        def write(parts: list[str]):
+            part_map: Dict[str, pa.Table] = {}
+            for part in parts:
+                part_map[part] = concat_tables(buffers.pop(part))
+                del buffered_rows[part]
+                del buffered_bytes[part]
+            written, schema = self.__write_partitions(part_map)
+            window_file_markers.extend(written)
+            window_schema.accumulate(schema.columns(), schema.types())
+
+        def buffer(table: pa.Table, partitions: pa.Array | pa.ChunkedArray,
+                   columns: Dict[str, Dict[str, bool]] = None):
+            for part, part_table in self.__split_partitions(table, partitions, columns).items():
+                buffers.setdefault(part, []).append(part_table)
+                buffered_rows[part] = buffered_rows.get(part, 0) + part_table.num_rows
+                buffered_bytes[part] = buffered_bytes.get(part, 0) + part_table.nbytes
+            full = list(filter(lambda x: buffered_rows[x] >= max_rows, buffered_rows.keys()))
+            if len(full) > 0:
+                write(full)
+            if sum(buffered_bytes.values()) >= max_bytes:
+                write(list(buffers.keys()))
+
+        def commit():
+            nonlocal window_schema, window_file_markers, window_start
+            write(list(buffers.keys()))
+            if len(window_file_markers) > 0:
+                self.__append_inserted(window_schema, window_file_markers)
+                file_markers.extend(window_file_markers)
+            window_schema = Schema()
+            window_file_markers = []
+            window_start = time()
+
+        with self.__inserting():
+            for item in rows_or_batches:
+                if isinstance(item, dict):
+                    pending_rows.append(item)
+                    if len(pending_rows) >= min(max_rows, STREAM_CHUNK_ROWS):
+                        buffer(*self.__partition_rows(pending_rows))
+                        pending_rows = []
+                else:
+                    buffer(*self.__partition_table(pa.Table.from_batches([item]) if isinstance(item, pa.RecordBatch)
+                                                   else item, partition_expr))
+                if max_latency is not None and time() - window_start >= max_latency:
+                    if len(pending_rows) > 0:
+                        buffer(*self.__partition_rows(pending_rows))
+                        pending_rows = []
+                    commit()
+
+            if len(pending_rows) > 0:
+                buffer(*self.__partition_rows(pending_rows))
+            commit()
+        return file_markers
+
+    def load_files(self, paths: str | list[str], format: LoadFormat = LoadFormat.PARQUET, partition_expr: str = None,
+                   transforms_sql: str = "*") -> list[FileMarker]:
+        """
+        Bulk loads CSV, JSON, or parquet files (local paths, globs, or `s3://` URLs) without going through Python rows.
+        DuckDB reads the files in parallel, applies `transforms_sql` (a select list over the source columns, e.g.
+        `* replace (epoch_ms(ts) as ts)`), and partitions the rows in a single `COPY ... PARTITION_BY` to local files.
+        Each partition is then sorted into a data file and uploaded, and all files are appended to the log at once.
+
+        The partition of each row is the result of `partition_expr`, a DuckDB SQL expression over the transformed
+        columns, or the `_partition` column if there is no expression. The `custom_insert_query` is not applied.
 
-            if part not in part_map:
-                part_map[part] = []
-            part_map[part].append(row)
+        Returns the file markers of every file written.
+        """
+        source = "select {} from {}(?)".format(transforms_sql, format.value)
+        if partition_expr is not None:
+            source = "select *, ({})::VARCHAR as _partition from ({})".format(partition_expr, source)
+        params = [paths if isinstance(paths, list) else [paths]]
+
+        with self.__inserting():
+            with tempfile.TemporaryDirectory() as local_dir, self.duckdb_pool.connection() as ddb:
+                running_schema = Schema()
+                described = ddb.execute("describe {}".format(source), params).fetch_arrow_table()
+                columns = list(map(str, described.column("column_name")))
+                if "_partition" not in columns:
+                    raise ValueError("load_files needs a partition_expr, or a _partition column")
+                described = list(filter(lambda x: x[0] != "_partition" or self.preserve_partition,
+                                        zip(columns, map(str, described.column("column_type")))))
+                running_schema.accumulate(list(map(lambda x: x[0], described)), list(map(lambda x: x[1], described)))
+
+                # Rows are only grouped by partition here, the partitioned write does not keep any order
+                partitioned = os.path.join(local_dir, "partitioned")
+                ddb.execute("copy ({}) to '{}' (format parquet, partition_by (_partition))".format(
+                    source, partitioned), params)
+
+                part_files: Dict[str, list[str]] = {}
+                for directory, _, files in os.walk(partitioned):
+                    if len(files) == 0:
+                        continue
+                    # Partition values are URL encoded (older DuckDB versions write them as is, making nested
+                    # directories)
+                    part = unquote(os.path.relpath(directory, partitioned)[len("_partition="):])
+                    part_files[part] = list(map(lambda x: os.path.join(directory, x), files))
+                check_partitions(list(part_files.keys()))
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+                    futures = []
+                    for part, files in part_files.items():
+                        futures.append(executor.submit(self.__load_part, part, files, running_schema))
+                    file_markers = list(map(lambda x: x.result(), futures))
+
+            if len(file_markers) > 0:
+                self.__append_inserted(running_schema, file_markers)
+
+        return file_markers
 
+    def __load_part(self, part: str, files: list[str], schema: Schema) -> FileMarker:
+        """
+        Sorts the local files of a partition written by `load_files` into a data file, and uploads it
+        """
+        filename = str(uuid4()) + '.parquet'
+        path_parts = ['_data', part, filename]
+        if self.s3c.s3prefix is not None:
+            path_parts = [self.s3c.s3prefix] + path_parts
+        fullpath = '/'.join(path_parts)
+
+        query = "select *{} from read_parquet(?, hive_partitioning=0) order by {}".format(
+            ", ?::VARCHAR as _partition" if self.preserve_partition else "", ','.join(self.sort_order))
+        params = [part, files] if self.preserve_partition else [files]
+        with self.duckdb_pool.connection() as ddb, self.__copy_to_local_parquet(ddb, query, params) as local:
+            file_size = self.__upload_file(local, fullpath)
+            row_count, zone_map = self.__file_zone_map(ddb, local, list(filter(lambda x: x in schema, self.sort_order)))
+        return FileMarker(fullpath, round(time() * 1000), file_size, None, row_count, zone_map)
+
+    def __partition_rows(self, rows: list[dict]) -> tuple[pa.Table, pa.Array | pa.ChunkedArray,
+                                                           Dict[str, Dict[str, bool]]]:
+        """
+        Builds a table from row dicts, and returns it with the partition of each row, and the columns that the rows of
+        each partition have
+        """
+        partitions: list[str] | None = None
+        if self.partition_spec is None or any(map(lambda x: "_partition" in x, rows)):
+            partitions = []
+            for row in rows:
+                part: str
+                if "_partition" in row:
+                    part = row["_partition"]
+                    if not self.preserve_partition:
+                        del row["_partition"]
+                else:
+                    part = self.partition_function(row)
+                partitions.append(part)
+
+        # Build the table from all rows (not just the first) so every key is kept
+        table = pa.Table.from_batches([pa.RecordBatch.from_struct_array(pa.array(rows))]) if len(rows) > 0 \
+            else pa.table({})
+        partition_array = pa.array(partitions, pa.string()) if partitions is not None \
+            else self.partition_spec.partitions(table)
+
+        # The table has the columns of every row, but each partition only gets the columns of its own rows, as if
+        # its rows were inserted on their own
+        columns: Dict[str, Dict[str, bool]] = {}
+        for row, part in zip(rows, partitions if partitions is not None else partition_array.to_pylist()):
+            columns.setdefault(part, {}).update(dict.fromkeys(row, True))
+        return table, partition_array, columns
+
+    def __partition_table(self, _rows: pa.Table, partition_expr: str = None) -> tuple[pa.Table,
+                                                                                     pa.Array | pa.ChunkedArray]:
+        """
+        Returns the table (without the `_partition` column, unless it is preserved) and the partition of each row,
+        see `insert_arrow`
+        """
+        if partition_expr is not None:
+            with self.duckdb_pool.connection() as ddb:
+                ddb.register("_rows", _rows)
+                partitions = ddb.execute("select ({})::VARCHAR as _partition from _rows".format(partition_expr)) \
+                    .fetch_arrow_table().column("_partition")
+                ddb.unregister("_rows")
+            check_partitions(pc.unique(partitions).to_pylist())
+        elif "_partition" in _rows.column_names:
+            partitions = _rows.column("_partition").cast(pa.string())
+            if not self.preserve_partition:
+                _rows = _rows.drop(["_partition"])
+        elif self.partition_spec is not None:
+            partitions = self.partition_spec.partitions(_rows)
+        else:
+            partitions = pa.array(list(map(self.partition_function, _rows.to_pylist())), pa.string())
+        return _rows, partitions
+
+    def __split_partitions(self, table: pa.Table, partitions: pa.Array | pa.ChunkedArray,
+                           columns: Dict[str, Dict[str, bool]] = None) -> Dict[str, pa.Table]:
+        """
+        Splits a table by the partition of each row. If `columns` are provided, each partition only keeps its columns.
+        """
+        # Sort by partition once, so each partition is a zero-copy slice
+        indexes = pc.sort_indices(partitions)
+        table = table.take(indexes)
+        part_map: Dict[str, pa.Table] = {}
+        offset = 0
+        for count in pc.value_counts(partitions.take(indexes)).to_pylist():
+            part_map[count["values"]] = table.slice(offset, count["counts"])
+            offset += count["counts"]
+            if columns is not None and len(columns[count["values"]]) < table.num_columns:
+                part_map[count["values"]] = part_map[count["values"]].select(
+                    list(filter(lambda x: x in columns[count["values"]], table.column_names)))
+        return part_map
+
+    def __write_partitions(self, part_map: Dict[str, pa.Table]) -> tuple[list[FileMarker], Schema]:
+        """
+        Writes a file for each partition (or several, for partitions over the file size limits), returning their file
+        markers and accumulated schema
+        """
         running_schema = Schema()
         file_markers: list[FileMarker] = []
+        parts = self.__split_files(part_map)
+
+        # Partitions of the same table share its schema, so it is only mapped once
+        schemas: Dict[pa.Schema, Schema | None] = {}
+        for _, part_ref in parts:
+            if part_ref.schema not in schemas:
+                schemas[part_ref.schema] = self.__arrow_schema(part_ref.schema)
+
+        if self.insert_executor == InsertExecutor.PROCESS:
+            return self.__write_partitions_in_processes(parts, schemas)
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
             futures = []
-            for part, part_ref in part_map.items():
-                futures.append(executor.submit(self.__insert_part, part, part_ref))
+            for part, part_ref in parts:
+                futures.append(executor.submit(self._insert_part, part, part_ref, schemas[part_ref.schema]))
 
             for futures in concurrent.futures.as_completed(futures):
                 result: tuple[FileMarker, Schema] = futures.result()
@@ -215,12 +701,229 @@ class IceDBv3:
                 # accumulate schema
                 running_schema.accumulate(result[1].columns(), result[1].types())
 
+        return file_markers, running_schema
+
+    def __split_files(self, part_map: Dict[str, pa.Table]) -> list[tuple[str, pa.Table]]:
+        """
+        Splits partitions over `max_rows_per_file` rows or `target_file_bytes` bytes (of Arrow memory) into several
+        files of about the same size. The partition is sorted first, so the files cover consecutive ranges of the sort
+        order and are written in parallel.
+        """
+        parts: list[tuple[str, pa.Table]] = []
+        for part, part_ref in part_map.items():
+            rows_per_file = part_ref.num_rows
+            if self.max_rows_per_file is not None:
+                rows_per_file = min(rows_per_file, self.max_rows_per_file)
+            if self.target_file_bytes is not None and part_ref.nbytes > self.target_file_bytes:
+                rows_per_file = min(rows_per_file, part_ref.num_rows * self.target_file_bytes // part_ref.nbytes)
+            rows_per_file = max(rows_per_file, 1)
+            if part_ref.num_rows <= rows_per_file:
+                parts.append((part, part_ref))
+                continue
+
+            with self.duckdb_pool.connection() as ddb:
+                ddb.register("_rows", part_ref)
+                try:
+                    part_ref = ddb.execute("select * from _rows order by {}".format(
+                        ','.join(self.sort_order))).fetch_arrow_table()
+                finally:
+                    ddb.unregister("_rows")
+            files = -(-part_ref.num_rows // rows_per_file)
+            file_rows = -(-part_ref.num_rows // files)
+            for offset in range(0, part_ref.num_rows, file_rows):
+                parts.append((part, part_ref.slice(offset, file_rows)))
+        return parts
+
+    def __write_partitions_in_processes(self, parts: list[tuple[str, pa.Table]],
+                                        schemas: Dict[pa.Schema, Schema | None]) -> tuple[list[FileMarker], Schema]:
+        """
+        Writes a file for each partition in the insert worker processes, so encoding is not bound by the GIL. Each
+        partition is written to shared memory as an Arrow IPC stream, which the worker reads without copying.
+        """
+        running_schema = Schema()
+        file_markers: list[FileMarker] = []
+        executor = self.__get_process_pool()
+        shared: list[shared_memory.SharedMemory] = []
+        futures = []
+        try:
+            for part, part_ref in parts:
+                shm, size = share_table(part_ref)
+                shared.append(shm)
+                futures.append(executor.submit(_insert_part_in_process, part, shm.name, size,
+                                               schemas[part_ref.schema]))
+
+            for future in concurrent.futures.as_completed(futures):
+                result: tuple[FileMarker, Schema] = future.result()
+                file_markers.append(result[0])
+                running_schema.accumulate(result[1].columns(), result[1].types())
+        finally:
+            # Workers may still be reading if a partition failed
+            concurrent.futures.wait(futures)
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+
+        return file_markers, running_schema
+
+    def __get_process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self.__process_pool_lock:
+            if self.__process_pool is None:
+                # Workers are spawned rather than forked, as forking a process with DuckDB and boto3 threads is unsafe
+                self.__process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.insert_processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_insert_process,
+                    initargs=(self.__process_args(),)
+                )
+            return self.__process_pool
+
+    def __process_args(self) -> dict:
+        """
+        The arguments to create an equivalent IceDBv3 in an insert worker process. Partitions are already known, so
+        the partition function is not needed.
+        """
+        return {
+            "s3_client": {
+                "s3prefix": self.s3c.s3prefix,
+                "s3bucket": self.s3c.s3bucket,
+                "s3region": self.s3_region,
+                "s3endpoint": self.s3_endpoint,
+                "s3accesskey": self.s3_access_key,
+                "s3secretkey": self.s3_secret_key,
+            },
+            "partition_function": None,
+            "sort_order": self.sort_order,
+            "s3_region": self.s3_region,
+            "s3_access_key": self.s3_access_key,
+            "s3_secret_key": self.s3_secret_key,
+            "s3_endpoint": self.s3_endpoint,
+            "path_safe_hostname": self.path_safe_hostname,
+            "s3_use_path": self.s3_use_path,
+            "duckdb_ext_dir": self.duckdb_ext_dir,
+            "custom_insert_query": self.custom_insert_query,
+            "unique_row_key": self.unique_row_key,
+            "row_group_size": self.row_group_size,
+            "compression_codec": self.compression_codec,
+            "max_threads": 1,
+            "cache_log_state": False,
+            "log_version": self.log_version,
+            "parquet_writer": self.parquet_writer,
+            "multipart_chunksize": self.multipart_chunksize,
+            "multipart_max_concurrency": self.multipart_max_concurrency,
+            "bloom_filter_columns": self.bloom_filter_columns,
+            "write_page_index": self.write_page_index,
+        }
+
+    def close(self):
+        """
+        Stops the insert worker processes, if any, waits for pending uploads and stops the transfer manager threads,
+        and closes the DuckDB connection pool
+        """
+        with self.__process_pool_lock:
+            if self.__process_pool is not None:
+                self.__process_pool.shutdown()
+                self.__process_pool = None
+        self.transfer_manager.shutdown()
+        self.duckdb_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __insert_table(self, table: pa.Table, partitions: pa.Array | pa.ChunkedArray,
+                       columns: Dict[str, Dict[str, bool]] = None) -> list[FileMarker]:
+        """
+        Writes a file for each partition of the table, and appends them to the log. See `__split_partitions` for
+        `columns`.
+        """
+        file_markers, running_schema = self.__write_partitions(self.__split_partitions(table, partitions, columns))
+
         # Append to log
-        logio = IceLogIO(self.path_safe_hostname)
-        logio.append(self.s3c, 1, running_schema, file_markers)
+        self.__append_inserted(running_schema, file_markers)
 
         return file_markers
 
+    @contextmanager
+    def __inserting(self):
+        """
+        Counts an insert as in progress from when it starts until its files are appended to the log, as until then it
+        may still join the current group commit
+        """
+        with self.__group_commit_lock:
+            self.__inserts_in_progress += 1
+        try:
+            yield
+        finally:
+            with self.__group_commit_changed:
+                self.__inserts_in_progress -= 1
+                self.__group_commit_changed.notify_all()
+
+    def __append_inserted(self, schema: Schema, file_markers: list[FileMarker]):
+        """
+        Appends inserted files to the log. With `group_commit_ms`, the first insert to arrive waits up to that long
+        for concurrent inserts to join it, then appends all of their files in a single log file. It stops waiting once
+        every insert in progress has joined, so an insert with no concurrent inserts is appended right away.
+        """
+        if self.group_commit_ms is None:
+            logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+            logio.append(self.s3c, self.log_version, schema, file_markers)
+            return
+
+        with self.__group_commit_lock:
+            group = self.__group_commit
+            leader = group is None
+            if leader:
+                group = self.__group_commit = LogAppendGroup()
+            index = len(group.entries)
+            group.entries.append((schema, file_markers))
+            self.__group_commit_changed.notify_all()
+
+        if leader:
+            with self.__group_commit_changed:
+                self.__group_commit_changed.wait_for(lambda: len(group.entries) >= self.__inserts_in_progress,
+                                                     self.group_commit_ms / 1000)
+                self.__group_commit = None
+            self.__commit_group(group)
+        else:
+            group.done.wait()
+
+        if group.errors[index] is not None:
+            raise group.errors[index]
+
+    def __commit_group(self, group: LogAppendGroup):
+        """
+        Appends the files of every insert in the group in a single log file. An insert with a schema that conflicts
+        with the rest of the group fails on its own.
+        """
+        errors: list[Exception | None] = [None] * len(group.entries)
+        try:
+            schema = Schema()
+            file_markers: list[FileMarker] = []
+            for i, (entry_schema, entry_file_markers) in enumerate(group.entries):
+                joined = Schema()
+                joined.accumulate(schema.columns(), schema.types())
+                try:
+                    joined.accumulate(entry_schema.columns(), entry_schema.types())
+                except SchemaConflictException as e:
+                    errors[i] = e
+                    continue
+                schema = joined
+                file_markers += entry_file_markers
+
+            # Groups are appended one at a time, with increasing timestamps so their log files never share a key
+            with self.__group_append_lock:
+                timestamp = max(round(time() * 1000), self.__last_group_append + 1)
+                logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+                logio.append(self.s3c, self.log_version, schema, file_markers, timestamp=timestamp)
+                self.__last_group_append = timestamp
+        except Exception as e:
+            errors = list(map(lambda x: e if x is None else x, errors))
+        finally:
+            group.errors = errors
+            group.done.set()
+
     def merge(self, max_file_size=10_000_000, max_file_count=10, asc=False) -> tuple[
         str | None, FileMarker | None, str | None, list[FileMarker] | None, LogMetadata | None]:
         """
@@ -229,99 +932,157 @@ class IceDBv3:
 
         Returns new_log, new_file_marker, partition, merged_file_markers, meta
         """
-        logio = IceLogIO(self.path_safe_hostname)
-        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_at_max_time(self.s3c, round(time() * 1000))
+        logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_table_at_max_time(self.s3c,
+                                                                                           round(time() * 1000),
+                                                                                           self.log_state)
 
         # Group by partition
-        partitions: Dict[str, list[FileMarker]] = {}
-        for file in cur_files:
-            partition = self.__get_file_partition(file.path)
-            if partition not in partitions:
-                partitions[partition] = []
-            partitions[partition].append(file)
+        partitions = cur_files.group_by_partition()
 
         # sort the dict
         partitions = dict(sorted(partitions.items(), key=lambda item: len(item[1]), reverse=not asc))
         for partition, file_markers in partitions.items():
-            if len(file_markers) <= 1:
-                continue
-            # sort the items in the array by file size, asc
-            sorted_file_markers = sorted(file_markers, key=lambda item: item.fileBytes)
-            # aggregate until we meet the max file count or limit
-            acc_bytes = 0
-            acc_file_markers: list[FileMarker] = []
-            for file_marker in sorted_file_markers:
-                if file_marker.tombstone is not None:
-                    continue
-                acc_bytes += file_marker.fileBytes
-                acc_file_markers.append(file_marker)
-                if acc_bytes >= max_file_size or len(acc_file_markers) > 1 and len(acc_file_markers) >= max_file_count:
-                    # then we merge
-                    break
-            if len(acc_file_markers) > 1:
-                # merge data parts
-                filename = str(uuid4()) + '.parquet'
-                path_parts = ['_data', partition, filename]
-                if self.s3c.s3prefix is not None:
-                    path_parts = [self.s3c.s3prefix] + path_parts
-                fullpath = '/'.join(path_parts)
-
-                q = "COPY ({}) TO '{}' (FORMAT PARQUET, CODEC '{}', ROW_GROUP_SIZE {})".format(
-                    ("select * from source_files" if self.custom_merge_query is None else self.custom_merge_query).replace(
-                        "source_files", "read_parquet(?, hive_partitioning=1)"),
-                    's3://{}/{}'.format(self.s3c.s3bucket, fullpath),
-                    self.compression_codec.value, self.row_group_size
-                )
-
-                ddb = self.get_duckdb()
-                ddb.execute(q, [
-                    list(map(lambda x: f"s3://{self.s3c.s3bucket}/{x.path}", acc_file_markers))
-                ])
-
-                # get the new file size
-                obj = self.s3c.s3.head_object(
-                    Bucket=self.s3c.s3bucket,
-                    Key=fullpath
-                )
-                merged_file_size = obj['ContentLength']
+            acc_file_markers = self.__plan_merge(file_markers, max_file_size, max_file_count)
+            if acc_file_markers is not None:
+                merged_file = self.__merge_files(partition, acc_file_markers, cur_schema)
 
                 # Now we need to get the current state of the files we just merged, and write that plus the new state
                 # We can keep the current schema
-                merged_log_files = list(map(lambda x: x.vir_source_log_file, acc_file_markers))
-                m_schema, m_file_markers, m_tombstones = logio.read_log_forward(self.s3c, merged_log_files)
+                merged_log_files = acc_file_markers.source_log_files()
+                m_schema, m_file_markers, m_tombstones = logio.read_log_forward_table(self.s3c, merged_log_files)
 
                 # create new log file with tombstones
-                acc_file_paths = list(map(lambda x: x.path, acc_file_markers))
                 merged_time = round(time() * 1000)
-                new_file_marker = FileMarker(fullpath, merged_time, merged_file_size)
-
-                updated_markers = list(map(lambda x: FileMarker(
-                    x.path,
-                    x.createdMS,
-                    x.fileBytes,
-                    merged_time if x.path in acc_file_paths else x.tombstone),
-                                           m_file_markers))
+                new_file_marker = FileMarker(merged_file[0], merged_time, merged_file[1], None, merged_file[2],
+                                             merged_file[3])
 
+                updated_markers = m_file_markers.with_tombstone(acc_file_markers.paths(), merged_time)
 
                 new_tombstones = list(map(lambda x: LogTombstone(x, merged_time),
                                           merged_log_files))
 
                 new_log, meta = logio.append(
                     self.s3c,
-                    1,
+                    self.log_version,
                     m_schema,
-                    updated_markers + [
-                        new_file_marker
-                    ],
+                    updated_markers.concat(FileMarkerTableFromList([new_file_marker])),
                     m_tombstones + new_tombstones,
-                    merged=True
+                    merged=True,
+                    carries_forward=True
                 )
 
-                return new_log, new_file_marker, partition, acc_file_markers, meta
+                return new_log, new_file_marker, partition, acc_file_markers.to_list(), meta
 
         # otherwise we did not merge
         return None, None, None, [], None
 
+    def merge_all(self, max_file_size=10_000_000, max_file_count=10, max_partitions: int = None,
+                  max_workers: int = None,
+                  asc=False) -> tuple[str | None, list[FileMarker], list[FileMarker], LogMetadata | None]:
+        """
+        Merges every partition that `merge` would (up to `max_partitions` of them, in the same order), planned from a
+        single read of the log. The merges run concurrently on up to `max_workers` threads (default `max_threads`),
+        and are written to the log in a single merged log file that tombstones all of the merged files.
+
+        Returns new_log, new_file_markers, merged_file_markers, meta. new_log is None if nothing was merged.
+
+        Requires the merge lock if running concurrently.
+        """
+        logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_table_at_max_time(self.s3c,
+                                                                                           round(time() * 1000),
+                                                                                           self.log_state)
+
+        partitions = cur_files.group_by_partition()
+        plans: list[tuple[str, FileMarkerTable]] = []
+        for partition, file_markers in sorted(partitions.items(), key=lambda item: len(item[1]), reverse=not asc):
+            if max_partitions is not None and len(plans) >= max_partitions:
+                break
+            acc_file_markers = self.__plan_merge(file_markers, max_file_size, max_file_count)
+            if acc_file_markers is not None:
+                plans.append((partition, acc_file_markers))
+
+        if len(plans) == 0:
+            return None, [], [], None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or self.max_threads) as executor:
+            merged_files = list(executor.map(lambda x: self.__merge_files(x[0], x[1], cur_schema), plans))
+
+        acc_file_markers = FileMarkerTable(pa.concat_tables(list(map(lambda x: x[1].table, plans)))
+                                           .unify_dictionaries())
+
+        # Carry forward the current state of every log file the merged files came from, like merge does
+        merged_log_files = acc_file_markers.source_log_files()
+        m_schema, m_file_markers, m_tombstones = logio.read_log_forward_table(self.s3c, merged_log_files)
+
+        merged_time = round(time() * 1000)
+        new_file_markers = list(map(lambda x: FileMarker(x[0], merged_time, x[1], None, x[2], x[3]), merged_files))
+        updated_markers = m_file_markers.with_tombstone(acc_file_markers.paths(), merged_time)
+        new_tombstones = list(map(lambda x: LogTombstone(x, merged_time), merged_log_files))
+
+        new_log, meta = logio.append(
+            self.s3c,
+            self.log_version,
+            m_schema,
+            updated_markers.concat(FileMarkerTableFromList(new_file_markers)),
+            m_tombstones + new_tombstones,
+            merged=True,
+            carries_forward=True
+        )
+
+        return new_log, new_file_markers, acc_file_markers.to_list(), meta
+
+    def __plan_merge(self, file_markers: FileMarkerTable, max_file_size: int,
+                     max_file_count: int) -> FileMarkerTable | None:
+        """
+        Picks the smallest alive files of a partition to merge, until the file count or size limit is reached.
+        Returns None if there are not at least 2 files to merge.
+        """
+        if len(file_markers) <= 1:
+            return None
+        # sort the alive files by file size, asc
+        sorted_file_markers = file_markers.alive().sort_by_bytes()
+        # aggregate until we meet the max file count or limit
+        acc_count = min(len(sorted_file_markers), max(max_file_count, 2))
+        acc_bytes = pc.cumulative_sum(sorted_file_markers.table.column("b").combine_chunks())
+        reached_size = pc.index(pc.greater_equal(acc_bytes, max_file_size), True).as_py()
+        if reached_size != -1:
+            acc_count = min(acc_count, reached_size + 1)
+        acc_file_markers = FileMarkerTable(sorted_file_markers.table.slice(0, acc_count))
+        return acc_file_markers if len(acc_file_markers) > 1 else None
+
+    def __merge_files(self, partition: str, acc_file_markers: FileMarkerTable,
+                      cur_schema: Schema) -> tuple[str, int, int, Dict[str, list] | None]:
+        """
+        Merges the files into a new file in the partition. Returns its path, size, row count, and zone map.
+        """
+        # merge data parts
+        filename = str(uuid4()) + '.parquet'
+        path_parts = ['_data', partition, filename]
+        if self.s3c.s3prefix is not None:
+            path_parts = [self.s3c.s3prefix] + path_parts
+        fullpath = '/'.join(path_parts)
+
+        q = ("select * from source_files" if self.custom_merge_query is None else self.custom_merge_query).replace(
+            "source_files", "read_parquet(?, hive_partitioning=1)")
+
+        with self.duckdb_pool.connection() as ddb, self.__copy_to_local_parquet(ddb, q, [
+            list(map(lambda x: f"s3://{self.s3c.s3bucket}/{x}", acc_file_markers.paths().to_pylist()))
+        ]) as local:
+            merged_file_size = self.__upload_file(local, fullpath)
+
+            # The merged file has the union of the rows unless a custom merge query changes them, otherwise
+            # read the statistics from the new file
+            columns = list(filter(lambda x: x in cur_schema, self.sort_order))
+            row_count, zone_map = combine_zone_maps(acc_file_markers.to_list())
+            if self.custom_merge_query is not None:
+                row_count, zone_map = self.__get_zone_map(ddb, "select * from read_parquet(?)", columns, [local])
+            elif zone_map is None:
+                row_count, zone_map = self.__file_zone_map(ddb, local, columns)
+
+        return fullpath, merged_file_size, row_count, zone_map
+
     def tombstone_cleanup(self, min_age_ms: int) -> tuple[list[str], list[str], list[str]]:
         """
         Removes parquet files that are no longer active, and are older than some age. Returns the number of files deleted.
@@ -331,7 +1092,7 @@ class IceDBv3:
         Returns the list of log files that were cleaned, log files that were deleted, and data files that
         were deleted
         """
-        logio = IceLogIO(self.path_safe_hostname)
+        logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
         cleaned_log_files: list[str] = []
         deleted_log_files: list[str] = []
         deleted_data_files: list[str] = []
@@ -344,39 +1105,56 @@ class IceDBv3:
 
         current_log_files = logio.get_current_log_files(self.s3c)
         # We only need to get merge files
-        merge_log_files = list(filter(lambda x: get_log_file_info(x['Key'])[1], current_log_files))
-        for file in merge_log_files:
-            obj = self.s3c.s3.get_object(
-                Bucket=self.s3c.s3bucket,
-                Key=file['Key']
-            )
-            jsonl = str(obj['Body'].read(), encoding="utf-8").split("\n")
-            meta_json = json.loads(jsonl[0])
-            meta = LogMetadataFromJSON(meta_json)
-
-            # Log tombstones
-            if meta.tombstoneLineIndex is not None:
-                for i in range(meta.tombstoneLineIndex, meta.fileLineIndex):
-                    tmb = LogTombstoneFromJSON(dict(json.loads(jsonl[i])))
+        merge_log_files = list(map(lambda x: x['Key'],
+                                   filter(lambda x: get_log_file_info(x['Key'])[1], current_log_files)))
+        if self.log_read_engine == LogReadEngine.ARROW:
+            headers = list(zip(merge_log_files, logio.read_log_headers(self.s3c, merge_log_files)))
+            for _, (meta, schema_json, log_tombstones, _, _) in headers:
+                # Log tombstones
+                for tmb in log_tombstones:
                     if tmb.createdMS <= now - min_age_ms:
                         log_files_to_delete[tmb.path] = True
 
-            # File markers
-            for i in range(meta.fileLineIndex, len(jsonl)):
-                fm_json = dict(json.loads(jsonl[i]))
-                fm = FileMarkerFromJSON(fm_json)
-                if fm.createdMS <= now - min_age_ms and fm.tombstone is not None:
-                    data_files_to_delete[fm.path] = True
-                    if fm.path in data_files_to_keep:
-                        del data_files_to_keep[fm.path]
-                else:
-                    data_files_to_keep[fm.path] = fm
+                # Accumulate schema
+                schema.accumulate(list(schema_json.keys()), list(schema_json.values()))
+
+            # File markers, a path is kept unless the last marker for it is an expired tombstone
+            markers = decode_file_markers_arrow(headers)
+            expired = lambda x: pc.and_(pc.less_equal(x.column("t"), now - min_age_ms), pc.is_valid(x.column("tmb")))
+            data_files_to_delete = dict.fromkeys(pc.unique(markers.filter(expired(markers)).column("p")).to_pylist(),
+                                                 True)
+            last_markers = fold_file_markers_arrow(markers)
+            data_files_to_keep = dict(map(lambda x: (x.path, x), file_markers_from_arrow(
+                last_markers.filter(pc.invert(expired(last_markers))))))
+        else:
+            for meta, schema_json, log_tombstones, file_markers in logio.read_log_files(self.s3c, merge_log_files):
+                # Log tombstones
+                for tmb in log_tombstones:
+                    if tmb.createdMS <= now - min_age_ms:
+                        log_files_to_delete[tmb.path] = True
+
+                # File markers
+                for fm in file_markers:
+                    if fm.createdMS <= now - min_age_ms and fm.tombstone is not None:
+                        data_files_to_delete[fm.path] = True
+                        if fm.path in data_files_to_keep:
+                            del data_files_to_keep[fm.path]
+                    else:
+                        data_files_to_keep[fm.path] = fm
 
-            # Accumulate schema
-            schema_json = dict(json.loads(jsonl[meta.schemaLineIndex]))
-            schema.accumulate(list(schema_json.keys()), list(schema_json.values()))
+                # Accumulate schema
+                schema.accumulate(list(schema_json.keys()), list(schema_json.values()))
 
-            cleaned_log_files.append(file['Key'])
+        cleaned_log_files += merge_log_files
+
+        # Delete checkpoints first, they may still list the data files we are about to delete as alive
+        for file in current_log_files:
+            if is_checkpoint_log_file(file['Key']):
+                self.s3c.s3.delete_object(
+                    Bucket=self.s3c.s3bucket,
+                    Key=file['Key']
+                )
+                deleted_log_files.append(file['Key'])
 
         # Delete log tombstones
         for log_path in log_files_to_delete.keys():
@@ -399,7 +1177,7 @@ class IceDBv3:
         # New log file
         new_log, _ = logio.append(
             self.s3c,
-            1,
+            self.log_version,
             schema,
             list(data_files_to_keep.values()),
             None,
@@ -416,42 +1194,107 @@ class IceDBv3:
             )
         print(f"Keeping {len(data_files_to_keep)} files")
 
+        # The cached state may reference log files we just deleted
+        if self.log_state is not None:
+            with self.log_state.lock:
+                self.log_state.reset()
+
         return cleaned_log_files, deleted_log_files, deleted_data_files
 
-    def remove_partitions(self, removal_func: PartitionRemovalFunctionType, max_files=1000) -> tuple[str | None,
-    LogMetadata | None, int]:
+    def checkpoint(self) -> tuple[str | None, LogMetadata | None]:
+        """
+        Writes a checkpoint of the current state of the log, so that reading the state only requires reading the
+        checkpoint and the log files written after it, rather than every log file since the last tombstone cleanup.
+        Run this periodically, for example after merging.
+
+        Tombstone cleanup deletes all checkpoints, so this requires the tombstone cleanup lock if running concurrently.
+
+        Returns the checkpoint path and metadata, or None if there are no log files.
+        """
+        logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+        return logio.write_checkpoint(self.s3c, round(time() * 1000), self.log_state, self.log_version)
+
+    def get_files(self, partition_filter: PartitionFilterFunctionType = None, predicates: list[PredicateType] = None,
+                  timestamp: int = None) -> list[str]:
+        """
+        Returns the paths of alive data files that may contain rows matching the filters, only reading the log. Pass
+        the result to a query engine (e.g. DuckDB `read_parquet` or ClickHouse `s3`) instead of globbing `_data/`.
+
+        `partition_filter` is given each partition, and returns whether its files should be included.
+
+        `predicates` are (column, operator, value) tuples that must all match, for example `("ts", "between", (a, b))`
+        for `ts BETWEEN a AND b`, or `("user_id", "=", "x")`. Columns that are hive style partition keys
+        (`key=value` directories), or the source column of a partition spec field, are checked against the partition
+        value, and sort order columns against the zone map of each file. Files without statistics for a column are
+        always included.
+
+        `timestamp` optionally reads the state of the log at a point in time, defaulting to now.
+        """
+        logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+        _, cur_files, _, _ = logio.read_table_at_max_time(self.s3c, timestamp if timestamp is not None else
+                                                          round(time() * 1000), self.log_state)
+        predicates = predicates if predicates is not None else []
+
+        files: list[str] = []
+        for partition, file_markers in cur_files.alive().group_by_partition().items():
+            if partition_filter is not None and not partition_filter(partition):
+                continue
+
+            if not partition_matches(partition, predicates, self.partition_spec):
+                continue
+
+            partition_values = hive_partition_values(partition)
+            column_predicates = list(filter(lambda x: x[0] not in partition_values, predicates))
+            for file_marker in file_markers:
+                if file_marker.zoneMap is not None and not all(map(
+                        lambda x: x[0] not in file_marker.zoneMap or zone_map_may_match(file_marker.zoneMap[x[0]],
+                                                                                        x[1], x[2]),
+                        column_predicates)):
+                    continue
+                files.append(file_marker.path)
+
+        return files
+
+    def remove_partitions(self, removal_func: PartitionRemovalFunctionType = None, max_files=1000,
+                          predicates: list[PredicateType] = None) -> tuple[str | None, LogMetadata | None, int]:
         """
         remove_partitions is used to drop entire partitions for functionality such as TTL or user data deletion.
         The `removal_func` is provided a list of unique partitions, and must return the list of
         partitions that should be dropped.
         Those data parts will be marked with tombstones in a log-only merge.
 
+        Alternatively (or additionally), `predicates` drops the partitions where every row matches all predicates,
+        for example `("ts", "<", datetime(2023, 1, 1))` with a `day(ts)` partition spec field. Partitions that only
+        partly match are kept.
+
         Returns the new log file path, the log file metadata, and the number of data files deleted
 
         Requires the merge lock if running concurrently.
         """
 
+        if removal_func is None and predicates is None:
+            raise ValueError("remove_partitions needs a removal_func or predicates")
+
         remove_time = round(time() * 1000)
 
-        logio = IceLogIO(self.path_safe_hostname)
-        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_at_max_time(self.s3c, remove_time)
+        logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_table_at_max_time(self.s3c, remove_time,
+                                                                                           self.log_state)
 
         # Group by partition (on alive files
-        alive_files = list(filter(lambda x: x.tombstone is None, cur_files))
-        partitions: Dict[str, list[FileMarker]] = {}
-        for file in alive_files:
-            partition = self.__get_file_partition(file.path)
-            if partition not in partitions:
-                partitions[partition] = []
-            partitions[partition].append(file)
-
-        partitions_to_remove = removal_func(list(partitions.keys()))
+        partitions = cur_files.alive().group_by_partition()
+
+        partitions_to_remove = list(partitions.keys())
+        if predicates is not None:
+            partitions_to_remove = list(filter(lambda x: partition_matches(x, predicates, self.partition_spec, True),
+                                               partitions_to_remove))
+        if removal_func is not None:
+            partitions_to_remove = removal_func(partitions_to_remove)
         if len(partitions_to_remove) == 0:
             # nothing to do
             return None, None, 0
 
-        modified_log_files = {}
-        updated_file_markers: list[FileMarker] = []
+        removed_partitions: list[str] = []
         deleted_parts = 0
 
         # Get all the file markers and log files to tombstone
@@ -463,25 +1306,31 @@ class IceDBv3:
             if len(file_markers) == 0:
                 continue
 
-            for file_marker in file_markers:
-                deleted_parts += 1
-                file_marker.tombstone = remove_time # add the tombstone
-                updated_file_markers.append(file_marker)
-                modified_log_files[file_marker.vir_source_log_file] = True
+            deleted_parts += len(file_markers)
+            removed_partitions.append(partition)
 
             if deleted_parts >= max_files:
                 # We've done enough, let's break
                 break
 
+        removed_files = cur_files.alive().in_partitions(removed_partitions)
+        modified_log_files = removed_files.source_log_files()
+
+        # Carry forward every marker from the log files we tombstone, not just the removed ones, otherwise markers in
+        # other partitions would be lost once those log files are cleaned up
+        updated_file_markers = cur_files.from_source_log_files(modified_log_files).with_tombstone(removed_files.paths(),
+                                                                                                 remove_time)
+
         # Log-only merge
-        log_tombstones = list(map(lambda x: LogTombstone(x, remove_time), list(modified_log_files)))
+        log_tombstones = list(map(lambda x: LogTombstone(x, remove_time), modified_log_files))
         new_log, meta = logio.append(
             self.s3c,
-            1,
+            self.log_version,
             cur_schema,
             updated_file_markers,
-            log_tombstones,
-            merged=True
+            cur_tombstones + log_tombstones,
+            merged=True,
+            carries_forward=True
         )
 
         return new_log, meta, deleted_parts
@@ -504,21 +1353,20 @@ class IceDBv3:
 
         Returns the new log file path, metadata, and the list of data files that were rewritten.
 
+        If the log state is not cached, only the target partition is read from log files that have a partition index.
+
         Requires the merge lock if running concurrently.
         """
 
         run_time = round(time() * 1000)
 
-        logio = IceLogIO(self.path_safe_hostname)
-        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_at_max_time(self.s3c, run_time)
+        logio = IceLogIO(self.path_safe_hostname, engine=self.log_read_engine)
+        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_table_at_max_time(
+            self.s3c, run_time, self.log_state if self.log_state is not None and self.log_state.last_key is not None
+            else None, [target_partition])
 
         # Get alive files matching partition
-        alive_files = list(filter(lambda x: x.tombstone is None, cur_files))
-        rewrite_targets: list[FileMarker] = []
-        for file in alive_files:
-            partition = self.__get_file_partition(file.path)
-            if target_partition == partition:
-                rewrite_targets.append(file)
+        rewrite_targets = cur_files.alive().in_partitions([target_partition])
 
         if len(rewrite_targets) == 0:
             return None, None, []
@@ -533,43 +1381,82 @@ class IceDBv3:
             fullpath = '/'.join(path_parts)
 
             # Copy the files through the query
-            ddb = self.get_duckdb()
-            ddb.execute("""
-                        copy ({}) to 's3://{}/{}' (format parquet, codec '{}', row_group_size {})
-                        """.format(
-                filter_query.replace("_rows", "read_parquet(?)"),
-                self.s3c.s3bucket,
-                fullpath,
-                self.compression_codec.value,
-                self.row_group_size
-            ), [f"s3://{self.s3c.s3bucket}/{old_file.path}"])
-            write_time = round(time() * 1000)
-
-            # get file metadata
-            obj = self.s3c.s3.head_object(
-                Bucket=self.s3c.s3bucket,
-                Key=fullpath
-            )
-            new_files.append(FileMarker(fullpath, write_time, obj['ContentLength']))
+            with self.duckdb_pool.connection() as ddb, self.__copy_to_local_parquet(
+                    ddb, filter_query.replace("_rows", "read_parquet(?)"),
+                    [f"s3://{self.s3c.s3bucket}/{old_file.path}"]) as local:
+                file_size = self.__upload_file(local, fullpath)
+                write_time = round(time() * 1000)
+                row_count, zone_map = self.__file_zone_map(ddb, local,
+                                                           list(filter(lambda x: x in cur_schema, self.sort_order)))
 
-        rewritten_paths = list(map(lambda x: x.path, rewrite_targets))
-        updated_markers = list(map(lambda x: FileMarker(
-            x.path,
-            x.createdMS,
-            x.fileBytes,
-            run_time if x.path in rewritten_paths else x.tombstone),
-                                   cur_files))
+            new_files.append(FileMarker(fullpath, write_time, file_size, None, row_count, zone_map))
 
-        new_tombstones = list(map(lambda x: LogTombstone(x, run_time),
-                                  list(map(lambda x: x.vir_source_log_file, rewrite_targets))))
+        # Carry forward the state of the log files being tombstoned, like merges do
+        rewritten_log_files = rewrite_targets.source_log_files()
+        m_schema, m_file_markers, m_tombstones = logio.read_log_forward_table(self.s3c, rewritten_log_files)
+
+        updated_markers = m_file_markers.with_tombstone(rewrite_targets.paths(), run_time)
+
+        new_tombstones = list(map(lambda x: LogTombstone(x, run_time), rewritten_log_files))
 
         new_log, meta = logio.append(
             self.s3c,
-            1,
+            self.log_version,
             cur_schema,
-            updated_markers + new_files,
-            cur_tombstones + new_tombstones,
-            merged=True
+            updated_markers.concat(FileMarkerTableFromList(new_files)),
+            m_tombstones + new_tombstones,
+            merged=True,
+            carries_forward=True
         )
 
-        return new_log, meta, list(map(lambda x: x.path, rewrite_targets))
\ No newline at end of file
+        return new_log, meta, rewrite_targets.paths().to_pylist()
+
+
+def share_table(table: pa.Table) -> tuple[shared_memory.SharedMemory, int]:
+    """
+    Writes a table to a new block of shared memory as an Arrow IPC stream, returning the block and the stream size.
+    The caller must close and unlink the block.
+    """
+    sizer = pa.MockOutputStream()
+    with pa.ipc.new_stream(sizer, table.schema) as writer:
+        writer.write_table(table)
+    size = sizer.size()
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        with pa.ipc.new_stream(pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf)), table.schema) as writer:
+            writer.write_table(table)
+    except Exception as e:
+        shm.close()
+        shm.unlink()
+        raise e
+    return shm, size
+
+
+# The IceDBv3 of an insert worker process, see `InsertExecutor.PROCESS`
+_process_icedb: IceDBv3 | None = None
+
+
+def _init_insert_process(args: dict):
+    global _process_icedb
+    _process_icedb = IceDBv3(**{**args, "s3_client": S3Client(**args["s3_client"])})
+    # Workers only encode rows that are already in memory to local files, so DuckDB needs no httpfs or S3 settings
+    _process_icedb.duckdb_pool = DuckDBPool(lambda: duckdb.connect(":memory:"), 1)
+
+
+def _read_shared_table(shm: shared_memory.SharedMemory, size: int) -> pa.Table:
+    return pa.ipc.open_stream(pa.py_buffer(shm.buf[:size])).read_all()
+
+
+def _insert_part_in_process(part: str, shm_name: str, size: int,
+                            schema: Schema | None) -> tuple[FileMarker, Schema]:
+    """
+    Writes a partition from shared memory in an insert worker process, returning its file marker and schema
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return _process_icedb._insert_part(part, _read_shared_table(shm, size), schema)
+    except Exception as e:
+        # The frames of the traceback reference the table, which must be released before the shared memory is closed
+        raise e.with_traceback(None)
+    finally:
+        shm.close()
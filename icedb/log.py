@@ -3,6 +3,17 @@ import boto3
 import botocore
 from typing import Dict
 from time import time
+import concurrent.futures
+import threading
+import io
+from enum import Enum
+from urllib.parse import unquote
+from decimal import Decimal
+import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json
+import pyarrow.parquet as pq
 
 
 class SchemaConflictException(Exception):
@@ -109,22 +120,30 @@ class Schema:
 
 
 class FileMarker:
+    __slots__ = ("path", "createdMS", "fileBytes", "tombstone", "rowCount", "zoneMap", "vir_source_log_file")
+
     path: str
     createdMS: int
     fileBytes: int
     tombstone: int | None
+    rowCount: int | None
+    # Statistics of the sort order columns, {column: [min, max, null count]} (see `zone_map_stats`)
+    zoneMap: Dict[str, list] | None
 
     # Only used for reading state, not included in serialization
     vir_source_log_file: str | None
 
-    def __init__(self, path: str, createdMS: int, fileBytes: int, tombstone: int = None):
+    def __init__(self, path: str, createdMS: int, fileBytes: int, tombstone: int = None, rowCount: int = None,
+                 zoneMap: Dict[str, list] = None):
         self.path = path
         self.createdMS = createdMS
         self.fileBytes = fileBytes
         self.tombstone = tombstone
+        self.rowCount = rowCount
+        self.zoneMap = zoneMap
         self.vir_source_log_file = None
 
-    def json(self) -> str:
+    def toDict(self) -> dict:
         d = {
             "p": self.path,
             "b": self.fileBytes,
@@ -134,7 +153,16 @@ class FileMarker:
         if self.tombstone is not None:
             d["tmb"] = self.tombstone
 
-        return json.dumps(d)
+        if self.rowCount is not None:
+            d["r"] = self.rowCount
+
+        if self.zoneMap is not None:
+            d["z"] = self.zoneMap
+
+        return d
+
+    def json(self) -> str:
+        return json.dumps(self.toDict())
 
     def __str__(self):
         if self.vir_source_log_file is not None:
@@ -154,9 +182,316 @@ class FileMarker:
 
 def FileMarkerFromJSON(jsonl: dict):
     fm = FileMarker(jsonl["p"], int(jsonl["t"]), int(jsonl["b"]),
-                    jsonl["tmb"] if "tmb" in jsonl else None)
+                    jsonl["tmb"] if "tmb" in jsonl else None,
+                    jsonl["r"] if "r" in jsonl else None,
+                    jsonl["z"] if "z" in jsonl else None)
     return fm
 
+
+def zone_map_value(value):
+    """
+    Converts a predicate value to one that can be compared with string statistics (or partition values), keeping JSON
+    native types and converting anything else (dates, timestamps, decimals, ...) to its ISO or string representation
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+# Zone map values that are not JSON numbers, strings, or booleans are stored as strings, with a type tag to decode them
+# for comparisons: {tag: (whether a value has the type, decode)}. Order matters, a datetime is also a date.
+ZONE_MAP_TYPES: Dict[str, tuple] = {
+    "decimal": (lambda x: isinstance(x, Decimal), Decimal),
+    "timestamptz": (lambda x: isinstance(x, datetime.datetime) and x.tzinfo is not None,
+                    datetime.datetime.fromisoformat),
+    "timestamp": (lambda x: isinstance(x, datetime.datetime), datetime.datetime.fromisoformat),
+    "date": (lambda x: isinstance(x, datetime.date), datetime.date.fromisoformat),
+    "time": (lambda x: isinstance(x, datetime.time), datetime.time.fromisoformat),
+}
+
+
+def zone_map_type(value) -> str | None:
+    """
+    Returns the type tag of a zone map value, "" for JSON native types, or None if the type is not supported
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return ""
+    for tag, (is_type, _) in ZONE_MAP_TYPES.items():
+        if is_type(value):
+            return tag
+    return None
+
+
+def zone_map_stats(minimum, maximum, null_count: int) -> list | None:
+    """
+    Returns the zone map of a column, `[min, max, null count]`. Values that are not JSON numbers, strings, or booleans
+    are stored as strings, followed by a fourth type tag (e.g. `["9.50", "10.50", 0, "decimal"]`), so they are compared
+    as their original type. Naive and timezone aware timestamps have different tags, as they cannot be compared.
+
+    Returns None if the values have an unsupported (e.g. binary) or mismatched type, the column is then left out of
+    the zone map.
+    """
+    tags = list(map(zone_map_type, filter(lambda x: x is not None, [minimum, maximum])))
+    if None in tags or len(set(tags)) > 1:
+        return None
+    if len(tags) == 0 or tags[0] == "":
+        return [minimum, maximum, null_count]
+    encode = lambda x: x.isoformat() if hasattr(x, "isoformat") else str(x)
+    return [encode(minimum) if minimum is not None else None, encode(maximum) if maximum is not None else None,
+            null_count, tags[0]]
+
+
+def decode_zone_map_value(stats: list, value):
+    """
+    Decodes a string value in the type of the zone map `stats`, other values are returned as is
+    """
+    if len(stats) < 4 or not isinstance(value, str):
+        return value
+    return ZONE_MAP_TYPES[stats[3]][1](value)
+
+
+def combine_zone_maps(file_markers: list[FileMarker]) -> tuple[int | None, Dict[str, list] | None]:
+    """
+    Combines the row counts and zone maps of files whose rows were merged into a single file. Returns None for
+    either if any file is missing it. Columns whose statistics have different types in different files are left out.
+    """
+    if any(map(lambda x: x.rowCount is None, file_markers)):
+        return None, None
+    row_count = sum(map(lambda x: x.rowCount, file_markers))
+    if any(map(lambda x: x.zoneMap is None, file_markers)):
+        return row_count, None
+
+    zone_map: Dict[str, list] = {}
+    for column in file_markers[0].zoneMap.keys():
+        stats = list(map(lambda x: x.zoneMap.get(column), file_markers))
+        if any(map(lambda x: x is None, stats)):
+            continue
+        mins = list(filter(lambda x: x is not None, map(lambda x: decode_zone_map_value(x, x[0]), stats)))
+        maxes = list(filter(lambda x: x is not None, map(lambda x: decode_zone_map_value(x, x[1]), stats)))
+        try:
+            combined = zone_map_stats(min(mins) if len(mins) > 0 else None, max(maxes) if len(maxes) > 0 else None,
+                                      sum(map(lambda x: x[2], stats)))
+        except TypeError:
+            continue
+        if combined is not None:
+            zone_map[column] = combined
+    return row_count, zone_map
+
+
+def arrow_zone_map(table: pa.Table, columns: list[str]) -> tuple[int, Dict[str, list] | None]:
+    """
+    Returns the row count of a table, and the min, max, and null count of the given columns, computed in Arrow, see
+    `zone_map_stats`. The zone map is None if the type of a column does not support min and max.
+    """
+    zone_map: Dict[str, list] = {}
+    try:
+        for column in columns:
+            min_max = pc.min_max(table.column(column))
+            stats = zone_map_stats(min_max["min"].as_py(), min_max["max"].as_py(), table.column(column).null_count)
+            if stats is not None:
+                zone_map[column] = stats
+    except pa.ArrowNotImplementedError:
+        return table.num_rows, None
+    return table.num_rows, zone_map
+
+
+def parquet_zone_map(metadata: pq.FileMetaData, columns: list[str]) -> tuple[int, Dict[str, list] | None]:
+    """
+    Returns the row count of a parquet file, and the min, max, and null count of the given columns, combined from
+    the statistics of each row group in the footer. Long strings may have truncated statistics, which still bound
+    the values. The zone map is None if a row group is missing the statistics of a column.
+    """
+    indexes: Dict[str, int] = dict(map(lambda i: (metadata.schema.column(i).path, i), range(metadata.num_columns)))
+    zone_map: Dict[str, list] = {}
+    for column in columns:
+        if column not in indexes:
+            return metadata.num_rows, None
+        mins, maxes, null_count = [], [], 0
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            stats = row_group.column(indexes[column]).statistics
+            if stats is None or not stats.has_null_count:
+                return metadata.num_rows, None
+            null_count += stats.null_count
+            if stats.has_min_max:
+                mins.append(stats.min)
+                maxes.append(stats.max)
+            elif stats.null_count < row_group.num_rows:
+                return metadata.num_rows, None
+        stats = zone_map_stats(min(mins) if len(mins) > 0 else None, max(maxes) if len(maxes) > 0 else None,
+                               null_count)
+        if stats is not None:
+            zone_map[column] = stats
+    return metadata.num_rows, zone_map
+
+
+def zone_map_may_match(stats: list, op: str, value) -> bool:
+    """
+    Whether a column with the zone map `stats` ([min, max, null count]) may have rows matching `column op value`.
+
+    Supported operators are `=`, `!=`, `<`, `<=`, `>`, `>=`, `between` (value is a (low, high) pair), and `in` (value
+    is a list). Like SQL, nulls never match. If the values cannot be compared, the file may match.
+
+    Typed statistics (see `zone_map_stats`) are compared as their type, string predicate values are parsed as that
+    type (e.g. an ISO timestamp). Predicate values compared with string statistics are converted with `zone_map_value`.
+    """
+    if stats[0] is None or stats[1] is None:
+        # Only nulls (or no rows)
+        return False
+    values = list(value) if op in ("between", "in") else [value]
+    try:
+        minimum, maximum = decode_zone_map_value(stats, stats[0]), decode_zone_map_value(stats, stats[1])
+        if len(stats) > 3:
+            values = list(map(lambda x: decode_zone_map_value(stats, x), values))
+        elif isinstance(minimum, str):
+            values = list(map(zone_map_value, values))
+    except (ValueError, ArithmeticError):
+        return True
+    try:
+        if op == "=":
+            return minimum <= values[0] <= maximum
+        if op == "!=":
+            return not (minimum == maximum == values[0])
+        if op == "<":
+            return minimum < values[0]
+        if op == "<=":
+            return minimum <= values[0]
+        if op == ">":
+            return maximum > values[0]
+        if op == ">=":
+            return maximum >= values[0]
+        if op == "between":
+            return maximum >= values[0] and minimum <= values[1]
+        if op == "in":
+            return any(map(lambda x: minimum <= x <= maximum, values))
+    except TypeError:
+        return True
+    raise ValueError(f"unknown predicate operator '{op}'")
+
+
+def hive_partition_values(partition: str) -> Dict[str, str]:
+    """
+    Parses the values of a hive style partition, e.g. `{"u": "a", "d": "2023-01-01"}` for `u=a/d=2023-01-01`.
+    Directories that are not `key=value` are ignored. Values are URL decoded, like DuckDB does.
+    """
+    values: Dict[str, str] = {}
+    for part in partition.split("/"):
+        key, sep, value = part.partition("=")
+        if sep != "":
+            values[key] = unquote(value)
+    return values
+
+
+class FileMarkerTable:
+    """
+    A columnar collection of file markers, backed by an Arrow table with the columns `p` (path), `b` (bytes), `t`
+    (created ms), `tmb` (tombstone ms, nullable), `r` (row count, nullable), `z` (JSON zone map, nullable), and `s`
+    (source log file, dictionary encoded so each log file is only stored once). Paths live in Arrow buffers rather than
+    as Python objects.
+
+    Iterating yields FileMarkers, which are only created for the rows being iterated.
+    """
+    table: pa.Table
+
+    def __init__(self, table: pa.Table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __iter__(self):
+        for batch in self.table.to_batches():
+            for fm in file_markers_from_arrow(pa.Table.from_batches([batch])):
+                yield fm
+
+    def to_list(self) -> list[FileMarker]:
+        return file_markers_from_arrow(self.table)
+
+    def paths(self) -> pa.ChunkedArray:
+        return self.table.column("p")
+
+    def source_log_files(self) -> list[str]:
+        """
+        The unique log files that the file markers were read from
+        """
+        return pc.unique(self.table.column("s").cast(pa.string())).to_pylist()
+
+    def partitions(self) -> pa.ChunkedArray:
+        """
+        The partition of every file marker, see `get_file_partition`
+        """
+        return pc.replace_substring_regex(self.table.column("p"), pattern=r"^(?:.*?_data/)?(?:(.*)/)?[^/]*$",
+                                          replacement=r"\1")
+
+    def filter(self, mask) -> 'FileMarkerTable':
+        return FileMarkerTable(self.table.filter(mask))
+
+    def alive(self) -> 'FileMarkerTable':
+        return self.filter(pc.is_null(self.table.column("tmb")))
+
+    def in_partitions(self, partitions: list[str]) -> 'FileMarkerTable':
+        return self.filter(pc.is_in(self.partitions(), value_set=pa.array(partitions, pa.string())))
+
+    def from_source_log_files(self, log_files: list[str]) -> 'FileMarkerTable':
+        return self.filter(pc.is_in(self.table.column("s").cast(pa.string()), value_set=pa.array(log_files,
+                                                                                                  pa.string())))
+
+    def sort_by_bytes(self) -> 'FileMarkerTable':
+        return FileMarkerTable(self.table.sort_by([("b", "ascending")]))
+
+    def group_by_partition(self) -> Dict[str, 'FileMarkerTable']:
+        """
+        Groups the file markers by partition (in partition order), each group being a zero-copy slice
+        """
+        if self.table.num_rows == 0:
+            return {}
+        partitions = self.partitions()
+        indexes = pc.sort_indices(partitions)
+        table = self.table.take(indexes)
+        # The partitions are sorted, so value counts are the lengths of each run in order
+        counts = pc.value_counts(partitions.take(indexes)).to_pylist()
+        groups: Dict[str, FileMarkerTable] = {}
+        offset = 0
+        for count in counts:
+            groups[count["values"]] = FileMarkerTable(table.slice(offset, count["counts"]))
+            offset += count["counts"]
+        return groups
+
+    def with_tombstone(self, paths: list[str] | pa.ChunkedArray, tombstone: int) -> 'FileMarkerTable':
+        """
+        Returns a copy with a tombstone set on the file markers with the given paths
+        """
+        value_set = paths.combine_chunks() if isinstance(paths, pa.ChunkedArray) else pa.array(paths, pa.string())
+        table = self.table.set_column(self.table.schema.get_field_index("tmb"), "tmb",
+                                      pc.if_else(pc.is_in(self.table.column("p"), value_set=value_set),
+                                                 pa.scalar(tombstone, pa.int64()),
+                                                 self.table.column("tmb")))
+        return FileMarkerTable(table)
+
+    def concat(self, other: 'FileMarkerTable') -> 'FileMarkerTable':
+        return FileMarkerTable(pa.concat_tables([self.table, other.table]).unify_dictionaries())
+
+
+def FileMarkerTableFromList(file_markers: list[FileMarker]) -> FileMarkerTable:
+    sources: Dict[str, int] = {}
+    for fm in file_markers:
+        if fm.vir_source_log_file is not None and fm.vir_source_log_file not in sources:
+            sources[fm.vir_source_log_file] = len(sources)
+    return FileMarkerTable(pa.table({
+        "p": pa.array(list(map(lambda x: x.path, file_markers)), pa.string()),
+        "b": pa.array(list(map(lambda x: x.fileBytes, file_markers)), pa.int64()),
+        "t": pa.array(list(map(lambda x: x.createdMS, file_markers)), pa.int64()),
+        "tmb": pa.array(list(map(lambda x: x.tombstone, file_markers)), pa.int64()),
+        "r": pa.array(list(map(lambda x: x.rowCount, file_markers)), pa.int64()),
+        "z": pa.array(list(map(lambda x: json.dumps(x.zoneMap) if x.zoneMap is not None else None, file_markers)),
+                      pa.string()),
+        "s": pa.DictionaryArray.from_arrays(pa.array(list(map(lambda x: sources.get(x.vir_source_log_file),
+                                                              file_markers)), pa.int32()),
+                                            pa.array(list(sources.keys()), pa.string()))
+    }))
+
 class LogTombstone:
     path: str
     createdMS: int
@@ -188,14 +523,31 @@ class LogMetadata:
     fileLineIndex: int
     tombstoneLineIndex: int | None
     timestamp: int
+    # Only used by checkpoints
+    logLineIndex: int | None
+    # Byte ranges of the file markers of each partition, relative to the start of the header (version 1 only). Stored
+    # on its own line after the metadata line, which is `partitionIndexLength` bytes long.
+    partitionIndex: Dict[str, list[int]] | None
+    partitionIndexLength: int | None
+    fileByteOffset: int | None
+    # Whether the log file carries forward the schema, log tombstones, and file markers of every log file it
+    # tombstones, so those log files never need to be read. Merged log files written before this was tracked (e.g.
+    # by older versions of `remove_partitions`) did not always do so.
+    carriesForward: bool
 
     def __init__(self, version: int, schemaLineIndex: int, fileLineIndex: int, tombstoneLineIndex: int = None,
-                 timestamp: int = None):
+                 timestamp: int = None, logLineIndex: int = None, partitionIndex: Dict[str, list[int]] = None,
+                 fileByteOffset: int = None, partitionIndexLength: int = None, carriesForward: bool = False):
         self.version = version
         self.schemaLineIndex = schemaLineIndex
         self.fileLineIndex = fileLineIndex
         self.tombstoneLineIndex = tombstoneLineIndex
         self.timestamp = timestamp if timestamp is not None else round(time()*1000)
+        self.logLineIndex = logLineIndex
+        self.partitionIndex = partitionIndex
+        self.fileByteOffset = fileByteOffset
+        self.partitionIndexLength = partitionIndexLength
+        self.carriesForward = carriesForward
 
     def toJSON(self) -> str:
         d = {
@@ -208,6 +560,16 @@ class LogMetadata:
         if self.tombstoneLineIndex is not None:
             d["tmb"] = self.tombstoneLineIndex
 
+        if self.logLineIndex is not None:
+            d["l"] = self.logLineIndex
+
+        if self.carriesForward:
+            d["cf"] = True
+
+        if self.partitionIndexLength is not None:
+            d["fb"] = self.fileByteOffset
+            d["pil"] = self.partitionIndexLength
+
         return json.dumps(d)
 
     def __str__(self):
@@ -218,126 +580,655 @@ class LogMetadata:
 
 
 def LogMetadataFromJSON(jsonl: dict):
-    lm = LogMetadata(jsonl["v"], jsonl["sch"], jsonl["f"], jsonl["tmb"] if "tmb" in jsonl else None)
+    lm = LogMetadata(jsonl["v"], jsonl["sch"], jsonl["f"], jsonl["tmb"] if "tmb" in jsonl else None,
+                     logLineIndex=jsonl["l"] if "l" in jsonl else None,
+                     fileByteOffset=jsonl["fb"] if "fb" in jsonl else None,
+                     partitionIndexLength=jsonl["pil"] if "pil" in jsonl else None,
+                     carriesForward=jsonl.get("cf", False))
     lm.timestamp = jsonl["t"]
     return lm
 
 
+class LogState:
+    """
+    A long-lived, incrementally updated view of the log. It remembers which log files have already been applied, so
+    that `IceLogIO.read_at_max_time` only needs to list and fetch log files written since the last read.
+
+    When a merged log that carries forward the log files it tombstones (see `LogMetadata.carriesForward`) is applied,
+    any file markers that were only known from those log files are evicted, as they disappear once tombstone cleanup
+    deletes those log files.
+
+    File markers are shared between the state and callers, and must not be mutated.
+    """
+    schema: Schema
+    file_markers: Dict[str, FileMarker]
+    tombstones: Dict[str, LogTombstone]
+    log_files: Dict[str, int]
+    log_file_markers: Dict[str, Dict[str, bool]]
+    # Log files tombstoned by applied merged logs that carry them forward
+    superseded: Dict[str, bool]
+    last_key: str | None
+    checkpoint: str | None
+    lookback_ms: int
+
+    def __init__(self, lookback_ms: int = 10_000):
+        """
+        `lookback_ms` is how far behind the newest known log file listing restarts from, so that log files that are
+        uploaded slightly out of timestamp order by concurrent writers are still picked up.
+        """
+        self.lookback_ms = lookback_ms
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drops all cached state, the next read will list and fetch the entire log. Should be called after tombstone
+        cleanup, as it deletes log files that the state may still reference. Reads also reset the state when they
+        notice that another process cleaned up the log, see `IceLogIO.read_at_max_time`.
+        """
+        self.schema = Schema()
+        self.file_markers = {}
+        self.tombstones = {}
+        self.log_files = {}
+        self.log_file_markers = {}
+        self.superseded = {}
+        self.last_key = None
+        self.checkpoint = None
+
+    def load_checkpoint(self, schema: Schema, file_markers: list[FileMarker], tombstones: list[LogTombstone],
+                        log_files: list[str], checkpoint: str = None):
+        """
+        Replaces the state with the contents of a checkpoint, see `IceLogIO.read_checkpoint`
+        """
+        self.reset()
+        self.checkpoint = checkpoint
+        self.schema.accumulate(schema.columns(), schema.types())
+        for tmb in tombstones:
+            self.tombstones[tmb.path] = tmb
+        for fm in file_markers:
+            self.file_markers[fm.path] = fm
+            if fm.vir_source_log_file not in self.log_file_markers:
+                self.log_file_markers[fm.vir_source_log_file] = {}
+            self.log_file_markers[fm.vir_source_log_file][fm.path] = True
+        for file in log_files:
+            self.log_files[file] = get_log_file_info(file)[0]
+            if self.last_key is None or file > self.last_key:
+                self.last_key = file
+
+    def max_timestamp(self) -> int | None:
+        if self.last_key is None:
+            return None
+        return get_log_file_info(self.last_key)[0]
+
+    def start_after(self, s3client: S3Client) -> str | None:
+        """
+        The key that listing should start after, `lookback_ms` behind the newest known log file
+        """
+        if self.last_key is None:
+            return None
+        return '/'.join([s3client.s3prefix, '_log', str(max(self.max_timestamp() - self.lookback_ms, 0))])
+
+    def apply(self, file: str, meta: LogMetadata, schema: dict, tombstones: list[LogTombstone],
+              file_markers: list[FileMarker]):
+        """
+        Folds a single log file into the state
+        """
+        self.schema.accumulate(list(schema.keys()), list(schema.values()))
+
+        for tmb in tombstones:
+            self.tombstones[tmb.path] = tmb
+
+        self.log_file_markers[file] = {}
+        for fm in file_markers:
+            if fm.path in self.file_markers:
+                previous = self.file_markers[fm.path].vir_source_log_file
+                if previous in self.log_file_markers:
+                    self.log_file_markers[previous].pop(fm.path, None)
+            self.file_markers[fm.path] = fm
+            self.log_file_markers[file][fm.path] = True
+
+        # Evict markers that the merged log did not carry forward
+        for tmb in tombstones if meta.carriesForward else []:
+            self.superseded[tmb.path] = True
+            for path in self.log_file_markers.pop(tmb.path, {}).keys():
+                del self.file_markers[path]
+
+        self.log_files[file] = meta.timestamp
+        if self.last_key is None or file > self.last_key:
+            self.last_key = file
+
+    def skip(self, file: str):
+        """
+        Records a log file that was superseded by a merged log as applied, without fetching it
+        """
+        self.log_files[file] = get_log_file_info(file)[0]
+        if self.last_key is None or file > self.last_key:
+            self.last_key = file
+
+
+class LogReadEngine(Enum):
+    """
+    How file markers are decoded and folded when reading the log
+    """
+    # A FileMarker is created for every line, and folded with a dict
+    PYTHON = "python"
+    # The file markers of all log files are decoded into a single Arrow table, and folded with a sort and deduplicate
+    ARROW = "arrow"
+
+
+# How much of a log file is fetched first when reading a subset of partitions, enough for the metadata line and
+# usually the header
+PARTITION_READ_CHUNK_BYTES = 64 * 1024
+
+
 class IceLogIO:
     path_safe_hostname: str
+    max_threads: int
+    engine: LogReadEngine
+
+    def __init__(self, path_safe_hostname: str, max_threads: int = 10, engine: LogReadEngine = LogReadEngine.PYTHON):
+        """
+        `max_threads` bounds how many log files are fetched from S3 concurrently. The default matches the boto3
+        connection pool size.
 
-    def __init__(self, path_safe_hostname: str):
+        `engine` selects how `read_log_forward` and `read_at_max_time` decode and fold file markers, see
+        `LogReadEngine`. Both return the same results.
+        """
         self.path_safe_hostname = path_safe_hostname
+        self.max_threads = max_threads
+        self.engine = engine
 
-    def read_log_forward(self, s3client: S3Client, s3_files: list[str]) -> tuple[Schema, list[FileMarker],
-    list[LogTombstone]]:
+    def read_log_file(self, s3client: S3Client, file: str, partitions: list[str] = None) -> tuple[LogMetadata, dict,
+    list[LogTombstone], list[FileMarker]]:
+        """
+        Fetches and parses a single log file of any version, returning its metadata, schema, log tombstones and file
+        markers. If `partitions` are provided, only the file markers in those partitions are returned, see
+        `read_log_file_partitions`.
+        """
+        if partitions is not None:
+            meta, schema, tombstones, file_markers, _ = self.read_log_file_partitions(s3client, file, partitions)
+            return meta, schema, tombstones, file_markers
+
+        meta, schema, tombstones, file_markers, _ = decode_log_file(file, self.fetch_log_file(s3client, file))
+        return meta, schema, tombstones, file_markers
+
+    def read_log_file_partitions(self, s3client: S3Client, file: str, partitions: list[str]) -> tuple[LogMetadata,
+    dict, list[LogTombstone], list[FileMarker], list[str] | None]:
+        """
+        Reads only the file markers of the given partitions from a log file or checkpoint, returning the same as
+        `decode_log_file`. See `fetch_log_file`.
+        """
+        meta, schema, tombstones, file_markers, log_files = decode_log_file(
+            file, self.fetch_log_file(s3client, file, partitions))
+        wanted = dict.fromkeys(partitions, True)
+        return (meta, schema, tombstones, list(filter(lambda x: get_file_partition(x.path) in wanted, file_markers)),
+                log_files)
+
+    def fetch_log_file(self, s3client: S3Client, file: str, partitions: list[str] = None) -> bytes:
+        """
+        Fetches the body of a log file or checkpoint.
+
+        If `partitions` are provided and the log file has a partition index, the metadata line, partition index, and
+        header are read with ranged GETs (usually a single one), and then only the byte ranges of the requested
+        partitions (adjacent ranges are fetched together), returning a log file with only those file markers. Otherwise,
+        the whole file is returned.
+        """
+        if partitions is None:
+            obj = s3client.s3.get_object(
+                Bucket=s3client.s3bucket,
+                Key=file
+            )
+            return obj['Body'].read()
+
+        obj = s3client.s3.get_object(
+            Bucket=s3client.s3bucket,
+            Key=file,
+            Range=f"bytes=0-{PARTITION_READ_CHUNK_BYTES - 1}"
+        )
+        chunk: bytes = obj['Body'].read()
+        total_bytes = int(obj['ContentRange'].split("/")[1]) if 'ContentRange' in obj else len(chunk)
+        meta: LogMetadata | None = None
+        if b"\n" in chunk:
+            meta = LogMetadataFromJSON(json.loads(chunk[:chunk.index(b"\n")]))
+
+        if meta is None or meta.partitionIndexLength is None:
+            return chunk if len(chunk) >= total_bytes else self.__read_range(s3client, file, chunk, 0, total_bytes)
+
+        # The partition index is on the line after the metadata, the header after that, so both are read together
+        header_start = chunk.index(b"\n") + 1
+        prefix = chunk[:header_start]
+        index_length = meta.partitionIndexLength + 1
+        header = self.__read_range(s3client, file, chunk, header_start,
+                                   header_start + index_length + meta.fileByteOffset)
+        meta.partitionIndex = json.loads(header[:meta.partitionIndexLength])
+        prefix += header[:index_length]
+        header = header[index_length:]
+        header_start += index_length
+        if header.endswith(b"\n"):
+            header = header[:-1]
+
+        # Coalesce the ranges of adjacent partitions
+        ranges = sorted(map(lambda x: meta.partitionIndex[x],
+                            filter(lambda x: x in meta.partitionIndex, dict.fromkeys(partitions, True))))
+        coalesced: list[list[int]] = []
+        for start, end in ranges:
+            if len(coalesced) > 0 and start <= coalesced[-1][1] + 1:
+                coalesced[-1][1] = max(coalesced[-1][1], end)
+            else:
+                coalesced.append([start, end])
+
+        marker_blocks = list(map(lambda x: self.__read_range(s3client, file, chunk, header_start + x[0],
+                                                             header_start + x[1]), coalesced))
+        body = prefix + header
+        if len(marker_blocks) > 0:
+            body += b"\n" + b"\n".join(marker_blocks)
+        return body
+
+    def __read_range(self, s3client: S3Client, file: str, chunk: bytes, start: int, end: int) -> bytes:
+        """
+        Returns the bytes [start, end) of a file, from the already fetched first chunk if possible
+        """
+        if end <= len(chunk):
+            return chunk[start:end]
+        obj = s3client.s3.get_object(
+            Bucket=s3client.s3bucket,
+            Key=file,
+            Range=f"bytes={start}-{end - 1}"
+        )
+        return obj['Body'].read()
+
+    def read_log_files(self, s3client: S3Client, s3_files: list[str], partitions: list[str] = None):
+        """
+        Fetches and parses log files concurrently, yielding the results of `read_log_file` in the same order as
+        `s3_files`.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            for result in executor.map(lambda file: self.read_log_file(s3client, file, partitions), s3_files):
+                yield result
+
+    def read_log_headers(self, s3client: S3Client, s3_files: list[str], partitions: list[str] = None):
+        """
+        Fetches log files concurrently, yielding the results of `decode_log_header` in the same order as `s3_files`.
+        The file markers are left encoded, see `decode_file_markers_arrow`.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            for result in executor.map(lambda file: decode_log_header(file, self.fetch_log_file(s3client, file,
+                                                                                                partitions)),
+                                       s3_files):
+                yield result
+
+    def read_log_files_superseded(self, s3client: S3Client, s3_files: list[str], superseded: list[str] = None,
+                                  partitions: list[str] = None, headers_only: bool = False):
+        """
+        Yields `(file, result)` for every log file in sorted order, where `result` is that of `read_log_file` (or
+        `decode_log_header` if `headers_only`), or None if the log file is superseded and was not fetched.
+
+        A log file is superseded once a newer merged log that carries forward the schema, log tombstones, and file
+        markers of every log file it tombstones (see `LogMetadata.carriesForward`) tombstones it. Merged logs are
+        fetched first, newest first, to collect their tombstones before fetching the rest. The tombstones of merged
+        logs written before that was tracked do not supersede anything. Log files in `superseded` (those tombstoned by
+        merged logs that carry them forward and were already applied) are never fetched.
+        """
+        read = self.read_log_headers if headers_only else self.read_log_files
+        s3_files = sorted(s3_files)
+        superseded_files: Dict[str, bool] = dict.fromkeys(superseded if superseded is not None else [], True)
+        results: Dict[str, tuple] = {}
+
+        pending = list(filter(lambda x: get_log_file_info(x)[1], reversed(s3_files)))
+        while True:
+            pending = list(filter(lambda x: x not in superseded_files, pending))
+            if len(pending) == 0:
+                break
+            batch, pending = pending[:self.max_threads], pending[self.max_threads:]
+            for file, result in zip(batch, read(s3client, batch, partitions)):
+                results[file] = result
+                for tmb in result[2] if result[0].carriesForward else []:
+                    superseded_files[tmb.path] = True
+
+        remaining = list(filter(lambda x: x not in superseded_files and x not in results, s3_files))
+        fetched = zip(remaining, read(s3client, remaining, partitions))
+        for file in s3_files:
+            if file in superseded_files:
+                yield file, None
+            elif file in results:
+                yield file, results[file]
+            else:
+                yield next(fetched)
+
+    def read_log_forward(self, s3client: S3Client, s3_files: list[str], checkpoint: tuple[Schema, list[FileMarker],
+    list[LogTombstone]] = None, partitions: list[str] = None) -> tuple[Schema, list[FileMarker], list[LogTombstone]]:
         """
         Reads the current state of the log for a given set of files, not meant to be used externally.
+
+        Files are fetched concurrently, but always applied in sorted order so later markers replace earlier ones. Log
+        files superseded by a newer merged log are not fetched, see `read_log_files_superseded`. If the schema, file
+        markers, and log tombstones of a checkpoint are provided, the files are applied on top of it. If `partitions`
+        are provided, only file markers in those partitions are read.
         """
+        if self.engine == LogReadEngine.ARROW and checkpoint is None:
+            total_schema, table, log_tombstones = self.read_log_forward_arrow(s3client, s3_files,
+                                                                              partitions=partitions)
+            return total_schema, file_markers_from_arrow(table), log_tombstones
+
         total_schema = Schema()
         file_markers: Dict[str, FileMarker] = {}
         tombstones: Dict[str, LogTombstone] = {}
-        log_files: list[str] = []
         # ensure they are sorted
         s3_files = sorted(s3_files)
 
-        for file in s3_files:
-            log_files.append(file)
+        if checkpoint is not None:
+            cp_schema, cp_file_markers, cp_tombstones = checkpoint
+            total_schema.accumulate(cp_schema.columns(), cp_schema.types())
+            for fm in cp_file_markers:
+                file_markers[fm.path] = fm
+            for tmb in cp_tombstones:
+                tombstones[tmb.path] = tmb
+        elif len(s3_files) == 0:
+            raise NoLogFilesException
+
+        for _, result in self.read_log_files_superseded(s3client, s3_files, partitions=partitions):
+            if result is None:
+                continue
+            meta, schema, log_tombstones, log_file_markers = result
+            total_schema.accumulate(list(schema.keys()), list(schema.values()))
+            for tmb in log_tombstones:
+                tombstones[tmb.path] = tmb
+            for fm in log_file_markers:
+                file_markers[fm.path] = fm
+
+        return total_schema, list(file_markers.values()), list(tombstones.values())
+
+    def read_log_forward_table(self, s3client: S3Client, s3_files: list[str], partitions: list[str] = None) -> tuple[
+        Schema, FileMarkerTable, list[LogTombstone]]:
+        """
+        Like `read_log_forward`, but returns the file markers as a `FileMarkerTable`
+        """
+        if self.engine == LogReadEngine.ARROW:
+            schema, table, tombstones = self.read_log_forward_arrow(s3client, s3_files, partitions=partitions)
+            return schema, FileMarkerTable(table), tombstones
+        schema, file_markers, tombstones = self.read_log_forward(s3client, s3_files, partitions=partitions)
+        return schema, FileMarkerTableFromList(file_markers), tombstones
+
+    def read_log_forward_arrow(self, s3client: S3Client, s3_files: list[str], checkpoint: str = None,
+                               partitions: list[str] = None) -> tuple[Schema, pa.Table, list[LogTombstone]]:
+        """
+        Like `read_log_forward`, but the file markers of all log files are decoded into a single Arrow table, and
+        folded by sorting and deduplicating on the path rather than updating a dict. The returned table has the
+        columns of `decode_file_markers_arrow`, and can be converted with `file_markers_from_arrow`.
+
+        If a checkpoint file is provided, it is applied first, and the log files it folded are skipped.
+        """
+        total_schema = Schema()
+        tombstones: Dict[str, LogTombstone] = {}
+        headers: list[tuple[str, tuple]] = []
+
+        if checkpoint is not None:
+            cp_header = decode_log_header(checkpoint, self.fetch_log_file(s3client, checkpoint, partitions))
+            folded = dict.fromkeys(cp_header[3], True)
+            s3_files = list(filter(lambda x: x not in folded, s3_files))
+            headers.append((checkpoint, cp_header))
+        elif len(s3_files) == 0:
+            raise NoLogFilesException
+
+        for file, header in self.read_log_files_superseded(s3client, s3_files, partitions=partitions,
+                                                           headers_only=True):
+            if header is not None:
+                headers.append((file, header))
+
+        for _, (meta, schema, log_tombstones, _, _) in headers:
+            total_schema.accumulate(list(schema.keys()), list(schema.values()))
+            for tmb in log_tombstones:
+                tombstones[tmb.path] = tmb
+
+        table = fold_file_markers_arrow(decode_file_markers_arrow(headers))
+        if partitions is not None:
+            table = filter_partitions_arrow(table, partitions)
+        return total_schema, table, list(tombstones.values())
+
+    def read_checkpoint(self, s3client: S3Client, file: str, partitions: list[str] = None) -> tuple[Schema,
+    list[FileMarker], list[LogTombstone], list[str]]:
+        """
+        Reads a checkpoint, returning the schema, file markers, and log tombstones it captured, and the log files
+        that were folded into it. File markers keep the log file they were originally read from. If `partitions` are
+        provided, only file markers in those partitions are read.
+        """
+        if partitions is not None:
+            meta, schema_json, tombstones, file_markers, log_files = self.read_log_file_partitions(s3client, file,
+                                                                                                   partitions)
+        else:
             obj = s3client.s3.get_object(
                 Bucket=s3client.s3bucket,
                 Key=file
             )
-            jsonl = str(obj['Body'].read(), encoding="utf-8").split("\n")
-            meta_json = json.loads(jsonl[0])
-            meta = LogMetadataFromJSON(meta_json)
-
-            # Schema
-            schema = dict(json.loads(jsonl[meta.schemaLineIndex]))
-            total_schema.accumulate(list(schema.keys()), list(schema.values()))
+            meta, schema_json, tombstones, file_markers, log_files = decode_log_file(file, obj['Body'].read())
 
-            # Log tombstones
-            if meta.tombstoneLineIndex is not None:
-                for i in range(meta.tombstoneLineIndex, meta.fileLineIndex):
-                    tmb_dict = dict(json.loads(jsonl[i]))
-                    tombstones[tmb_dict["p"]] = LogTombstone(tmb_dict["p"], int(tmb_dict["t"]))
+        schema = Schema()
+        schema.accumulate(list(schema_json.keys()), list(schema_json.values()))
 
-            # Files
-            for i in range(meta.fileLineIndex, len(jsonl)):
-                fm_json = dict(json.loads(jsonl[i]))
+        return schema, file_markers, tombstones, log_files
 
-                # Otherwise add if not exists
-                fm = FileMarker(fm_json["p"], int(fm_json["t"]), int(fm_json["b"]),
-                                fm_json["tmb"] if "tmb" in fm_json else None)
-                fm.vir_source_log_file = file
-                file_markers[fm_json["p"]] = fm
+    def write_checkpoint(self, s3client: S3Client, timestamp: int = None, state: LogState = None,
+                         version: int = 1) -> tuple[str | None, LogMetadata | None]:
+        """
+        Writes a checkpoint of the state of the log up to a given timestamp (defaults to now) to the `_log` prefix,
+        so that readers only need to read the newest checkpoint and the log files written after it.
 
-        if len(log_files) == 0:
-            raise NoLogFilesException
+        The checkpoint is named after the newest log file folded into it, and keeps the same line layout as a log
+        file, so readers that are not aware of checkpoints can still apply it as a regular log file.
 
-        return total_schema, list(file_markers.values()), list(tombstones.values())
+        Returns the checkpoint path and metadata, or None if there are no log files.
+        """
+        if timestamp is None:
+            timestamp = round(time() * 1000)
+        try:
+            schema, file_markers, tombstones, log_files = self.read_at_max_time(s3client, timestamp, state)
+        except NoLogFilesException:
+            return None, None
+
+        # Intern the source log files, markers refer to them by index
+        log_indexes: Dict[str, int] = {}
+        for file in log_files:
+            log_indexes[file] = len(log_indexes)
+        for fm in file_markers:
+            if fm.vir_source_log_file not in log_indexes:
+                log_indexes[fm.vir_source_log_file] = len(log_indexes)
+
+        checkpoint_ts = max(map(lambda x: get_log_file_info(x)[0], log_files))
+        meta = LogMetadata(version, 1, 3 + len(tombstones), 3 if len(tombstones) > 0 else None,
+                           timestamp=checkpoint_ts, logLineIndex=2)
+
+        log_file_lines: list[str] = [schema.toJSON(), json.dumps(list(log_indexes.keys()))]
+        for tmb in tombstones:
+            log_file_lines.append(tmb.toJSON())
+
+        file_key = "/".join([s3client.s3prefix, '_log', f"{checkpoint_ts}_c_{self.path_safe_hostname}" +
+                             log_file_extension(version)])
+        s3client.s3.put_object(
+            Body=encode_log_file(meta, log_file_lines, file_markers,
+                                 list(map(lambda x: log_indexes[x.vir_source_log_file], file_markers))),
+            Bucket=s3client.s3bucket,
+            Key=file_key
+        )
+        if state is not None:
+            with state.lock:
+                # The state already holds everything folded into the checkpoint
+                if state.checkpoint is None or file_key > state.checkpoint:
+                    state.checkpoint = file_key
+        return file_key, meta
 
-    def get_current_log_files(self, s3client: S3Client) -> list[dict]:
+    def get_current_log_files(self, s3client: S3Client, start_after: str = None) -> list[dict]:
         """
-        Returns the list of known log files as S3 object dictionaries
+        Returns the list of known log files as S3 object dictionaries, optionally only those listed after the
+        `start_after` key
         """
         s3_files: list[dict] = []
         no_more_files = False
         continuation_token = ""
         while not no_more_files:
-            res = s3client.s3.list_objects_v2(
-                Bucket=s3client.s3bucket,
-                MaxKeys=1000,
-                Prefix='/'.join([s3client.s3prefix, '_log']),
-                ContinuationToken=continuation_token
-            ) if continuation_token != "" else s3client.s3.list_objects_v2(
-                Bucket=s3client.s3bucket,
-                MaxKeys=1000,
-                Prefix='/'.join([s3client.s3prefix, '_log'])
-            )
+            list_args = {
+                "Bucket": s3client.s3bucket,
+                "MaxKeys": 1000,
+                "Prefix": '/'.join([s3client.s3prefix, '_log'])
+            }
+            if continuation_token != "":
+                list_args["ContinuationToken"] = continuation_token
+            elif start_after is not None:
+                list_args["StartAfter"] = start_after
+            res = s3client.s3.list_objects_v2(**list_args)
             if 'Contents' not in res:
-                return []
+                return s3_files
             s3_files += res['Contents']
             no_more_files = not res['IsTruncated']
             if not no_more_files:
                 continuation_token = res['NextContinuationToken']
 
-        if len(s3_files) == 0:
+        if len(s3_files) == 0 and start_after is None:
             raise NoLogFilesException
 
         return s3_files
 
-    def read_at_max_time(self, s3client: S3Client, timestamp: int) -> tuple[Schema, list[FileMarker],
-    list[LogTombstone], list[str]]:
+    def read_at_max_time(self, s3client: S3Client, timestamp: int, state: LogState = None,
+                         partitions: list[str] = None) -> tuple[Schema, list[FileMarker], list[LogTombstone],
+    list[str]]:
+        """
+        Read the current state of the log up to a given timestamp.
+
+        If a `LogState` is provided, only log files that it has not yet applied are fetched. Reading at a timestamp
+        older than the newest log file in the state falls back to reading the entire log. The state is rebuilt if a log
+        file it applied within its lookback window is no longer listed (another process ran tombstone cleanup), and
+        reloaded from any checkpoint newer than the one it was loaded from.
+
+        If `partitions` are provided, only the file markers in those partitions are returned. Without a state, only
+        the byte ranges of those partitions are fetched from log files that have a partition index.
+        """
+        schema, file_markers, tombstones, log_files = self.__read_at_max_time(s3client, timestamp, state, partitions)
+        if isinstance(file_markers, FileMarkerTable):
+            file_markers = file_markers.to_list()
+        return schema, file_markers, tombstones, log_files
+
+    def read_table_at_max_time(self, s3client: S3Client, timestamp: int, state: LogState = None,
+                               partitions: list[str] = None) -> tuple[Schema, FileMarkerTable, list[LogTombstone],
+    list[str]]:
         """
-        Read the current state of the log up to a given timestamp
+        Like `read_at_max_time`, but returns the file markers as a `FileMarkerTable`. With the Arrow engine and no
+        cached state, the file markers are never materialized as FileMarkers.
         """
+        schema, file_markers, tombstones, log_files = self.__read_at_max_time(s3client, timestamp, state, partitions)
+        if not isinstance(file_markers, FileMarkerTable):
+            file_markers = FileMarkerTableFromList(file_markers)
+        return schema, file_markers, tombstones, log_files
+
+    def __read_at_max_time(self, s3client: S3Client, timestamp: int, state: LogState = None,
+                           partitions: list[str] = None) -> tuple[Schema, list[FileMarker] | FileMarkerTable,
+    list[LogTombstone], list[str]]:
+        if state is not None:
+            with state.lock:
+                max_timestamp = state.max_timestamp()
+                if max_timestamp is None or max_timestamp < timestamp:
+                    schema, file_markers, tombstones, log_files = self.__read_state_at_max_time(s3client, timestamp,
+                                                                                                state)
+                    if partitions is not None:
+                        wanted = dict.fromkeys(partitions, True)
+                        file_markers = list(filter(lambda x: get_file_partition(x.path) in wanted, file_markers))
+                    return schema, file_markers, tombstones, log_files
+
         s3_files = self.get_current_log_files(s3client)
 
         # Filter out files that are too old
         s3_files = list(filter(lambda x: get_log_file_info(x['Key'])[0] < timestamp, s3_files))
+        log_files = list(map(lambda x: x['Key'], filter(lambda x: not is_checkpoint_log_file(x['Key']), s3_files)))
+        checkpoints = list(map(lambda x: x['Key'], filter(lambda x: is_checkpoint_log_file(x['Key']), s3_files)))
 
-        if len(s3_files) == 0:
+        if len(log_files) == 0:
             raise NoLogFilesException
 
-        log_files = list(map(lambda x: x['Key'], s3_files))
-        schema, file_markers, log_tombstones = self.read_log_forward(s3client, log_files)
+        if self.engine == LogReadEngine.ARROW:
+            checkpoint = max(checkpoints, key=lambda x: get_log_file_info(x)[0]) if len(checkpoints) > 0 else None
+            schema, table, log_tombstones = self.read_log_forward_arrow(s3client, log_files, checkpoint, partitions)
+            return schema, FileMarkerTable(table), log_tombstones, log_files
+
+        if len(checkpoints) == 0:
+            schema, file_markers, log_tombstones = self.read_log_forward(s3client, log_files, partitions=partitions)
+            return schema, file_markers, log_tombstones, log_files
+
+        # Start from the newest checkpoint, and only replay the log files that it did not fold
+        cp_schema, cp_file_markers, cp_tombstones, cp_log_files = self.read_checkpoint(
+            s3client, max(checkpoints, key=lambda x: get_log_file_info(x)[0]), partitions)
+        folded = dict.fromkeys(cp_log_files, True)
+        schema, file_markers, log_tombstones = self.read_log_forward(
+            s3client, list(filter(lambda x: x not in folded, log_files)), (cp_schema, cp_file_markers, cp_tombstones),
+            partitions)
         return schema, file_markers, log_tombstones, log_files
 
-    def append(self, s3client: S3Client, version: int, schema: Schema, files: list[FileMarker], tombstones: list[
-        LogTombstone] = None, merged = False, timestamp: int = None) -> tuple[str, LogMetadata]:
+    def read_partitions(self, s3client: S3Client, partitions: list[str], timestamp: int = None) -> tuple[Schema,
+    list[FileMarker], list[LogTombstone], list[str]]:
+        """
+        Read the state of the given partitions up to a given timestamp (defaults to now). The schema and log
+        tombstones are those of the whole log.
+
+        For log files with a partition index, only the byte ranges of the given partitions are fetched.
+        """
+        return self.read_at_max_time(s3client, timestamp if timestamp is not None else round(time() * 1000),
+                                     partitions=partitions)
+
+    def __read_state_at_max_time(self, s3client: S3Client, timestamp: int, state: LogState) -> tuple[Schema,
+    list[FileMarker], list[LogTombstone], list[str]]:
+        start_after = state.start_after(s3client)
+        listed = list(map(lambda x: x['Key'], self.get_current_log_files(s3client, start_after)))
+
+        # Only tombstone cleanup deletes log files, if one the state applied is no longer listed then another process
+        # cleaned up the log, and the state may still reference deleted log and data files
+        listed_files = dict.fromkeys(listed, True)
+        if start_after is not None and any(map(lambda x: x > start_after and x not in listed_files,
+                                               state.log_files.keys())):
+            state.reset()
+            return self.__read_state_at_max_time(s3client, timestamp, state)
+
+        s3_files = list(filter(lambda x: get_log_file_info(x)[0] < timestamp, listed))
+
+        # A new checkpoint is a complete fold of the log, and may have been written after a cleanup that the check
+        # above did not see, so the state is rebuilt from it
+        checkpoints = list(filter(is_checkpoint_log_file, s3_files))
+        if len(checkpoints) > 0:
+            checkpoint = max(checkpoints, key=lambda x: get_log_file_info(x)[0])
+            if state.checkpoint is None or checkpoint > state.checkpoint:
+                state.load_checkpoint(*self.read_checkpoint(s3client, checkpoint), checkpoint=checkpoint)
+
+        new_files = sorted(filter(lambda x: x not in state.log_files and not is_checkpoint_log_file(x), s3_files))
+        for file, result in self.read_log_files_superseded(s3client, new_files, list(state.superseded.keys())):
+            if result is None:
+                state.skip(file)
+            else:
+                state.apply(file, *result)
+
+        if len(state.log_files) == 0:
+            raise NoLogFilesException
+
+        schema = Schema()
+        schema.accumulate(state.schema.columns(), state.schema.types())
+        return (schema, list(state.file_markers.values()), list(state.tombstones.values()),
+                sorted(state.log_files.keys()))
+
+    def append(self, s3client: S3Client, version: int, schema: Schema, files: list[FileMarker] | FileMarkerTable,
+               tombstones: list[LogTombstone] = None, merged = False, timestamp: int = None,
+               carries_forward = False) -> tuple[str, LogMetadata]:
         """
         Creates a new log file in S3, in the order of version, schema, tombstones?, files
+
+        `carries_forward` records that the log file includes the schema, log tombstones, and file markers of every log
+        file it tombstones, so readers can skip those log files, see `read_log_files_superseded`.
+
+        Version 1 writes file markers as JSON lines grouped by partition, with a partition index in the metadata.
+        Version 2 writes them as a compressed columnar block. See `encode_log_file`.
         """
         log_file_lines: list[str] = []
         meta = LogMetadata(version, 1, 2 if tombstones is None or len(tombstones) == 0 else 2+len(tombstones),
-                           None if tombstones is None or len(tombstones) == 0 else 2, timestamp=timestamp)
-        log_file_lines.append(meta.toJSON())
+                           None if tombstones is None or len(tombstones) == 0 else 2, timestamp=timestamp,
+                           carriesForward=carries_forward)
         log_file_lines.append(schema.toJSON())
         if tombstones is not None:
             for tmb in tombstones:
                 log_file_lines.append(tmb.toJSON())
-        for fileMarker in files:
-            log_file_lines.append(fileMarker.json())
 
         file_id = f"{meta.timestamp}"
         if merged:
@@ -345,9 +1236,9 @@ class IceLogIO:
         file_id += f"_{self.path_safe_hostname}"
 
         # Upload the file to S3
-        file_key = "/".join([s3client.s3prefix, '_log', file_id+'.jsonl'])
+        file_key = "/".join([s3client.s3prefix, '_log', file_id+log_file_extension(version)])
         s3client.s3.put_object(
-            Body=bytes('\n'.join(log_file_lines), 'utf-8'),
+            Body=encode_log_file(meta, log_file_lines, files),
             Bucket=s3client.s3bucket,
             Key=file_key
         )
@@ -365,3 +1256,335 @@ def get_log_file_info(file_name: str) -> tuple[int, bool]:
     if len(name_parts) > 2 and name_parts[1] == "m":
         merged = True
     return file_ts, merged
+
+
+def is_checkpoint_log_file(file_name: str) -> bool:
+    """
+    Whether the file in the `_log` prefix is a checkpoint rather than a log file
+    """
+    name_parts = file_name.split("/")[-1].split("_")
+    return len(name_parts) > 2 and name_parts[1] == "c"
+
+
+def log_file_extension(version: int) -> str:
+    return ".jsonl" if version < 2 else ".log"
+
+
+def encode_log_file(meta: LogMetadata, header_lines: list[str], file_markers: list[FileMarker] | FileMarkerTable,
+                    log_indexes: list[int] = None) -> bytes:
+    """
+    Encodes a log file from its metadata, the lines following it (schema, and tombstones), and file markers.
+
+    Version 1 appends a JSON line per file marker, grouped by partition. The byte range of each partition's markers is
+    recorded in the partition index, a line between the metadata line and the header lines whose length is the
+    metadata `pil` property, and the start of the markers in `fb`. Both are relative to the start of the header lines,
+    so readers can fetch a subset of partitions with ranged GETs, and the metadata line stays small however many
+    partitions there are. The line indexes of the metadata are shifted to account for the partition index line.
+
+    Version 2 appends a single Arrow IPC stream (zstd compressed) after the header lines, with the directory of each
+    path dictionary encoded, so the `prefix/_data/partition` of each path is only stored once per log file.
+
+    If provided, `log_indexes` are written as each marker's `l` property (used by checkpoints).
+    """
+    header = bytes('\n'.join(header_lines), 'utf-8')
+    if isinstance(file_markers, FileMarkerTable) and (meta.version < 2 or log_indexes is not None):
+        file_markers = file_markers.to_list()
+    if meta.version < 2:
+        partitions: Dict[str, list[bytes]] = {}
+        for i in range(len(file_markers)):
+            d = file_markers[i].toDict()
+            if log_indexes is not None:
+                d["l"] = log_indexes[i]
+            partition = get_file_partition(file_markers[i].path)
+            if partition not in partitions:
+                partitions[partition] = []
+            partitions[partition].append(bytes(json.dumps(d), 'utf-8'))
+
+        meta.fileByteOffset = len(header) + 1
+        meta.partitionIndex = {}
+        blocks: list[bytes] = []
+        offset = meta.fileByteOffset
+        for partition, lines in partitions.items():
+            block = b"\n".join(lines)
+            meta.partitionIndex[partition] = [offset, offset + len(block)]
+            offset += len(block) + 1
+            blocks.append(block)
+
+        index_line = bytes(json.dumps(meta.partitionIndex), 'utf-8')
+        meta.partitionIndexLength = len(index_line)
+        meta.schemaLineIndex += 1
+        meta.fileLineIndex += 1
+        if meta.tombstoneLineIndex is not None:
+            meta.tombstoneLineIndex += 1
+        if meta.logLineIndex is not None:
+            meta.logLineIndex += 1
+
+        body = bytes(meta.toJSON(), 'utf-8') + b"\n" + index_line + b"\n" + header
+        if len(blocks) > 0:
+            body += b"\n" + b"\n".join(blocks)
+        return body
+
+    if isinstance(file_markers, FileMarkerTable):
+        paths = file_markers.table.column("p").combine_chunks()
+        # Split on the last "/", paths without a directory have an empty one
+        dirs = pc.replace_substring_regex(paths, pattern=r"^(?:(.*)/)?[^/]*$", replacement=r"\1")
+        columns = {
+            "d": dirs.dictionary_encode(),
+            "n": pc.replace_substring_regex(paths, pattern=r"^.*/", replacement=""),
+            "b": file_markers.table.column("b").combine_chunks(),
+            "t": file_markers.table.column("t").combine_chunks(),
+            "tmb": file_markers.table.column("tmb").combine_chunks(),
+            "r": file_markers.table.column("r").combine_chunks(),
+            "z": file_markers.table.column("z").combine_chunks()
+        }
+    else:
+        dirs: list[str] = []
+        names: list[str] = []
+        for fm in file_markers:
+            d, _, name = fm.path.rpartition("/")
+            dirs.append(d)
+            names.append(name)
+        columns = {
+            "d": pa.array(dirs, pa.string()).dictionary_encode(),
+            "n": pa.array(names, pa.string()),
+            "b": pa.array(list(map(lambda x: x.fileBytes, file_markers)), pa.int64()),
+            "t": pa.array(list(map(lambda x: x.createdMS, file_markers)), pa.int64()),
+            "tmb": pa.array(list(map(lambda x: x.tombstone, file_markers)), pa.int64()),
+            "r": pa.array(list(map(lambda x: x.rowCount, file_markers)), pa.int64()),
+            "z": pa.array(list(map(lambda x: json.dumps(x.zoneMap) if x.zoneMap is not None else None,
+                                   file_markers)), pa.string())
+        }
+    if log_indexes is not None:
+        columns["l"] = pa.array(log_indexes, pa.int32())
+    table = pa.table(columns)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+        writer.write_table(table)
+    return bytes(meta.toJSON(), 'utf-8') + b"\n" + header + b"\n" + sink.getvalue().to_pybytes()
+
+
+def decode_log_header(file: str, body: bytes) -> tuple[LogMetadata, dict, list[LogTombstone], list[str] | None,
+bytes]:
+    """
+    Decodes the lines of a log file or checkpoint before its file markers, returning its metadata, schema, log
+    tombstones, for checkpoints the list of log files folded into it, and the still encoded file markers.
+    """
+    meta = LogMetadataFromJSON(json.loads(body.split(b"\n", 1)[0]))
+    parts = body.split(b"\n", meta.fileLineIndex)
+    lines = parts[:meta.fileLineIndex]
+
+    schema = dict(json.loads(lines[meta.schemaLineIndex]))
+    log_files = list(json.loads(lines[meta.logLineIndex])) if meta.logLineIndex is not None else None
+
+    tombstones: list[LogTombstone] = []
+    if meta.tombstoneLineIndex is not None:
+        for i in range(meta.tombstoneLineIndex, meta.fileLineIndex):
+            tombstones.append(LogTombstoneFromJSON(dict(json.loads(lines[i]))))
+
+    return meta, schema, tombstones, log_files, parts[meta.fileLineIndex] if len(parts) > meta.fileLineIndex else b""
+
+
+def decode_log_file(file: str, body: bytes) -> tuple[LogMetadata, dict, list[LogTombstone], list[FileMarker],
+list[str] | None]:
+    """
+    Decodes a log file or checkpoint of any version, returning its metadata, schema, log tombstones, file markers,
+    and for checkpoints the list of log files folded into it.
+    """
+    meta, schema, tombstones, log_files, markers = decode_log_header(file, body)
+
+    file_markers: list[FileMarker] = []
+    if meta.version >= 2:
+        table = pa.ipc.open_stream(markers).read_all()
+        dirs = table.column("d").to_pylist()
+        names = table.column("n").to_pylist()
+        file_bytes = table.column("b").to_pylist()
+        created = table.column("t").to_pylist()
+        marker_tombstones = table.column("tmb").to_pylist()
+        row_counts = optional_column(table, "r", pa.int64()).to_pylist()
+        zone_maps = optional_column(table, "z", pa.string()).to_pylist()
+        indexes = table.column("l").to_pylist() if "l" in table.column_names else None
+        for i in range(table.num_rows):
+            fm = FileMarker(dirs[i] + "/" + names[i] if dirs[i] != "" else names[i], created[i], file_bytes[i],
+                            marker_tombstones[i], row_counts[i],
+                            json.loads(zone_maps[i]) if zone_maps[i] is not None else None)
+            fm.vir_source_log_file = log_files[indexes[i]] if indexes is not None else file
+            file_markers.append(fm)
+    elif len(markers) > 0:
+        for line in markers.split(b"\n"):
+            fm_json = dict(json.loads(line))
+            fm = FileMarkerFromJSON(fm_json)
+            fm.vir_source_log_file = log_files[fm_json["l"]] if "l" in fm_json else file
+            file_markers.append(fm)
+
+    return meta, schema, tombstones, file_markers, log_files
+
+
+# The properties of version 1 file marker lines, for decoding with pyarrow.json. The zone map (z) is an object whose
+# values have mixed types, which pyarrow.json cannot decode, see `decode_zone_maps_json`.
+FILE_MARKER_JSON_SCHEMA = pa.schema([
+    pa.field("p", pa.string()),
+    pa.field("b", pa.int64()),
+    pa.field("t", pa.int64()),
+    pa.field("tmb", pa.int64()),
+    pa.field("r", pa.int64()),
+    pa.field("l", pa.int32())
+])
+
+# The zone map of a version 1 file marker line as written by `FileMarker.json`, the last property other than `l`
+FILE_MARKER_ZONE_MAP_PATTERN = r'"z": (?P<z>\{.*\})(?:, "l": \d+)?\}$'
+
+
+def decode_zone_maps_json(markers: bytes) -> pa.Array:
+    """
+    Returns the zone maps of version 1 file marker lines as JSON strings (null if there is none), like the `z` column
+    of version 2 log files. They are extracted from the lines with a regex, lines written with a different layout
+    are parsed.
+    """
+    lines = pc.list_flatten(pc.split_pattern(pa.array([markers], pa.large_binary()), "\n")).cast(pa.large_string())
+    zone_maps = pc.struct_field(pc.extract_regex(lines, pattern=FILE_MARKER_ZONE_MAP_PATTERN), [0])
+    missed = pc.and_(pc.is_null(zone_maps), pc.match_substring(lines, '"z"'))
+    if not pc.any(missed).as_py():
+        return zone_maps.cast(pa.string())
+    parsed = list(map(lambda x: json.loads(x).get("z") if x is not None else None,
+                      pc.if_else(missed, lines, pa.scalar(None, pa.large_string())).to_pylist()))
+    return pc.coalesce(zone_maps, pa.array(list(map(lambda x: json.dumps(x) if x is not None else None, parsed)),
+                                           pa.large_string())).cast(pa.string())
+
+
+def optional_column(table: pa.Table, name: str, type: pa.DataType):
+    """
+    Returns a column of the table, or all nulls if it does not exist (e.g. written before the column was added)
+    """
+    return table.column(name) if name in table.column_names else pa.nulls(table.num_rows, type)
+
+
+def decode_file_markers_arrow(headers: list[tuple[str, tuple]]) -> pa.Table:
+    """
+    Decodes the file markers of many log files (pairs of the log file and its `decode_log_header` result) into a
+    single table, in the order of the log files, with the columns `p` (path), `b` (bytes), `t` (created ms),
+    `tmb` (tombstone ms, nullable), `r` (row count, nullable), `z` (JSON zone map, nullable), and `s` (dictionary
+    encoded source log file).
+
+    The version 1 file markers of all log files are parsed in a single pyarrow.json pass, and their zone maps
+    extracted with `decode_zone_maps_json`.
+    """
+    sources: list[str] = []
+    # (log file version, source index of the log file, index of the first folded log file of a checkpoint, markers)
+    logs: list[tuple[int, int, int, bytes]] = []
+    for file, (meta, _, _, log_files, markers) in headers:
+        own = len(sources)
+        sources.append(file)
+        if log_files is not None:
+            sources += log_files
+        if len(markers) > 0:
+            logs.append((meta.version, own, own + 1, markers))
+
+    v1_markers = list(map(lambda x: x[3], filter(lambda x: x[0] < 2, logs)))
+    v1_table: pa.Table | None = None
+    if len(v1_markers) > 0:
+        joined = b"\n".join(v1_markers)
+        v1_table = pyarrow.json.read_json(io.BytesIO(joined),
+                                          parse_options=pyarrow.json.ParseOptions(
+                                              explicit_schema=FILE_MARKER_JSON_SCHEMA,
+                                              unexpected_field_behavior="ignore"))
+        v1_table = v1_table.append_column("z", decode_zone_maps_json(joined))
+
+    tables: list[pa.Table] = []
+    v1_offset = 0
+    for version, own, base, markers in logs:
+        if version < 2:
+            rows = markers.count(b"\n") + 1
+            table = v1_table.slice(v1_offset, rows)
+            v1_offset += rows
+            paths = table.column("p")
+            indexes = table.column("l")
+        else:
+            table = pa.ipc.open_stream(markers).read_all()
+            dirs = table.column("d").cast(pa.string())
+            paths = pc.if_else(pc.equal(dirs, ""), table.column("n"),
+                               pc.binary_join_element_wise(dirs, table.column("n"), "/"))
+            indexes = table.column("l") if "l" in table.column_names else pa.nulls(table.num_rows, pa.int32())
+
+        tables.append(pa.table({
+            "p": paths,
+            "b": table.column("b"),
+            "t": table.column("t"),
+            "tmb": table.column("tmb"),
+            "r": optional_column(table, "r", pa.int64()),
+            "z": optional_column(table, "z", pa.string()),
+            "s": pc.if_else(pc.is_valid(indexes), pc.add(indexes, pa.scalar(base, pa.int32())),
+                            pa.scalar(own, pa.int32()))
+        }))
+
+    if len(tables) == 0:
+        return pa.table({
+            "p": pa.array([], pa.string()),
+            "b": pa.array([], pa.int64()),
+            "t": pa.array([], pa.int64()),
+            "tmb": pa.array([], pa.int64()),
+            "r": pa.array([], pa.int64()),
+            "z": pa.array([], pa.string()),
+            "s": pa.DictionaryArray.from_arrays(pa.array([], pa.int32()), pa.array(sources, pa.string()))
+        })
+
+    table = pa.concat_tables(tables)
+    return table.set_column(table.schema.get_field_index("s"), "s",
+                            pa.DictionaryArray.from_arrays(table.column("s").combine_chunks(),
+                                                           pa.array(sources, pa.string())))
+
+
+def fold_file_markers_arrow(table: pa.Table) -> pa.Table:
+    """
+    Keeps only the last file marker of each path, where markers are in the order they were applied (last writer
+    wins). The result is sorted by path.
+    """
+    if table.num_rows == 0:
+        return table
+    # The sort is stable, so the last marker applied for a path is the last in its run
+    indexes = pc.sort_indices(table, sort_keys=[("p", "ascending")])
+    paths = table.column("p").take(indexes).combine_chunks()
+    last = pc.not_equal(paths.slice(0, len(paths) - 1), paths.slice(1))
+    return table.take(indexes.filter(pa.concat_arrays([last, pa.array([True])])))
+
+
+def filter_partitions_arrow(table: pa.Table, partitions: list[str]) -> pa.Table:
+    """
+    Keeps only the file markers in the given partitions, see `get_file_partition`
+    """
+    file_partitions = pc.replace_substring_regex(table.column("p"), pattern=r"^(?:.*?_data/)?(?:(.*)/)?[^/]*$",
+                                                 replacement=r"\1")
+    return table.filter(pc.is_in(file_partitions, value_set=pa.array(partitions, pa.string())))
+
+
+def file_markers_from_arrow(table: pa.Table) -> list[FileMarker]:
+    """
+    Converts a table of file markers (see `decode_file_markers_arrow`) to FileMarkers. Markers from the same log file
+    share the same source log file string.
+    """
+    file_markers: list[FileMarker] = []
+    for batch in table.unify_dictionaries().combine_chunks().to_batches() if table.num_rows > 0 else []:
+        paths = batch.column("p").to_pylist()
+        file_bytes = batch.column("b").to_pylist()
+        created = batch.column("t").to_pylist()
+        tombstones = batch.column("tmb").to_pylist()
+        row_counts = batch.column("r").to_pylist()
+        zone_maps = batch.column("z").to_pylist()
+        source_column = batch.column("s")
+        sources = source_column.dictionary.to_pylist()
+        source_indexes = source_column.indices.to_pylist()
+        for i in range(batch.num_rows):
+            fm = FileMarker(paths[i], created[i], file_bytes[i], tombstones[i], row_counts[i],
+                            json.loads(zone_maps[i]) if zone_maps[i] is not None else None)
+            fm.vir_source_log_file = sources[source_indexes[i]] if source_indexes[i] is not None else None
+            file_markers.append(fm)
+    return file_markers
+
+
+def get_file_partition(path: str) -> str:
+    """
+    Returns the partition of a data file path, e.g. `u=a/d=2023-01-01` for
+    `prefix/_data/u=a/d=2023-01-01/file.parquet`
+    """
+    base_path = path.split("_data/")[1] if "_data/" in path else path
+    return base_path.rpartition("/")[0]
@@ -0,0 +1,221 @@
+import re
+import zlib
+from enum import Enum
+from decimal import Decimal
+import pyarrow as pa
+import pyarrow.compute as pc
+from .log import zone_map_value, zone_map_may_match, hive_partition_values
+
+# The partition value of rows where the source column is null
+PARTITION_NULL_VALUE = "__HIVE_DEFAULT_PARTITION__"
+
+
+class PartitionTransform(Enum):
+    IDENTITY = "identity"
+    YEAR = "year"
+    MONTH = "month"
+    DAY = "day"
+    HOUR = "hour"
+    BUCKET = "bucket"
+
+
+# Formats of the time transforms, partition values sort in the same order as the times they contain
+TIME_TRANSFORM_FORMATS = {
+    PartitionTransform.YEAR: "%Y",
+    PartitionTransform.MONTH: "%Y-%m",
+    PartitionTransform.DAY: "%Y-%m-%d",
+    PartitionTransform.HOUR: "%Y-%m-%d-%H",
+}
+
+
+def as_timestamps(column: pa.Array | pa.ChunkedArray) -> pa.Array | pa.ChunkedArray:
+    """
+    Converts a column to timestamps for the time transforms. Integers are unix ms, strings are ISO 8601.
+    """
+    if pa.types.is_integer(column.type):
+        return column.cast(pa.int64()).cast(pa.timestamp("ms"))
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return column.cast(pa.timestamp("us"))
+    if pa.types.is_date(column.type):
+        return column.cast(pa.timestamp("ms"))
+    return column
+
+
+class PartitionField:
+    """
+    A single `name=value` directory of a partition, the result of a transform of a source column
+    """
+    name: str
+    transform: PartitionTransform
+    column: str
+    buckets: int | None
+
+    def __init__(self, transform: PartitionTransform, column: str, name: str = None, buckets: int = None):
+        if transform == PartitionTransform.BUCKET and (buckets is None or buckets < 1):
+            raise ValueError(f"bucket transform of '{column}' needs a positive number of buckets")
+        self.transform = transform
+        self.column = column
+        self.buckets = buckets
+        self.name = name if name is not None else (
+            column if transform == PartitionTransform.IDENTITY else f"{column}_{transform.value}")
+
+    def values(self, column: pa.Array | pa.ChunkedArray) -> pa.Array | pa.ChunkedArray:
+        """
+        Returns the partition value of each row of the source column
+        """
+        if self.transform == PartitionTransform.IDENTITY:
+            # URL encoded (like DuckDB, which decodes them when reading hive partitions), so a `/` in a value does not
+            # add a directory
+            values = pc.replace_substring(pc.replace_substring(column.cast(pa.string()), "%", "%25"), "/", "%2F")
+        elif self.transform == PartitionTransform.BUCKET:
+            # Only hash each distinct value once
+            encoded = pc.dictionary_encode(column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column)
+            buckets = pa.array(list(map(lambda x: str(zlib.crc32(str(x).encode()) % self.buckets),
+                                        encoded.dictionary.to_pylist())), pa.string())
+            values = buckets.take(encoded.indices)
+        else:
+            values = pc.strftime(as_timestamps(column), format=TIME_TRANSFORM_FORMATS[self.transform])
+        return pc.fill_null(values, PARTITION_NULL_VALUE)
+
+    def value(self, literal) -> str:
+        """
+        Returns the partition value of a single value of the source column
+        """
+        return self.values(pa.array([literal]))[0].as_py()
+
+    def partition_predicates(self, op: str, value, exact=False) -> list[tuple[str, str, object]] | None:
+        """
+        Maps a predicate on the source column to predicates on the partition value. The returned predicates match
+        every partition that may have a matching row, or with `exact`, only partitions where every row matches.
+
+        Returns None if the predicate cannot be mapped.
+        """
+        if self.transform == PartitionTransform.IDENTITY:
+            return [(self.name, op, value)]
+        if self.transform == PartitionTransform.BUCKET:
+            if exact:
+                return None
+            if op == "=":
+                return [(self.name, "=", self.value(value))]
+            if op == "in":
+                return [(self.name, "in", list(map(self.value, value)))]
+            return None
+
+        # Time transforms keep the order of the source column, but a boundary partition may only partially match
+        if op == "between":
+            low, high = self.value(value[0]), self.value(value[1])
+            return [(self.name, ">", low), (self.name, "<", high)] if exact else [(self.name, "between", (low, high))]
+        if op in ("<", "<="):
+            return [(self.name, "<" if exact else "<=", self.value(value))]
+        if op in (">", ">="):
+            return [(self.name, ">" if exact else ">=", self.value(value))]
+        if op == "=" and not exact:
+            return [(self.name, "=", self.value(value))]
+        if op == "in" and not exact:
+            return [(self.name, "in", list(map(self.value, value)))]
+        return None
+
+    def __str__(self):
+        args = f"{self.buckets}, {self.column}" if self.transform == PartitionTransform.BUCKET else self.column
+        return f"{self.name}={self.transform.value}({args})"
+
+
+class PartitionSpec:
+    """
+    A declarative partition strategy, evaluated in bulk with Arrow compute. Partitions are hive style paths of its
+    fields, e.g. `u=user_a/d=2023-08-19` for `u=identity(user_id)/d=day(ts)`.
+
+    A spec can be used anywhere a partition function can, and lets IceDB map predicates on the source columns to the
+    partitions they touch.
+    """
+    fields: list[PartitionField]
+
+    def __init__(self, fields: list[PartitionField]):
+        if len(fields) == 0:
+            raise ValueError("a partition spec needs at least one field")
+        self.fields = fields
+
+    def partitions(self, table: pa.Table) -> pa.Array | pa.ChunkedArray:
+        """
+        Returns the partition of each row of the table
+        """
+        parts = list(map(lambda x: pc.binary_join_element_wise(x.name + "=", x.values(table.column(x.column)), ""),
+                         self.fields))
+        return pc.binary_join_element_wise(*parts, "/")
+
+    def __call__(self, row: dict) -> str:
+        """
+        Returns the partition of a single row, so the spec can be used as a partition function
+        """
+        return self.partitions(pa.Table.from_pylist([row]))[0].as_py()
+
+    def __str__(self):
+        return "/".join(map(str, self.fields))
+
+
+def PartitionSpecFromString(spec: str) -> PartitionSpec:
+    """
+    Parses a partition spec such as `u=identity(user_id)/d=day(ts)/b=bucket(16, user_id)`. The `name=` of each field
+    is optional.
+    """
+    fields: list[PartitionField] = []
+    for part in spec.split("/"):
+        match = re.fullmatch(r"\s*(?:(\w+)\s*=\s*)?(\w+)\(\s*(?:(\d+)\s*,\s*)?([^(),]+?)\s*\)\s*", part)
+        if match is None:
+            raise ValueError(f"invalid partition field '{part}'")
+        name, transform, buckets, column = match.groups()
+        fields.append(PartitionField(PartitionTransform(transform.lower()), column, name,
+                                     int(buckets) if buckets is not None else None))
+    return PartitionSpec(fields)
+
+
+def check_partitions(partitions: list[str]):
+    """
+    Raises a ValueError if a partition computed by a SQL expression is not a hive style path of `key=value`
+    directories, e.g. because a value contains a `/`, which must be escaped as `%2F` (and `%` as `%25`)
+    """
+    for partition in filter(lambda x: x is not None, partitions):
+        if any(map(lambda x: "=" not in x, partition.split("/"))):
+            raise ValueError(f"invalid partition '{partition}', each directory must be key=value, a '/' in a value "
+                             f"must be escaped as '%2F' (e.g. replace(column, '/', '%2F'))")
+
+
+def partition_value_matches(partition_value: str, op: str, value, exact=False) -> bool:
+    """
+    Whether a partition value matches `value op partition_value`. Partition values are strings, so they are compared
+    as numbers if the predicate is a number. Values that cannot be compared match, unless `exact`.
+    """
+    if partition_value == PARTITION_NULL_VALUE:
+        return False
+    literal = value[0] if op in ("between", "in") and len(value) > 0 else value
+    if isinstance(literal, (int, float, Decimal)) and not isinstance(literal, bool):
+        try:
+            partition_value = float(partition_value)
+        except ValueError:
+            if exact:
+                return False
+    elif exact and not isinstance(zone_map_value(literal), str):
+        return False
+    return zone_map_may_match([partition_value, partition_value, 0], op, value)
+
+
+def partition_matches(partition: str, predicates: list[tuple[str, str, object]], spec: PartitionSpec = None,
+                      exact=False) -> bool:
+    """
+    Whether a partition may have rows matching all predicates, or with `exact`, whether every row matches.
+
+    Predicates on hive style partition keys are checked against the partition value, and predicates on the source
+    column of a spec field are mapped to its partition value. Other predicates are ignored, unless `exact`, where
+    they never match.
+    """
+    partition_values = hive_partition_values(partition)
+    for column, op, value in predicates:
+        mapped = [(column, op, value)] if column in partition_values else []
+        for field in filter(lambda x: x.column == column, spec.fields if spec is not None else []):
+            mapped += field.partition_predicates(op, value, exact) or []
+        if exact and not any(map(lambda x: x[0] in partition_values, mapped)):
+            return False
+        for name, mapped_op, mapped_value in filter(lambda x: x[0] in partition_values, mapped):
+            if not partition_value_matches(partition_values[name], mapped_op, mapped_value, exact):
+                return False
+    return True
@@ -0,0 +1,92 @@
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict
+import duckdb
+
+
+class DuckDBPool:
+    """
+    Thread-safe pool of DuckDB connections. Every connection is a cursor of a single in-memory database that is
+    configured (extensions and S3 settings) once, on first use, so handing out a connection does not reinstall
+    httpfs or set the credentials again.
+
+    Connections are not shared between threads while in use. Up to `max_size` idle connections are kept for reuse,
+    more can be in use at once, but they are closed when released.
+    """
+    setup: Callable[[], duckdb.DuckDBPyConnection]
+    max_size: int
+    created: int
+    reused: int
+
+    def __init__(self, setup: Callable[[], duckdb.DuckDBPyConnection], max_size: int):
+        self.setup = setup
+        self.max_size = max_size
+        self.created = 0
+        self.reused = 0
+        self.__database: duckdb.DuckDBPyConnection | None = None
+        self.__idle: list[duckdb.DuckDBPyConnection] = []
+        self.__in_use = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> duckdb.DuckDBPyConnection:
+        """
+        Returns an idle connection, or a new one if there are none. Must be given back with `release`.
+        """
+        with self.__lock:
+            self.__in_use += 1
+            if len(self.__idle) > 0:
+                self.reused += 1
+                return self.__idle.pop()
+            try:
+                if self.__database is None:
+                    self.__database = self.setup()
+                self.created += 1
+                return self.__database.cursor()
+            except Exception as e:
+                self.__in_use -= 1
+                raise e
+
+    def release(self, conn: duckdb.DuckDBPyConnection):
+        with self.__lock:
+            self.__in_use -= 1
+            if len(self.__idle) < self.max_size:
+                self.__idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager for a pooled connection, e.g. `with pool.connection() as ddb:`
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def metrics(self) -> Dict[str, int]:
+        """
+        Returns the number of connections created and reused, and the number currently idle and in use
+        """
+        with self.__lock:
+            return {
+                "max_size": self.max_size,
+                "created": self.created,
+                "reused": self.reused,
+                "idle": len(self.__idle),
+                "in_use": self.__in_use,
+            }
+
+    def close(self):
+        """
+        Closes the idle connections and the database. Connections in use are closed when released.
+        """
+        with self.__lock:
+            for conn in self.__idle:
+                conn.close()
+            self.__idle = []
+            self.max_size = 0
+            if self.__database is not None:
+                self.__database.close()
+                self.__database = None
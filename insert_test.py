@@ -0,0 +1,266 @@
+import io
+import os
+import json
+import tempfile
+import threading
+from time import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from decimal import Decimal
+from datetime import datetime, timezone, timedelta
+from icedb.icedb import IceDBv3, LoadFormat, ParquetWriter, CompressionCodec
+from icedb.log import S3Client, IceLogIO, FileMarker
+
+s3c = S3Client(s3prefix="insert_test", s3bucket="testbucket", s3region="us-east-1", s3endpoint="http://localhost:9000",
+               s3accesskey="user", s3secretkey="password")
+log = IceLogIO("dan-mbp")
+
+
+def part_func(row: dict) -> str:
+    return f"u={row['user_id']}"
+
+
+def new_log_files(since: list[str]) -> list[str]:
+    _, _, _, log_files = log.read_at_max_time(s3c, 2 ** 62)
+    return list(filter(lambda x: x not in since, log_files))
+
+
+def delete_all():
+    res = s3c.s3.list_objects_v2(Bucket=s3c.s3bucket, MaxKeys=1000, Prefix=s3c.s3prefix)
+    for file in res.get('Contents', []):
+        s3c.s3.delete_object(Bucket=s3c.s3bucket, Key=file['Key'])
+
+
+try:
+    # every concurrent insert below waits in the partition function until all of them are in progress
+    started = threading.Barrier(8)
+    def group_part_func(row: dict) -> str:
+        if row["user_id"] != "a":
+            started.wait(10)
+        return part_func(row)
+
+    ice = IceDBv3(group_part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", s3c, "dan-mbp",
+                  group_commit_ms=10_000)
+    # an insert with no concurrent inserts does not wait for the group commit window
+    start = time()
+    ice.insert([{"user_id": "a", "ts": 0}])
+    assert time() - start < 5
+    before = new_log_files([])
+
+    # concurrent inserts are appended in a single log file, once all of them have joined the group
+    start = time()
+    results = {}
+    def insert(i: int):
+        results[i] = ice.insert([{"user_id": f"user_{i % 3}", "ts": i}])
+    threads = list(map(lambda x: threading.Thread(target=insert, args=(x,)), range(8)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time() - start < 5
+    assert sorted(map(lambda x: len(x), results.values())) == [1] * 8
+    assert len(new_log_files(before)) == 1
+
+    _, file_markers, _, _ = log.read_at_max_time(s3c, 2 ** 62)
+    assert len(file_markers) == 9
+    assert sum(map(lambda x: x.rowCount, file_markers)) == 9
+    ice.close()
+
+    # a stream of dict rows is appended in a single log file
+    ice = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", s3c, "dan-mbp")
+    before = new_log_files([])
+    inserted = ice.insert_stream(map(lambda x: {"user_id": f"user_{x % 2}", "ts": x}, range(1000)), max_rows=300)
+    assert sum(map(lambda x: x.rowCount, inserted)) == 1000
+    assert len(new_log_files(before)) == 1
+
+    # and so is a stream of record batches
+    before = new_log_files([])
+    batches = map(lambda x: pa.record_batch({"user_id": ["a", "b"] * 50, "ts": list(range(x * 100, x * 100 + 100))}),
+                  range(5))
+    inserted = ice.insert_stream(batches, partition_expr="'u=' || user_id")
+    assert sum(map(lambda x: x.rowCount, inserted)) == 500
+    assert sorted(map(lambda x: x.path.split("/")[2], inserted)) == ["u=a", "u=b"]
+    assert len(new_log_files(before)) == 1
+
+    # an empty stream writes nothing
+    before = new_log_files([])
+    assert ice.insert_stream(iter([])) == []
+    assert len(new_log_files(before)) == 0
+
+    # a column added midway is added to the schema
+    before = new_log_files([])
+    rows = list(map(lambda x: {"user_id": "c", "ts": x}, range(10))) + \
+        list(map(lambda x: {"user_id": "c", "ts": x, "event": "click"}, range(10, 20)))
+    inserted = ice.insert_stream(iter(rows), max_rows=5)
+    assert sum(map(lambda x: x.rowCount, inserted)) == 20
+    assert len(new_log_files(before)) == 1
+    schema, _, _, _ = log.read_at_max_time(s3c, 2 ** 62)
+    assert schema["event"] == "VARCHAR"
+
+    # each partition's file only has the columns of its own rows
+    inserted = ice.insert([{"user_id": "f", "ts": 1, "event": "click"}, {"user_id": "g", "ts": 2},
+                           {"user_id": "g", "ts": 3, "country": None}])
+    file_columns = dict(map(lambda x: (x.path.split("/")[2], pq.read_schema(io.BytesIO(s3c.s3.get_object(
+        Bucket=s3c.s3bucket, Key=x.path)["Body"].read())).names), inserted))
+    assert sorted(file_columns["u=f"]) == ["event", "ts", "user_id"], file_columns
+    assert sorted(file_columns["u=g"]) == ["country", "ts", "user_id"], file_columns
+
+    # a column that is an int in some chunks and a float in others is written as a float
+    before = new_log_files([])
+    batches = iter([pa.record_batch({"user_id": ["h"] * 3, "ts": [0, 1, 2], "value": [0, 1, 2]}),
+                    pa.record_batch({"user_id": ["h"] * 2, "ts": [3, 4], "value": [3.5, 4.5]}),
+                    pa.record_batch({"user_id": ["h"], "ts": [5], "value": [None]})])
+    inserted = ice.insert_stream(batches, partition_expr="'u=' || user_id")
+    assert len(inserted) == 1 and inserted[0].rowCount == 6
+    assert len(new_log_files(before)) == 1
+    schema, _, _, _ = log.read_at_max_time(s3c, 2 ** 62)
+    assert schema["value"] == "DOUBLE"
+    table = pq.read_table(io.BytesIO(s3c.s3.get_object(Bucket=s3c.s3bucket, Key=inserted[0].path)["Body"].read()))
+    assert table.column("value").to_pylist() == [0.0, 1.0, 2.0, 3.5, 4.5, None]
+    batches = iter([pa.record_batch({"user_id": ["h"], "ts": [1], "value": [1]}),
+                    pa.record_batch({"user_id": ["h"], "ts": [2], "value": ["x"]})])
+    try:
+        ice.insert_stream(batches, partition_expr="'u=' || user_id")
+        raise AssertionError("expected an ArrowTypeError")
+    except pa.ArrowTypeError:
+        pass
+
+    # a / in a loaded partition value must be escaped, rather than adding a directory
+    local_dir = tempfile.mkdtemp()
+    with open(os.path.join(local_dir, "rows.json"), "w") as f:
+        f.write("\n".join(map(json.dumps, [{"user_id": "c/d", "ts": 1}, {"user_id": "e", "ts": 2}])))
+    try:
+        ice.load_files(os.path.join(local_dir, "rows.json"), LoadFormat.JSON, "'u=' || user_id || '/d=1'")
+        raise AssertionError("expected a ValueError")
+    except ValueError:
+        pass
+    inserted = ice.load_files(os.path.join(local_dir, "rows.json"), LoadFormat.JSON,
+                              "'u=' || replace(user_id, '/', '%2F') || '/d=1'")
+    assert sorted(map(lambda x: x.path.split("/", 2)[2].rsplit("/", 1)[0], inserted)) == ["u=c%2Fd/d=1", "u=e/d=1"]
+    ice.close()
+
+    # files written with the pyarrow writer round trip, are as large as their file markers say, and are uploaded in
+    # parts when larger than multipart_chunksize
+    writer_s3c = S3Client(s3prefix="insert_test_writer", s3bucket="testbucket", s3region="us-east-1",
+                          s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+    ice = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", writer_s3c, "dan-mbp",
+                  parquet_writer=ParquetWriter.PYARROW, compression_codec=CompressionCodec.UNCOMPRESSED,
+                  multipart_chunksize=5 * 1024 * 1024)
+    s3_calls = []
+    for call in ["PutObject", "CreateMultipartUpload", "UploadPart"]:
+        writer_s3c.s3.meta.events.register(f"before-call.s3.{call}", lambda model, **kwargs: s3_calls.append(model.name))
+    small_rows = list(map(lambda x: {"user_id": "small", "ts": x, "value": x / 2, "tags": ["a", str(x)],
+                                     "event": None if x % 3 == 0 else f"event_{x}"}, range(1000)))
+    large_rows = list(map(lambda x: {"user_id": "large", "ts": x, "value": x / 2, "tags": [],
+                                     "event": os.urandom(100).hex()}, range(40_000)))
+    inserted = ice.insert(small_rows + large_rows)
+    # the small file and the log file are single requests
+    assert s3_calls.count("PutObject") == 2 and s3_calls.count("CreateMultipartUpload") == 1, s3_calls
+    assert s3_calls.count("UploadPart") >= 2, s3_calls
+    for file_marker in inserted:
+        body = writer_s3c.s3.get_object(Bucket=writer_s3c.s3bucket, Key=file_marker.path)["Body"].read()
+        assert file_marker.fileBytes == len(body)
+        assert writer_s3c.s3.head_object(Bucket=writer_s3c.s3bucket, Key=file_marker.path)["ContentLength"] == \
+            file_marker.fileBytes
+        rows = pq.read_table(io.BytesIO(body)).to_pylist()
+        expected = small_rows if "u=small" in file_marker.path else large_rows
+        assert file_marker.rowCount == len(expected)
+        assert rows == expected
+    assert max(map(lambda x: x.fileBytes, inserted)) > 5 * 1024 * 1024
+    ice.close()
+
+    # bloom filters are written for bloom_filter_columns, and page indexes for every column with write_page_index
+    ice = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", writer_s3c, "dan-mbp",
+                  parquet_writer=ParquetWriter.PYARROW, bloom_filter_columns=["event"], write_page_index=True)
+    inserted = ice.insert(small_rows)
+    metadata = pq.read_metadata(io.BytesIO(writer_s3c.s3.get_object(Bucket=writer_s3c.s3bucket,
+                                                                    Key=inserted[0].path)["Body"].read()))
+    for i in range(metadata.num_columns):
+        column = metadata.row_group(0).column(i)
+        assert column.has_column_index and column.has_offset_index, column.path_in_schema
+        assert (column.bloom_filter_offset is not None) == (column.path_in_schema == "event"), column.path_in_schema
+    ice.close()
+
+    # get_files prunes files with partition values and the zone maps of the sort order columns
+    files_s3c = S3Client(s3prefix="insert_test_files", s3bucket="testbucket", s3region="us-east-1",
+                         s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+    ice = IceDBv3(part_func, ['ts', 'amount'], "us-east-1", "user", "password", "http://localhost:9000", files_s3c,
+                  "dan-mbp")
+    utc = timezone.utc
+    files_schema = pa.schema([("user_id", pa.string()), ("ts", pa.timestamp("us", tz="UTC")),
+                              ("amount", pa.decimal128(10, 2))])
+    insert_rows = lambda rows: ice.insert_arrow(pa.Table.from_pylist(rows, schema=files_schema),
+                                                "'u=' || user_id")[0].path
+    a1 = insert_rows([{"user_id": "a", "ts": datetime(2024, 1, 1, tzinfo=utc), "amount": Decimal("9.50")},
+                      {"user_id": "a", "ts": datetime(2024, 1, 2, tzinfo=utc), "amount": Decimal("10.50")}])
+    a2 = insert_rows([{"user_id": "a", "ts": datetime(2024, 2, 1, tzinfo=utc), "amount": Decimal("100.00")},
+                      {"user_id": "a", "ts": datetime(2024, 2, 2, tzinfo=utc), "amount": Decimal("200.00")}])
+    b1 = insert_rows([{"user_id": "b", "ts": datetime(2024, 1, 1, tzinfo=utc), "amount": Decimal("50.00")}])
+    # a file without a zone map (e.g. written by an older version) may match anything
+    schema, _, _, _ = log.read_at_max_time(files_s3c, 2 ** 62)
+    no_zone_map = "insert_test_files/_data/u=a/no_zone_map.parquet"
+    log.append(files_s3c, 1, schema, [FileMarker(no_zone_map, 0, 1)])
+
+    get_files = lambda *predicates, **kwargs: sorted(ice.get_files(predicates=list(predicates), **kwargs))
+    assert get_files() == sorted([a1, a2, b1, no_zone_map])
+    assert get_files(("amount", "=", Decimal("10"))) == sorted([a1, no_zone_map])
+    assert get_files(("amount", "=", 10)) == sorted([a1, no_zone_map])
+    assert get_files(("amount", "in", [Decimal("150"), Decimal("1")])) == sorted([a2, no_zone_map])
+    assert get_files(("ts", "between", (datetime(2024, 1, 15, tzinfo=utc), datetime(2024, 2, 15, tzinfo=utc)))) == \
+        sorted([a2, no_zone_map])
+    # timestamps are compared in UTC, and ISO strings are parsed
+    assert get_files(("ts", ">", datetime(2024, 1, 1, 20, tzinfo=timezone(timedelta(hours=-5))))) == \
+        sorted([a2, no_zone_map])
+    assert get_files(("ts", "<", "2024-01-01T12:00:00+00:00")) == sorted([a1, b1, no_zone_map])
+    # a naive timestamp cannot be compared with a timezone aware one, so every file may match
+    assert get_files(("ts", "=", datetime(2030, 1, 1))) == sorted([a1, a2, b1, no_zone_map])
+    # partition predicates, and predicates on columns without statistics
+    assert get_files(("user_id", "=", "b")) == sorted([a1, a2, b1, no_zone_map])
+    assert get_files(("u", "=", "b")) == [b1]
+    assert get_files(("u", "in", ["a", "c"]), ("amount", ">=", 150)) == sorted([a2, no_zone_map])
+    assert get_files(("u", "=", "b"), ("amount", "<", 10)) == []
+    assert get_files(("event", "=", "click")) == sorted([a1, a2, b1, no_zone_map])
+    assert get_files(partition_filter=lambda x: x == "u=b") == [b1]
+    ice.close()
+
+    # partitions over max_rows_per_file or target_file_bytes are split into files of about the same size, which cover
+    # consecutive ranges of the sort order
+    split_s3c = S3Client(s3prefix="insert_test_split", s3bucket="testbucket", s3region="us-east-1",
+                         s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+
+    def assert_split(inserted: list, files: int, rows: int):
+        assert len(inserted) == files
+        row_counts = list(map(lambda x: x.rowCount, inserted))
+        assert sum(row_counts) == rows
+        assert max(row_counts) - min(row_counts) <= 1
+        ranges = sorted(map(lambda x: (x.zoneMap["ts"][0], x.zoneMap["ts"][1]), inserted))
+        for (_, prev_max), (next_min, _) in zip(ranges, ranges[1:]):
+            assert prev_max < next_min
+        for file_marker in inserted:
+            table = pq.read_table(io.BytesIO(split_s3c.s3.get_object(Bucket=split_s3c.s3bucket,
+                                                                     Key=file_marker.path)["Body"].read()))
+            assert table.num_rows == file_marker.rowCount
+            assert table.column("ts").to_pylist() == sorted(table.column("ts").to_pylist())
+            assert [min(table.column("ts").to_pylist()), max(table.column("ts").to_pylist())] == \
+                file_marker.zoneMap["ts"][:2]
+
+    # rows are shuffled, so only sorting the partition before splitting gives non-overlapping files
+    shuffled = list(map(lambda x: (x * 7919) % 1000, range(1000)))
+    ice = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", split_s3c, "dan-mbp",
+                  max_rows_per_file=300)
+    inserted = ice.insert(list(map(lambda x: {"user_id": "a", "ts": x}, shuffled)) +
+                          list(map(lambda x: {"user_id": "b", "ts": x}, range(100))))
+    assert_split(list(filter(lambda x: "/u=a/" in x.path, inserted)), 4, 1000)
+    # a partition under the limit is written to a single file
+    assert_split(list(filter(lambda x: "/u=b/" in x.path, inserted)), 1, 100)
+    ice.close()
+
+    table = pa.table({"user_id": ["c"] * 1000, "ts": pa.array(shuffled, pa.int64())})
+    ice = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", split_s3c, "dan-mbp",
+                  target_file_bytes=table.nbytes * 3 // 10)
+    assert_split(ice.insert_arrow(table, partition_expr="'u=' || user_id"), 4, 1000)
+    ice.close()
+
+    print("passed!")
+finally:
+    delete_all()
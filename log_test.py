@@ -1,5 +1,8 @@
-from icedb.log import IceLogIO, Schema, FileMarker, LogTombstone, S3Client
+from icedb.log import IceLogIO, Schema, FileMarker, LogTombstone, S3Client, LogState, LogReadEngine, zone_map_stats, \
+    zone_map_may_match, combine_zone_maps
 from time import time
+from decimal import Decimal
+from datetime import datetime, timezone, timedelta
 
 s3c = S3Client(s3prefix="tenant", s3bucket="testbucket", s3region="us-east-1", s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
 
@@ -7,13 +10,15 @@ log = IceLogIO("dan-mbp")
 
 # create a log file
 sch = Schema()
-logFile = log.append(s3c, 1, sch.accumulate(["a", "b"], ["VARCHAR", "BIGINT"]), [FileMarker(
+sch.accumulate(["a", "b"], ["VARCHAR", "BIGINT"])
+logFile, _ = log.append(s3c, 1, sch, [FileMarker(
     "tenant/_data/d=2023-08-04/a.parquet", time()-10 * 1000, 123), FileMarker("tenant/_data/d=2023-08-04/b.parquet", time()-11 * 1000, 234), FileMarker("tenant/_data/d=2023-08-04/inevershow.parquet", time()-12 * 1000, 345), FileMarker("tenant/_data/d=2023-08-04/inevershoweither.parquet", time()-12 * 1000, 345)])
 print("created log file", logFile)
 
 # pretend inevershow* merged into something
 sch = Schema()
-logFile = log.append(s3c, 1, sch.accumulate(["a", "b", "c"], ["VARCHAR", "BIGINT", "BIGINT"]), [
+sch.accumulate(["a", "b", "c"], ["VARCHAR", "BIGINT", "BIGINT"])
+logFile, _ = log.append(s3c, 1, sch, [
     FileMarker("tenant/_data/d=2023-08-04/a.parquet", round(time()-10 * 1000), 123),
     FileMarker("tenant/_data/d=2023-08-04/b.parquet", round(time()-11 * 1000), 234),
     FileMarker("tenant/_data/d=2023-08-05/c.parquet", round(time()-5 * 1000), 123),
@@ -30,8 +35,145 @@ print(s1.toJSON())
 print(f1)
 print(t1)
 print(l1)
+
+# read through a cached state, then again after a new log file
+state = LogState()
+s2, f2, t2, l2 = log.read_at_max_time(s3c, round(time() * 1000), state)
+assert sorted(map(lambda x: x.path, f2)) == sorted(map(lambda x: x.path, f1))
+assert l2 == sorted(l1)
+logFile = log.append(s3c, 1, sch, [FileMarker("tenant/_data/d=2023-08-06/f.parquet", round(time() * 1000), 123)])
+s2, f2, t2, l2 = log.read_at_max_time(s3c, round(time() * 1000) + 1, state)
+assert len(f2) == len(f1) + 1
+assert len(l2) == len(l1) + 1
+
+# a checkpoint should give the same state, and the log files it folds should not be read again
+checkpoint, _ = log.write_checkpoint(s3c)
+print("created checkpoint", checkpoint)
+s3, f3, t3, l3 = log.read_at_max_time(s3c, round(time() * 1000) + 1)
+assert sorted(map(lambda x: str(x), f3)) == sorted(map(lambda x: str(x), f2))
+assert sorted(l3) == l2
+
+# reading a single partition should only return its file markers
+s4, f4, t4, l4 = log.read_partitions(s3c, ["d=2023-08-05"], round(time() * 1000) + 1)
+assert sorted(map(lambda x: str(x), f4)) == sorted(map(lambda x: str(x), filter(lambda x: "d=2023-08-05/" in x.path, f2)))
+
+# the arrow engine should give the same state
+s5, f5, t5, l5 = IceLogIO("dan-mbp", engine=LogReadEngine.ARROW).read_at_max_time(s3c, round(time() * 1000) + 1)
+assert sorted(map(lambda x: str(x), f5)) == sorted(map(lambda x: str(x), f2))
+assert s5.toJSON() == s2.toJSON()
 # s2, f2, t2 = log.readAtMaxTime(s3c, time()-9*1000)
 
+# a partition index larger than the first ranged GET should not cause the whole log file to be fetched
+manyLogFile, _ = log.append(s3c, 1, sch, list(map(lambda x: FileMarker(
+    f"tenant/_data/user=user_{x:05d}/d=2023-08-04/file_{x:05d}.parquet", round(time() * 1000), 123), range(3000))))
+fetched = []
+get_object = s3c.s3.get_object
+def counting_get_object(**kwargs):
+    obj = get_object(**kwargs)
+    fetched.append(obj['ContentLength'])
+    return obj
+s3c.s3.get_object = counting_get_object
+_, _, _, fm6 = log.read_log_file(s3c, manyLogFile, ["user=user_01500/d=2023-08-04"])
+s3c.s3.get_object = get_object
+assert list(map(lambda x: x.path, fm6)) == ["tenant/_data/user=user_01500/d=2023-08-04/file_01500.parquet"]
+manyLogFileBytes = s3c.s3.head_object(Bucket=s3c.s3bucket, Key=manyLogFile)['ContentLength']
+assert manyLogFileBytes > 2 * 64 * 1024
+assert len(fetched) <= 3 and sum(fetched) < manyLogFileBytes, fetched
+
+# a merged log written before merged logs carried forward every file marker (like an older remove_partitions, which
+# only carried forward the removed files) must not cause the log file it tombstones to be skipped
+oldLog = IceLogIO("old-host")
+removedLogFile, _ = oldLog.append(s3c, 1, sch, [
+    FileMarker("tenant/_data/d=2023-08-07/removed.parquet", round(time() * 1000), 123),
+    FileMarker("tenant/_data/d=2023-08-08/kept.parquet", round(time() * 1000), 123)])
+oldLog.append(s3c, 1, sch, [FileMarker("tenant/_data/d=2023-08-07/removed.parquet", round(time() * 1000), 123,
+                                       round(time() * 1000))],
+              [LogTombstone(removedLogFile, round(time() * 1000))], merged=True, timestamp=round(time() * 1000) + 1)
+for engine in [LogReadEngine.PYTHON, LogReadEngine.ARROW]:
+    s7, f7, t7, l7 = IceLogIO("dan-mbp", engine=engine).read_at_max_time(s3c, round(time() * 1000) + 2)
+    alive7 = list(map(lambda x: x.path, filter(lambda x: x.tombstone is None, f7)))
+    assert "tenant/_data/d=2023-08-08/kept.parquet" in alive7, engine
+    assert "tenant/_data/d=2023-08-07/removed.parquet" not in alive7, engine
+s7, f7, t7, l7 = log.read_at_max_time(s3c, round(time() * 1000) + 2, state)
+assert "tenant/_data/d=2023-08-08/kept.parquet" in map(lambda x: x.path, filter(lambda x: x.tombstone is None, f7))
+
+# version 2 log files round trip, can be mixed with version 1 log files, and are read by both engines
+s3v2 = S3Client(s3prefix="tenant_v2", s3bucket="testbucket", s3region="us-east-1", s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+v1File, _ = log.append(s3v2, 1, sch, [
+    FileMarker("tenant_v2/_data/d=2023-08-04/a.parquet", round(time() * 1000), 123, rowCount=10, zoneMap={"b": [1, 5, 0]}),
+    FileMarker("tenant_v2/_data/d=2023-08-04/b.parquet", round(time() * 1000), 234)])
+v2Markers = [
+    FileMarker("tenant_v2/_data/d=2023-08-04/b.parquet", round(time() * 1000), 234, round(time() * 1000)),
+    FileMarker("tenant_v2/_data/d=2023-08-05/c.parquet", round(time() * 1000), 345, rowCount=3, zoneMap={"a": ["x", "y", 1]}),
+    FileMarker("root.parquet", round(time() * 1000), 456)]
+v2File, _ = log.append(s3v2, 2, sch, v2Markers, [LogTombstone(v1File, round(time() * 1000))], merged=True,
+                       timestamp=round(time() * 1000) + 1)
+assert v2File.endswith(".log")
+m8, s8, t8, f8 = log.read_log_file(s3v2, v2File)
+assert m8.version == 2
+assert s8 == {"a": "VARCHAR", "b": "BIGINT", "c": "BIGINT"}
+assert list(map(lambda x: x.path, t8)) == [v1File]
+assert list(map(lambda x: x.json(), f8)) == list(map(lambda x: x.json(), v2Markers))
+v2Alive = ["root.parquet", "tenant_v2/_data/d=2023-08-04/a.parquet", "tenant_v2/_data/d=2023-08-05/c.parquet"]
+for engine in [LogReadEngine.PYTHON, LogReadEngine.ARROW]:
+    s9, f9, t9, l9 = IceLogIO("dan-mbp", engine=engine).read_at_max_time(s3v2, round(time() * 1000) + 2)
+    assert sorted(l9) == [v1File, v2File], engine
+    assert sorted(map(lambda x: x.path, filter(lambda x: x.tombstone is None, f9))) == v2Alive, engine
+    assert list(map(lambda x: x.zoneMap, filter(lambda x: x.path.endswith("c.parquet"), f9))) == [{"a": ["x", "y", 1]}]
+s9, f9, t9, l9 = log.read_at_max_time(s3v2, round(time() * 1000) + 2, LogState())
+assert sorted(map(lambda x: x.path, filter(lambda x: x.tombstone is None, f9))) == v2Alive
+
+# a version 2 checkpoint stores the source log file of each marker in the l column
+v2Checkpoint, _ = log.write_checkpoint(s3v2, round(time() * 1000) + 2, version=2)
+assert v2Checkpoint.endswith(".log")
+_, f10, _, l10 = log.read_checkpoint(s3v2, v2Checkpoint)
+assert sorted(l10) == [v1File, v2File]
+assert sorted(map(lambda x: (x.path, x.vir_source_log_file), f10)) == sorted(map(lambda x: (x.path, x.vir_source_log_file), f9))
+for engine in [LogReadEngine.PYTHON, LogReadEngine.ARROW]:
+    s11, f11, t11, l11 = IceLogIO("dan-mbp", engine=engine).read_at_max_time(s3v2, round(time() * 1000) + 2)
+    assert sorted(map(lambda x: x.json(), f11)) == sorted(map(lambda x: x.json(), f9)), engine
+
+# a log file tombstoned by an already applied merged log that does not carry it forward must still be read, whether
+# the merged log was applied by a cached state or folded into a checkpoint
+s3cf = S3Client(s3prefix="tenant_cf", s3bucket="testbucket", s3region="us-east-1", s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+lateTs = round(time() * 1000)
+lateLogFile = f"tenant_cf/_log/{lateTs}_late-host.jsonl"
+log.append(s3cf, 1, sch, [FileMarker("tenant_cf/_data/d=2023-08-09/old.parquet", round(time() * 1000), 123,
+                                     round(time() * 1000))],
+           [LogTombstone(lateLogFile, round(time() * 1000))], merged=True, timestamp=lateTs + 1)
+cfState = LogState()
+log.read_at_max_time(s3cf, round(time() * 1000) + 2, cfState)
+cfCheckpoint, _ = log.write_checkpoint(s3cf, round(time() * 1000) + 2)
+assert IceLogIO("late-host").append(s3cf, 1, sch, [
+    FileMarker("tenant_cf/_data/d=2023-08-09/late.parquet", round(time() * 1000), 123)], timestamp=lateTs)[0] == lateLogFile
+s12, f12, t12, l12 = log.read_at_max_time(s3cf, round(time() * 1000) + 2, cfState)
+assert "tenant_cf/_data/d=2023-08-09/late.parquet" in map(lambda x: x.path, f12)
+for engine in [LogReadEngine.PYTHON, LogReadEngine.ARROW]:
+    s12, f12, t12, l12 = IceLogIO("dan-mbp", engine=engine).read_at_max_time(s3cf, round(time() * 1000) + 2)
+    assert "tenant_cf/_data/d=2023-08-09/late.parquet" in map(lambda x: x.path, f12), engine
+
+# zone maps of decimals and timestamps are compared as their type, and survive a round trip through both engines
+decimalStats = zone_map_stats(Decimal("9.50"), Decimal("10.50"), 0)
+assert decimalStats == ["9.50", "10.50", 0, "decimal"]
+assert zone_map_may_match(decimalStats, "=", Decimal("10"))
+assert not zone_map_may_match(decimalStats, ">", 11)
+tsStats = zone_map_stats(datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 2, tzinfo=timezone.utc), 0)
+assert not zone_map_may_match(tsStats, ">", datetime(2024, 1, 1, 20, tzinfo=timezone(timedelta(hours=-5))))
+assert zone_map_may_match(tsStats, "<", "2024-01-01T01:00:00+00:00")
+assert zone_map_may_match(tsStats, "=", datetime(2030, 1, 1))  # naive, cannot be compared
+assert zone_map_stats(b"a", b"b", 0) is None
+_, combined = combine_zone_maps([FileMarker("a", 0, 1, rowCount=1, zoneMap={"d": decimalStats}),
+                                 FileMarker("b", 0, 1, rowCount=1, zoneMap={"d": zone_map_stats(Decimal("100"), Decimal("200"), 1)})])
+assert combined == {"d": ["9.50", "200", 1, "decimal"]}
+s3z = S3Client(s3prefix="tenant_z", s3bucket="testbucket", s3region="us-east-1", s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+zoneMap = {"d": decimalStats, "ts": tsStats, "s": ["a}, \"l\": 1}", "z", 2]}
+log.append(s3z, 1, sch, [FileMarker("tenant_z/_data/d=2023-08-04/a.parquet", round(time() * 1000), 123, rowCount=3, zoneMap=zoneMap),
+                         FileMarker("tenant_z/_data/d=2023-08-04/b.parquet", round(time() * 1000), 123)])
+for engine in [LogReadEngine.PYTHON, LogReadEngine.ARROW]:
+    _, f13, _, _ = IceLogIO("dan-mbp", engine=engine).read_at_max_time(s3z, round(time() * 1000) + 1)
+    assert sorted(map(lambda x: (x.path, x.zoneMap), f13)) == [("tenant_z/_data/d=2023-08-04/a.parquet", zoneMap),
+                                                              ("tenant_z/_data/d=2023-08-04/b.parquet", None)], engine
+
 logFiles = s3c.s3.list_objects_v2(
     Bucket=s3c.s3bucket,
     MaxKeys=1000,
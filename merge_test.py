@@ -0,0 +1,78 @@
+from icedb.icedb import IceDBv3
+from icedb.log import S3Client, IceLogIO, LogState
+
+s3c = S3Client(s3prefix="merge_test", s3bucket="testbucket", s3region="us-east-1", s3endpoint="http://localhost:9000",
+               s3accesskey="user", s3secretkey="password")
+log = IceLogIO("dan-mbp")
+
+
+def part_func(row: dict) -> str:
+    return f"u={row['user_id']}"
+
+
+def delete_all():
+    res = s3c.s3.list_objects_v2(Bucket=s3c.s3bucket, MaxKeys=1000, Prefix=s3c.s3prefix)
+    for file in res.get('Contents', []):
+        s3c.s3.delete_object(Bucket=s3c.s3bucket, Key=file['Key'])
+
+
+ice = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", s3c, "dan-mbp",
+              s3_use_path=True)
+
+try:
+    # 3 files in each of 3 partitions, and a partition with a single file
+    for i in range(3):
+        ice.insert(list(map(lambda x: {"user_id": x, "ts": i, "event": "click"}, ["a", "b", "c"])))
+    ice.insert([{"user_id": "d", "ts": 0, "event": "click"}])
+    _, _, _, before = log.read_at_max_time(s3c, 2 ** 62)
+
+    # every partition with more than one file is merged, in a single log file
+    new_log, new_file_markers, merged_file_markers, meta = ice.merge_all()
+    assert new_log is not None
+    assert len(new_file_markers) == 3
+    assert len(merged_file_markers) == 9
+    assert sorted(map(lambda x: x.path.split("/")[2], new_file_markers)) == ["u=a", "u=b", "u=c"]
+
+    _, file_markers, _, log_files = log.read_at_max_time(s3c, 2 ** 62)
+    assert list(filter(lambda x: x not in before, log_files)) == [new_log]
+    alive = list(filter(lambda x: x.tombstone is None, file_markers))
+    assert len(alive) == 4
+    assert sum(map(lambda x: x.rowCount, alive)) == 10
+    merged = dict.fromkeys(map(lambda x: x.path, merged_file_markers), True)
+    assert all(map(lambda x: x.tombstone is not None, filter(lambda x: x.path in merged, file_markers)))
+
+    # nothing left to merge
+    new_log, new_file_markers, merged_file_markers, meta = ice.merge_all()
+    assert new_log is None and new_file_markers == [] and merged_file_markers == []
+
+    # only up to max_partitions partitions are merged
+    ice.insert(list(map(lambda x: {"user_id": x, "ts": 3, "event": "click"}, ["a", "b", "c"])))
+    new_log, new_file_markers, merged_file_markers, meta = ice.merge_all(max_partitions=1)
+    assert len(new_file_markers) == 1 and len(merged_file_markers) == 2
+
+    # a cached state must notice when another process cleans up the log, rather than keep returning deleted files
+    _, cached_file_markers, _, _ = log.read_at_max_time(s3c, 2 ** 62, ice.log_state)
+    no_lookback = LogState(lookback_ms=0)
+    log.read_at_max_time(s3c, 2 ** 62, no_lookback)
+    other = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", s3c, "other",
+                    s3_use_path=True)
+    try:
+        _, deleted_log_files, deleted_data_files = other.tombstone_cleanup(0)
+        assert len(deleted_data_files) > 0
+        assert all(map(lambda x: x in map(lambda y: y.path, cached_file_markers), deleted_data_files))
+        _, file_markers, _, log_files = log.read_at_max_time(s3c, 2 ** 62, ice.log_state)
+        deleted = dict.fromkeys(deleted_data_files + deleted_log_files, True)
+        assert not any(map(lambda x: x.path in deleted, file_markers))
+        assert not any(map(lambda x: x in deleted, log_files))
+
+        # without a lookback window the deleted log files are not noticed, but the checkpoint written afterwards is
+        other.checkpoint()
+        _, file_markers, _, _ = log.read_at_max_time(s3c, 2 ** 62, no_lookback)
+        assert not any(map(lambda x: x.path in deleted, file_markers))
+    finally:
+        other.close()
+
+    print("passed!")
+finally:
+    ice.close()
+    delete_all()
@@ -0,0 +1,41 @@
+from datetime import datetime
+import pyarrow as pa
+from icedb.partition import PartitionSpecFromString, partition_matches, check_partitions
+
+spec = PartitionSpecFromString("u=identity(user_id)/d=day(ts)")
+assert str(spec) == "u=identity(user_id)/d=day(ts)"
+
+# ts is unix ms
+parts = spec.partitions(pa.table({"user_id": ["a", None], "ts": [1692403200000, 1692489600000]}))
+assert parts.to_pylist() == ["u=a/d=2023-08-19", "u=__HIVE_DEFAULT_PARTITION__/d=2023-08-20"]
+assert spec({"user_id": "a", "ts": 1692403200000}) == "u=a/d=2023-08-19"
+
+# the same value is always in the same bucket
+bucket = PartitionSpecFromString("b=bucket(16, user_id)")
+assert bucket.partitions(pa.table({"user_id": ["a", "b", "a"]})).to_pylist()[0] == bucket({"user_id": "a"})
+
+# predicates on the source column map to the partitions they may touch
+assert partition_matches("u=a/d=2023-08-19", [("ts", "<", datetime(2023, 8, 19, 12))], spec)
+assert not partition_matches("u=a/d=2023-08-19", [("ts", ">=", datetime(2023, 8, 20))], spec)
+assert not partition_matches("u=a/d=2023-08-19", [("user_id", "=", "b")], spec)
+
+# or only the partitions where every row matches
+assert not partition_matches("u=a/d=2023-08-19", [("ts", "<", datetime(2023, 8, 19, 12))], spec, True)
+assert partition_matches("u=a/d=2023-08-19", [("ts", "<", datetime(2023, 8, 20))], spec, True)
+assert not partition_matches("u=a/d=2023-08-19", [("event", "=", "click")], spec, True)
+
+# a / or % in an identity value is escaped, so it does not add a directory, and predicates match the original value
+parts = spec.partitions(pa.table({"user_id": ["c/d", "50%"], "ts": [1692403200000, 1692403200000]}))
+assert parts.to_pylist() == ["u=c%2Fd/d=2023-08-19", "u=50%25/d=2023-08-19"]
+assert partition_matches("u=c%2Fd/d=2023-08-19", [("user_id", "=", "c/d")], spec)
+assert not partition_matches("u=c%2Fd/d=2023-08-19", [("user_id", "=", "c")], spec)
+
+# partitions computed by an expression must be key=value directories
+check_partitions(["u=c%2Fd/d=1", None])
+try:
+    check_partitions(["u=c/d/d=1"])
+    raise AssertionError("expected a ValueError")
+except ValueError:
+    pass
+
+print("passed!")
@@ -1,36 +1,8 @@
-from icedb.icedb import IceDBv3, S3Client
-import csv, os
+from icedb.icedb import IceDBv3, S3Client, LoadFormat
+import os
 from time import time
 from datetime import datetime
 
-csv_headers = [
-    'Trip ID',
-    'Taxi ID',
-    'Trip Start Timestamp',
-    'Trip End Timestamp',
-    'Trip Seconds',
-    'Trip Miles',
-    'Pickup Census Tract',
-    'Dropoff Census Tract',
-    'Pickup Community Area',
-    'Dropoff Community Area',
-    'Fare',
-    'Tips',
-    'Tolls',
-    'Extras',
-    'Trip Total',
-    'Payment Type',
-    'Company',
-    'Pickup Centroid Latitude',
-    'Pickup Centroid Longitude',
-    'Pickup Centroid Location',
-    'Dropoff Centroid Latitude',
-    'Dropoff Centroid Longitude',
-    'Dropoff Centroid  Location'
-]
-
-flush_limit = 1_000_000
-
 
 def part_func(row: dict) -> str:
     # Normally you should parse this with datetime package and
@@ -56,40 +28,18 @@ ice = IceDBv3(
     row_group_size=8192
 )
 
-# Let's create a row buffer to batch inserts into icedb
-row_buf = []
-
-
-def flush_row_buf():
-    s = time()
-    files = ice.insert(row_buf)
-    print(f"flushed {len(row_buf)} rows and {len(files)} files in {time() - s} seconds")
-
-
 start = time()
 
-# Open the csv file for reading
-with open('chicago_taxis.csv') as csvfile:
-    lr = csv.reader(csvfile, delimiter=',')
-    next(lr, None)  # skip headers
-    for row in lr:
-        # convert timestamp to unix seconds
-        d = dict(zip(csv_headers, row))  # convert to a dict with the CSV headers as keys
-        trip_start: str = d['Trip Start Timestamp']
-        if trip_start[4] == '-':  # 2015-05-07 20:30:00 UTC
-            dt = datetime.strptime(trip_start, '%Y-%m-%d %H:%M:%S %Z')
-            d['Trip Start Timestamp'] = int(dt.timestamp() * 1000)
-        else:
-            dt = datetime.strptime(trip_start, '%m/%d/%Y %H:%M:%S %p')  # 05/09/2014 07:30:00 PM
-            d['Trip Start Timestamp'] = int(dt.timestamp() * 1000)
-        row_buf.append(d)
-        if len(row_buf) >= flush_limit:
-            flush_row_buf()
-            row_buf = []
-
-    if len(row_buf) > 0:
-        print(f'performing a final flush of {len(row_buf)} rows')
-        flush_row_buf()
-        row_buf = []
+# DuckDB reads and converts the CSV, so no rows pass through Python
+files = ice.load_files(
+    'chicago_taxis.csv',
+    LoadFormat.CSV,
+    partition_expr="""strftime(epoch_ms("Trip Start Timestamp"), 'd=%Y-%m')""",
+    # Timestamps are either 2015-05-07 20:30:00 UTC or 05/09/2014 07:30:00 PM, convert them to unix ms
+    transforms_sql="""* replace (epoch_ms(coalesce(
+        try_strptime("Trip Start Timestamp"::VARCHAR, '%Y-%m-%d %H:%M:%S UTC'),
+        try_strptime("Trip Start Timestamp"::VARCHAR, '%m/%d/%Y %I:%M:%S %p')
+    )) as "Trip Start Timestamp")"""
+)
 
-print(f"done in {time() - start} seconds")
+print(f"loaded {len(files)} files in {time() - start} seconds")
@@ -31,8 +31,8 @@ ice = IceDBv3(
 start = time()
 while True:
     s = time()
-    _, _, partition, merged_file_markers, _ = ice.merge(max_file_size=100_000_000, max_file_count=40)
-    if partition is None:
+    _, new_file_markers, merged_file_markers, _ = ice.merge_all(max_file_size=100_000_000, max_file_count=40)
+    if len(new_file_markers) == 0:
         break
-    print(f"Merged partition {partition} with {len(merged_file_markers)} files in {time()-s} seconds")
+    print(f"Merged {len(merged_file_markers)} files into {len(new_file_markers)} in {time()-s} seconds")
 print(f"done in {time()-start} seconds")
\ No newline at end of file
@@ -0,0 +1,84 @@
+import threading
+import duckdb
+import pyarrow as pa
+from icedb.pool import DuckDBPool
+
+setups = []
+
+
+def setup() -> duckdb.DuckDBPyConnection:
+    setups.append(True)
+    ddb = duckdb.connect(":memory:")
+    ddb.execute("set threads=3")
+    ddb.execute("create table settings_applied as select 1 as x")
+    return ddb
+
+
+pool = DuckDBPool(setup, 2)
+
+# connections in use at once are distinct cursors of the same database, which is only set up once
+first, second = pool.acquire(), pool.acquire()
+assert first is not second
+assert len(setups) == 1
+assert pool.metrics() == {"max_size": 2, "created": 2, "reused": 0, "idle": 0, "in_use": 2}
+
+# settings and tables of the database are shared by every cursor
+for conn in [first, second]:
+    assert conn.execute("select current_setting('threads')").fetchone()[0] == 3
+    assert conn.execute("select x from settings_applied").fetchone()[0] == 1
+first.execute("create table shared as select 2 as y")
+assert second.execute("select y from shared").fetchone()[0] == 2
+
+# registered Arrow tables are scoped to the cursor that registered them
+first.register("_rows", pa.table({"a": [1, 2, 3]}))
+assert first.execute("select sum(a) from _rows").fetchone()[0] == 6
+try:
+    second.execute("select * from _rows")
+    raise AssertionError("expected _rows to only be visible to the cursor that registered it")
+except duckdb.CatalogException:
+    pass
+first.unregister("_rows")
+
+# released connections are reused
+pool.release(first)
+pool.release(second)
+assert pool.metrics() == {"max_size": 2, "created": 2, "reused": 0, "idle": 2, "in_use": 0}
+with pool.connection() as ddb:
+    assert ddb in [first, second]
+    assert pool.metrics()["in_use"] == 1
+assert pool.metrics() == {"max_size": 2, "created": 2, "reused": 1, "idle": 2, "in_use": 0}
+
+# more connections than max_size can be in use at once, the extra ones are closed when released
+conns = list(map(lambda x: pool.acquire(), range(3)))
+assert pool.metrics() == {"max_size": 2, "created": 3, "reused": 3, "idle": 0, "in_use": 3}
+for conn in conns:
+    pool.release(conn)
+assert pool.metrics()["idle"] == 2
+try:
+    conns[2].execute("select 1")
+    raise AssertionError("expected the connection over max_size to be closed")
+except duckdb.ConnectionException:
+    pass
+
+# threads each get their own connection
+results = {}
+def query(i: int):
+    with pool.connection() as ddb:
+        results[i] = ddb.execute("select ?::INTEGER * 2", [i]).fetchone()[0]
+threads = list(map(lambda x: threading.Thread(target=query, args=(x,)), range(8)))
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+assert results == dict(map(lambda x: (x, x * 2), range(8)))
+assert pool.metrics()["in_use"] == 0 and pool.metrics()["idle"] <= 2
+
+# close closes the idle connections and the database, connections in use are closed when released
+in_use = pool.acquire()
+pool.close()
+assert pool.metrics()["idle"] == 0
+pool.release(in_use)
+assert pool.metrics() == {"max_size": 0, "created": pool.created, "reused": pool.reused, "idle": 0, "in_use": 0}
+assert len(setups) == 1
+
+print("passed!")
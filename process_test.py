@@ -0,0 +1,103 @@
+import io
+import os
+import pyarrow.parquet as pq
+from multiprocessing import shared_memory
+import icedb.icedb
+from icedb.icedb import IceDBv3, InsertExecutor
+from icedb.log import S3Client, IceLogIO
+
+
+def part_func(row: dict) -> str:
+    return f"u={row['user_id']}"
+
+
+def worker_state() -> tuple[int, bool, bool]:
+    """
+    Runs in an insert worker process: its pid, whether it has an IceDBv3, and whether it inherited the state of the
+    test's main module (which it would if forked)
+    """
+    import __main__
+    return os.getpid(), icedb.icedb._process_icedb is not None, hasattr(__main__, "main_only")
+
+
+# Insert workers are spawned and import this module, so the test only runs in the main process
+if __name__ == "__main__":
+    main_only = True
+    s3c = S3Client(s3prefix="process_test", s3bucket="testbucket", s3region="us-east-1",
+                   s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+    log = IceLogIO("dan-mbp")
+
+    # record the shared memory blocks that partitions are handed to the workers in
+    shared_names = []
+    share_table = icedb.icedb.share_table
+    def recording_share_table(table):
+        shm, size = share_table(table)
+        shared_names.append(shm.name)
+        return shm, size
+    icedb.icedb.share_table = recording_share_table
+
+    def assert_unlinked(names: list[str]):
+        for name in names:
+            try:
+                shared_memory.SharedMemory(name=name).close()
+                raise AssertionError(f"expected shared memory {name} to be unlinked")
+            except FileNotFoundError:
+                pass
+
+    def delete_all():
+        res = s3c.s3.list_objects_v2(Bucket=s3c.s3bucket, MaxKeys=1000, Prefix=s3c.s3prefix)
+        for file in res.get('Contents', []):
+            s3c.s3.delete_object(Bucket=s3c.s3bucket, Key=file['Key'])
+
+    ice = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", s3c, "dan-mbp",
+                  insert_executor=InsertExecutor.PROCESS, insert_processes=2)
+    try:
+        # each partition is written by a worker from shared memory, which is unlinked once written
+        rows = list(map(lambda x: {"user_id": f"user_{x % 3}", "ts": x, "event": f"event_{x}"}, range(300)))
+        inserted = ice.insert(rows)
+        assert len(inserted) == 3
+        assert len(shared_names) == 3
+        assert_unlinked(shared_names)
+
+        # the files written by the workers hold the rows of their partition, and are in the log
+        read = []
+        for file_marker in inserted:
+            body = s3c.s3.get_object(Bucket=s3c.s3bucket, Key=file_marker.path)["Body"].read()
+            assert file_marker.fileBytes == len(body)
+            table = pq.read_table(io.BytesIO(body))
+            assert table.num_rows == file_marker.rowCount == 100
+            assert len(set(table.column("user_id").to_pylist())) == 1
+            assert file_marker.path.split("/")[2] == f"u={table.column('user_id')[0]}"
+            read.extend(table.to_pylist())
+        assert sorted(read, key=lambda x: x["ts"]) == rows
+        _, file_markers, _, _ = log.read_at_max_time(s3c, 2 ** 62)
+        assert sorted(map(lambda x: x.path, file_markers)) == sorted(map(lambda x: x.path, inserted))
+
+        # workers are spawned, not forked, and set up with their own IceDBv3
+        pool = ice._IceDBv3__process_pool
+        assert pool._mp_context.get_start_method() == "spawn"
+        pid, has_icedb, forked = pool.submit(worker_state).result()
+        assert pid != os.getpid()
+        assert has_icedb
+        assert not forked
+
+        # errors in a worker are raised by insert, and the shared memory is still unlinked
+        bad_s3c = S3Client(s3prefix="process_test", s3bucket="missing-bucket", s3region="us-east-1",
+                           s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+        bad = IceDBv3(part_func, ['ts'], "us-east-1", "user", "password", "http://localhost:9000", bad_s3c, "dan-mbp",
+                      insert_executor=InsertExecutor.PROCESS, insert_processes=2)
+        shared_names.clear()
+        try:
+            bad.insert(rows)
+            raise AssertionError("expected the insert to fail")
+        except Exception as e:
+            assert "NoSuchBucket" in str(e), str(e)
+        finally:
+            bad.close()
+        assert len(shared_names) == 3
+        assert_unlinked(shared_names)
+
+        print("passed!")
+    finally:
+        ice.close()
+        delete_all()
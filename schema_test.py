@@ -1,4 +1,6 @@
 from icedb.log import IceLogIO, Schema, SchemaConflictException
+from icedb.arrow_types import arrow_to_duckdb_type
+import pyarrow as pa
 
 log = IceLogIO("dan-mbp")
 
@@ -18,4 +20,11 @@ try:
 except SchemaConflictException as e:
     pass
 
+# Arrow types map to the same names as DuckDB's DESCRIBE
+assert arrow_to_duckdb_type(pa.int64()) == "BIGINT"
+assert arrow_to_duckdb_type(pa.timestamp("ms")) == "TIMESTAMP_MS"
+assert arrow_to_duckdb_type(pa.list_(pa.string())) == "VARCHAR[]"
+assert arrow_to_duckdb_type(pa.struct([("a", pa.float64()), ("order", pa.bool_()), ("b c", pa.date32())])) == \
+       'STRUCT(a DOUBLE, "order" BOOLEAN, "b c" DATE)'
+
 print("passed!")
\ No newline at end of file
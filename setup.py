@@ -18,7 +18,7 @@ setup(
         "boto3==1.26.151",
         "botocore==1.29.151",
         "duckdb==0.9.2",
-        "pyarrow==12.0.1"
+        "pyarrow==24.0.0"
     ],
     keywords=['olap', 'icedb', 'data lake', 'parquet', 'data warehouse', 'analytics'],
     classifiers= []